@@ -7,25 +7,273 @@
 """
 This module encapulates the communication with iDigBio's storage service API.
 """
-import socket
-import argparse, json, urllib2, logging, time, sys
+import socket, errno
+import argparse, json, urllib2, logging, time, sys, os
 import uuid
 import base64
-from poster.encode import multipart_encode
-from poster.streaminghttp import register_openers
+import hashlib
+import threading
+import random
+from Queue import Queue, Empty
+from poster.encode import gen_boundary, MultipartParam
+from poster.streaminghttp import (StreamingHTTPConnection,
+                                  StreamingHTTPHandler,
+                                  StreamingHTTPRedirectHandler)
 from time import sleep
+import httplib
 from httplib import HTTPException
+from dataingestion.services import metrics, tracing
 
 logger = logging.getLogger("iDigBioSvc.api_client")
-register_openers()
 
 api_endpoint = None
 
-def init(api_ep):
-  global api_endpoint
+# Files of at least this many bytes are sent with the chunked upload protocol.
+# None disables chunked uploads. Cleared when the server does not support
+# them.
+chunked_threshold = None
+chunk_size = 8 * 2 ** 20
+chunk_parallelism = 4
+# Whether the dataset CSV is sent gzip-encoded. Cleared when the server
+# rejects a compressed upload or does not decode it.
+csv_gzip = False
+# Blocks of BLOCK_SIZE of the files of a request read ahead of the socket.
+# 0 reads them in the sending thread.
+read_ahead_blocks = 4
+
+def init(api_ep, chunked_threshold_mb=None, chunk_size_mb=None,
+         chunk_parallelism_count=None, csv_gzip_enabled=None,
+         breaker_failures=None, breaker_reset_seconds=None,
+         server_outage_seconds=None, timeout_min_seconds=None,
+         timeout_max_seconds=None, read_ahead=None):
+  global api_endpoint, chunked_threshold, chunk_size, chunk_parallelism
+  global csv_gzip, max_outage_seconds, read_ahead_blocks
   api_endpoint = api_ep
+  if breaker_failures:
+    breaker.failure_threshold = max(1, int(breaker_failures))
+  if breaker_reset_seconds:
+    breaker.reset_timeout = float(breaker_reset_seconds)
+  if server_outage_seconds:
+    max_outage_seconds = float(server_outage_seconds)
+  if timeout_min_seconds:
+    timeouts.min_seconds = float(timeout_min_seconds)
+  if timeout_max_seconds:
+    timeouts.max_seconds = float(timeout_max_seconds)
+  if read_ahead is not None:
+    read_ahead_blocks = max(0, int(read_ahead))
+  if csv_gzip_enabled is not None:
+    csv_gzip = str(csv_gzip_enabled).lower() == "true"
+  if chunked_threshold_mb:
+    chunked_threshold = int(float(chunked_threshold_mb) * 2 ** 20)
+  if chunk_size_mb:
+    chunk_size = int(float(chunk_size_mb) * 2 ** 20)
+  if chunk_parallelism_count:
+    chunk_parallelism = max(1, int(chunk_parallelism_count))
+
+class RequestTimeout(object):
+  """
+  The timeouts of a request, in seconds, given to urlopen as its timeout:
+    connect: to open the connection.
+    read: to wait for each read or write on the socket, including the
+      response.
+    deadline: to send the whole body.
+  """
+  def __init__(self, connect, read, deadline):
+    self.connect = connect
+    self.read = read
+    self.deadline = deadline
+
+  def __repr__(self):
+    return "RequestTimeout(connect={0:.1f}, read={1:.1f}, deadline={2:.1f})"\
+        .format(self.connect, self.read, self.deadline)
+
+class TimeoutPolicy(object):
+  """
+  Derives the timeouts of a request from the size of its body and the
+  throughput and connect time measured on the recent requests:
+    - connect: CONNECT_FACTOR times the smoothed connect time, within
+      [MIN_CONNECT, MAX_CONNECT].
+    - read: min_seconds plus the expected transfer time, as the server takes
+      longer to store a larger file before it responds.
+    - deadline: min_seconds plus DEADLINE_FACTOR times the expected transfer
+      time.
+  read and deadline are within [min_seconds, max_seconds]. A timeout halves
+  the throughput estimate, or doubles the connect time estimate, so that the
+  retries get more time.
+  """
+  CONNECT_FACTOR = 4
+  MIN_CONNECT = 3.0
+  MAX_CONNECT = 30.0
+  DEADLINE_FACTOR = 4
+  # Assumed until the uploads are measured: a slow link.
+  INITIAL_THROUGHPUT = 128 * 1024
+  MIN_THROUGHPUT = 16 * 1024
+  # Smaller bodies measure the latency more than the throughput.
+  MIN_MEASURED_BYTES = 256 * 1024
+  # The weight of a new measurement in the smoothed values.
+  SMOOTHING = 0.3
+
+  def __init__(self, min_seconds=10.0, max_seconds=1800.0):
+    self.min_seconds = min_seconds
+    self.max_seconds = max_seconds
+    self.lock = threading.Lock()
+    self.throughput = float(self.INITIAL_THROUGHPUT)
+    self.connect_seconds = None
+
+  def for_size(self, size):
+    """
+    Returns: The RequestTimeout of a request with a body of size bytes.
+    """
+    self.lock.acquire()
+    try:
+      expected = (size or 0) / self.throughput
+      connect_seconds = self.connect_seconds
+    finally:
+      self.lock.release()
+    connect = self.MIN_CONNECT
+    if connect_seconds is not None:
+      connect = min(self.MAX_CONNECT,
+                    max(connect, self.CONNECT_FACTOR * connect_seconds))
+    return RequestTimeout(
+        connect, self._clamp(self.min_seconds + expected),
+        self._clamp(self.min_seconds + self.DEADLINE_FACTOR * expected))
+
+  def _clamp(self, seconds):
+    return min(self.max_seconds, max(self.min_seconds, seconds))
+
+  def record_transfer(self, size, seconds):
+    if size < self.MIN_MEASURED_BYTES or seconds <= 0:
+      return
+    self.lock.acquire()
+    try:
+      self.throughput += self.SMOOTHING * (size / seconds - self.throughput)
+    finally:
+      self.lock.release()
+
+  def record_connect(self, seconds):
+    self.lock.acquire()
+    try:
+      if self.connect_seconds is None:
+        self.connect_seconds = seconds
+      else:
+        self.connect_seconds += self.SMOOTHING * (
+            seconds - self.connect_seconds)
+    finally:
+      self.lock.release()
+
+  def record_timeout(self, phase):
+    self.lock.acquire()
+    try:
+      if phase == "connect":
+        self.connect_seconds = min(
+            self.MAX_CONNECT, 2 * (self.connect_seconds or self.MIN_CONNECT))
+      else:
+        self.throughput = max(self.MIN_THROUGHPUT, self.throughput / 2)
+    finally:
+      self.lock.release()
+
+# Shared by all the requests.
+timeouts = TimeoutPolicy()
+metrics.throughput_estimate.set_function(lambda: timeouts.throughput)
+
+class _ConnectTimeout(socket.timeout):
+  pass
+
+class _DeadlineExceeded(socket.timeout):
+  pass
+
+def _connect(conn, base_connect):
+  """
+  Opens the connection conn within the connect timeout of its
+  RequestTimeout, and sets the read timeout on the socket.
+  """
+  timeout = conn.timeout
+  if not isinstance(timeout, RequestTimeout):
+    return base_connect(conn)
+  start = time.time()
+  conn.timeout = timeout.connect
+  try:
+    base_connect(conn)
+  except socket.timeout as e:
+    raise _ConnectTimeout(*e.args)
+  finally:
+    conn.timeout = timeout
+  timeouts.record_connect(time.time() - start)
+  conn.sock.settimeout(timeout.read)
+
+def _send(conn, value, base_send):
+  """
+  Sends the request body value on the connection conn with its send_to if it
+  has one, and with base_send otherwise.
+  """
+  if not hasattr(value, "send_to"):
+    return base_send(conn, value)
+  if conn.sock is None:
+    conn.connect()
+  try:
+    value.send_to(conn.sock)
+  except socket.error as e:
+    if e.args and e.args[0] == errno.EPIPE:
+      conn.close()
+    raise
+
+class _HTTPConnection(StreamingHTTPConnection):
+  def connect(self):
+    _connect(self, StreamingHTTPConnection.connect)
+
+  def send(self, value):
+    _send(self, value, StreamingHTTPConnection.send)
+
+class _HTTPHandler(StreamingHTTPHandler):
+  def http_open(self, req):
+    return self.do_open(_HTTPConnection, req)
+
+_handlers = [_HTTPHandler, StreamingHTTPRedirectHandler]
+if hasattr(httplib, "HTTPS"):
+  from poster.streaminghttp import (StreamingHTTPSConnection,
+                                    StreamingHTTPSHandler)
+
+  class _HTTPSConnection(StreamingHTTPSConnection):
+    def connect(self):
+      _connect(self, StreamingHTTPSConnection.connect)
+
+    def send(self, value):
+      _send(self, value, StreamingHTTPSConnection.send)
+
+  class _HTTPSHandler(StreamingHTTPSHandler):
+    def https_open(self, req):
+      return self.do_open(_HTTPSConnection, req)
+
+  _handlers.append(_HTTPSHandler)
+# The streaming handlers of poster, with the timeouts of RequestTimeout.
+urllib2.install_opener(urllib2.build_opener(*_handlers))
+
+def _timeout_phase(err):
+  """
+  Returns: The phase of the request that timed out with err: connect, send,
+    deadline or response. None if err is not a timeout.
+  """
+  if isinstance(err, urllib2.URLError):
+    # urllib2 wraps the errors of connecting and sending the request.
+    err = err.reason
+    if isinstance(err, _ConnectTimeout):
+      return "connect"
+    if isinstance(err, _DeadlineExceeded):
+      return "deadline"
+    if isinstance(err, socket.timeout):
+      return "send"
+  elif isinstance(err, socket.timeout):
+    return "response"
+  return None
 
-TIMEOUT = 3
+def _record_timeout(err):
+  phase = _timeout_phase(err)
+  if phase:
+    count_timeout(phase)
+
+def count_timeout(phase):
+  metrics.timeouts.inc(phase=phase)
+  timeouts.record_timeout(phase)
 
 def _build_url(collection):
   assert api_endpoint
@@ -35,37 +283,366 @@ def _build_url(collection):
     ret = "%s/upload/%s" % (api_endpoint, collection)
   return ret
 
-def _post_image(path, reference):
+def use_chunked_upload(size):
+  """
+  Returns True if a file of size bytes should go through the chunked upload
+  protocol instead of a single multipart POST.
+  """
+  return bool(chunked_threshold) and size not in (None, "") and \
+      int(size) >= chunked_threshold
+
+def _read_into(stream, view):
+  """
+  Reads from stream into the memoryview view.
+  Returns: The number of bytes read, 0 at the end of the stream.
+  """
+  readinto = getattr(stream, "readinto", None)
+  if readinto is not None:
+    return readinto(view)
+  data = stream.read(len(view))
+  view[:len(data)] = data
+  return len(data)
+
+class _ReadAhead(object):
+  """
+  Reads the files of params, in order, from a background thread into a ring
+  of depth buffers of block_size bytes, so that the next blocks are read from
+  the disk while the previous ones are sent.
+  """
+  def __init__(self, params, block_size, depth):
+    self.params = params
+    self.free = Queue()
+    for _junk in xrange(depth):
+      self.free.put(memoryview(bytearray(block_size)))
+    self.full = Queue()
+    self.closed = False
+    self.thread = threading.Thread(target=self._run, name="read-ahead")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _run(self):
+    try:
+      for param in self.params:
+        remaining = param.filesize
+        while remaining:
+          view = self.free.get()
+          if self.closed:
+            return
+          count = _read_into(param.fileobj, view[:min(remaining, len(view))])
+          if not count:
+            raise _file_changed(param)
+          remaining -= count
+          self.full.put((view, count))
+    except Exception as e:
+      # Handed to the sender, which would otherwise wait forever.
+      self.full.put((None, e))
+
+  def next_block(self):
+    """
+    Returns: (view, count), the next block of the files in view[:count].
+      view is reused once given back with release.
+    """
+    view, count = self.full.get()
+    if view is None:
+      raise count
+    return view, count
+
+  def release(self, view):
+    self.free.put(view)
+
+  def close(self):
+    """
+    Stops the reader and waits for it, so that the files can be closed.
+    """
+    self.closed = True
+    self.free.put(None)
+    self.thread.join()
+
+class MultipartBody(object):
+  """
+  The multipart/form-data body of params, encoded as poster's
+  multipart_encode does, with its headers computed up front. The files are
+  read in blocks of BLOCK_SIZE rather than poster's 4 KB: send_to writes
+  them to the socket from reused buffers, and iterating the body, as
+  poster's connections and the event loop do, yields strings of that size.
+  Files of more than one block are read up to read_ahead blocks ahead of the
+  sends by a _ReadAhead, or in the sending thread if read_ahead is 0.
+  The boundary is random, so unlike poster the files are not searched for it.
+  cb(param, current, total) is called as the blocks are sent, as with
+  multipart_encode. close() must be called once the body is no longer sent.
+  """
+  BLOCK_SIZE = 256 * 1024
+
+  def __init__(self, params, cb=None, boundary=None, read_ahead=None):
+    boundary = boundary or gen_boundary()
+    self.params = MultipartParam.from_params(params)
+    # (param, data) pairs, data None for the content of the file of param.
+    self.parts = []
+    for param in self.params:
+      if param.fileobj is None:
+        self.parts.append((param, param.encode(boundary)))
+      else:
+        self.parts.append((param, param.encode_hdr(boundary)))
+        self.parts.append((param, None))
+        self.parts.append((param, "\r\n"))
+    self.parts.append((None, "--%s--\r\n" % boundary))
+    self.total = sum(param.filesize if data is None else len(data)
+                     for param, data in self.parts)
+    self.headers = {
+        "Content-Type": "multipart/form-data; boundary=%s" % boundary,
+        "Content-Length": str(self.total)}
+    self.cb = cb
+    if read_ahead is None:
+      read_ahead = read_ahead_blocks
+    file_bytes = sum(param.filesize for param, data in self.parts
+                     if data is None)
+    self.read_ahead = read_ahead if file_bytes > self.BLOCK_SIZE else 0
+    self.reader = None
+    self.buffer = None
+    self.blocks = None
+    self.reset()
+
+  def __iter__(self):
+    return self
+
+  def reset(self):
+    self.close()
+    for param in self.params:
+      param.reset()
+    self.current = 0
+    # Seconds the sender waited for the files to be read.
+    self.read_time = 0.0
+    self.blocks = self._iter_blocks()
+
+  def close(self):
+    if self.blocks is not None:
+      self.blocks.close()
+    if self.reader is not None:
+      self.reader.close()
+      self.reader = None
+
+  def _iter_blocks(self):
+    """
+    Yields the (param, data) blocks of the body. data is a string or, for the
+    files, a memoryview valid until the next block.
+    """
+    for param, data in self.parts:
+      if data is not None:
+        yield param, data
+        continue
+      remaining = param.filesize
+      while remaining:
+        start = time.time()
+        if self.read_ahead:
+          if self.reader is None:
+            self.reader = _ReadAhead(
+                [p for p, d in self.parts if d is None], self.BLOCK_SIZE,
+                self.read_ahead)
+          view, count = self.reader.next_block()
+        else:
+          if self.buffer is None:
+            self.buffer = memoryview(bytearray(self.BLOCK_SIZE))
+          view = self.buffer
+          count = _read_into(param.fileobj,
+                             view[:min(remaining, self.BLOCK_SIZE)])
+          if not count:
+            raise _file_changed(param)
+        self.read_time += time.time() - start
+        remaining -= count
+        try:
+          yield param, view[:count]
+        finally:
+          if view is not self.buffer:
+            self.reader.release(view)
+
+  def next(self):
+    param, data = self.blocks.next()
+    self._advance(param, len(data))
+    if isinstance(data, memoryview):
+      return data.tobytes()
+    return data
+
+  def _advance(self, param, count):
+    self.current += count
+    if self.cb:
+      self.cb(param, self.current, self.total)
+
+  def send_to(self, sock, sent=None):
+    """
+    Sends the body, from its beginning, to the socket sock. sent(count) is
+    called after each write.
+    """
+    self.reset()
+    for param, data in self.blocks:
+      sock.sendall(data)
+      self._advance(param, len(data))
+      if sent:
+        sent(len(data))
+
+def _file_changed(param):
+  # A socket.error so that urllib2 reports it as the failure of the request.
+  return socket.error("{0} is shorter than its {1} bytes.".format(
+      getattr(param.fileobj, "name", param.name), param.filesize))
+
+class _TimedBody(object):
+  """
+  Wraps a MultipartBody to measure the time the request spends encoding the
+  body, sending it and waiting for the server, and to stop it at the
+  deadline of its timeout.
+  """
+  def __init__(self, datagen):
+    self.datagen = datagen
+    self.total = datagen.total
+    self.timeout = timeouts.for_size(self.total)
+    self.sent = 0
+    self.encode_time = 0.0
+    self.start = None
+    self.end = None
+    self.finished = False
+
+  def __iter__(self):
+    return self
+
+  def reset(self):
+    self.datagen.reset()
+    self.encode_time = 0.0
+    self.start = None
+    self.end = None
+
+  def _check_deadline(self, now):
+    if now - self.start > self.timeout.deadline:
+      raise _DeadlineExceeded("The body was not sent in {0:.0f} seconds."
+                              .format(self.timeout.deadline))
+
+  def next(self):
+    now = time.time()
+    if self.start is None:
+      self.start = now
+    else:
+      self._check_deadline(now)
+    try:
+      block = self.datagen.next()
+    except StopIteration:
+      self.end = time.time()
+      raise
+    self.encode_time += time.time() - now
+    self.sent += len(block)
+    return block
+
+  def send_to(self, sock):
+    """
+    Sends the body to sock with MultipartBody.send_to, see _send. The time
+    spent reading the files counts as encoding.
+    """
+    self.reset()
+    self.start = time.time()
+    def _sent(count):
+      self.sent += count
+      self._check_deadline(time.time())
+    self.datagen.send_to(sock, _sent)
+    self.end = time.time()
+    self.encode_time = self.datagen.read_time
+
+  def finish(self, success):
+    """
+    Records the metrics of the request once it has returned (success) or
+    failed. Only the first call counts.
+    """
+    if self.finished:
+      return
+    self.finished = True
+    self.datagen.close()
+    metrics.sent_bytes.inc(self.sent)
+    if success and self.end is not None:
+      self.send_time = self.end - self.start - self.encode_time
+      self.server_wait = time.time() - self.end
+      timeouts.record_transfer(self.sent, self.end - self.start)
+      tracing.record("encode", self.encode_time)
+      tracing.record("send", self.send_time)
+      tracing.record("server_wait", self.server_wait)
+      logger.debug("Request done. Size: {0} bytes. Encode: {1:.3f} sec. "
+          "Send: {2:.3f} sec. Server wait: {3:.3f} sec.".format(
+          self.total, self.encode_time, self.send_time, self.server_wait))
+
+class ByteProgress(object):
+  """
+  Reports the bytes of the requests of one upload to func(delta) as they are
+  sent. The bytes are reported in steps of at least REPORT_STEP, and taken
+  back with rollback() when the attempt fails or its file is accounted for as
+  a whole, so that the sum of the deltas is the bytes in flight.
+  It is the cb of MultipartBody, and thread-safe so that the parts
+  of a chunked upload can share it.
+  """
+  REPORT_STEP = 256 * 1024
+
+  def __init__(self, func):
+    self.func = func
+    self.lock = threading.Lock()
+    self.current = 0
+    self.reported = 0
+
+  def __call__(self, param, current, total):
+    self.lock.acquire()
+    try:
+      self.current = current
+      self._report(current == total)
+    finally:
+      self.lock.release()
+
+  def add(self, count):
+    self.lock.acquire()
+    try:
+      self.current += count
+      self._report(True)
+    finally:
+      self.lock.release()
+
+  def rollback(self):
+    self.lock.acquire()
+    try:
+      self.current = 0
+      self._report(True)
+    finally:
+      self.lock.release()
+
+  def _report(self, force):
+    delta = self.current - self.reported
+    if delta and (force or abs(delta) >= self.REPORT_STEP):
+      self.reported = self.current
+      self.func(delta)
+
+def _post_image(path, reference, progress=None):
   with open(path, "rb") as stream:
-    _post_stream(stream, reference)
+    return _post_stream(stream, reference, progress)
 
-def _post_stream(stream, reference):
+def encode_image(stream, reference, progress=None):
+  """
+  Encodes the POST of the media read from stream.
+  Returns: (url, body, headers, cb). body is a _TimedBody and cb the
+    ByteProgress reporting to progress, or None.
+  """
   url = _build_url("images")
+  params = {"file": stream, "filereference": reference}
+  cb = progress and ByteProgress(progress)
+  datagen = MultipartBody(params, cb=cb)
+  headers = dict(datagen.headers)
+  headers["Authorization"] = "Basic %s" % auth_string
+  return url, _TimedBody(datagen), headers, cb
+
+def _post_stream(stream, reference, progress=None):
+  """
+  POSTs the media read from stream. If progress is given, the bytes sent are
+  reported to progress(delta) while the request is in flight.
+  """
+  url, body, headers, cb = encode_image(stream, reference, progress)
+  path = getattr(stream, "name", "")
   try:
-    params = {"file": stream, "filereference": reference}
-  except IOError as e:
-    logger.error("File IO error: {0}".format(e))
-    raise
-  size = sys.getsizeof(params)
-  datagen, headers = multipart_encode(params)
-  try:
-    request = urllib2.Request(url, datagen, headers)
-    request.add_header("Authorization", "Basic %s" % auth_string)
-    starttime = time.time()
-    startptime = time.clock()
-    resp = urllib2.urlopen(request, timeout=TIMEOUT).read()
-    duration = time.time() - starttime
-    ptime = time.clock() - startptime
-    logger.debug("POSTing image done. Size: {0} Duration: {1} sec. Processing time: {2} sec."
-        .format(size, duration, ptime))
+    request = urllib2.Request(url, body, headers)
+    resp = urllib2.urlopen(request, timeout=body.timeout).read()
+    body.finish(True)
     return resp
   except urllib2.HTTPError as e:
     logger.error("urllib2.HTTPError caught: {0}".format(e.code))
-    if e.code == 500:
-      logger.error("Fatal Server Exception Detected. HTTP Error code:{0}"
-          .format(e.code))
-      raise ServerException(
-          "Fatal Server Exception Detected. HTTP Error code:{0}".format(e.code))
     logger.error("Failed to POST the media to server. url={0}, http_status={1},\
         http_response_content={2}, local_path={3}"
         .format(request.get_full_url(), e.code, e.read(), path))
@@ -73,39 +650,100 @@ def _post_stream(stream, reference):
         "Failed to POST the media to server", url=request.get_full_url(),
         http_status=e.code, http_response_content=e.read(), local_path=path)
   except (urllib2.URLError, socket.error, socket.timeout, HTTPException) as e:
+    _record_timeout(e)
     # URLError: server down, network down.
     logger.error("{0} caught while POSTing the media. reason={1}, url={2}."
         .format(type(e), str(e), url))
     raise ClientException("{0} caught while POSTing the media.".format(type(e)),
                           reason=str(e), url=url)
+  finally:
+    body.finish(False)
+    if cb:
+      cb.rollback()
 
-def _post_csv(path):
-  url = _build_url("datasets")
+def _post_images_batch(items, progress=None):
+  """
+  POSTs several images in one multipart request.
+  Params:
+    items: A list of (path, reference) pairs.
+    progress: If given, the bytes sent are reported to progress(delta) while
+      the request is in flight.
+  Returns: A list with an entry for each item in order: the server response
+    for that file as a JSON string (same format as a single image POST), or a
+    ClientException if the server failed to store it.
+  """
+  url = _build_url("batch")
+  streams = []
   try:
-    params = {"file": open(path, "rb")}
-  except IOError as e:
-    logger.error("File IO error: {0}".format(e))
-    raise
-  size = sys.getsizeof(params)
-  datagen, headers = multipart_encode(params)
+    params = []
+    for index, (path, reference) in enumerate(items):
+      stream = open(path, "rb")
+      streams.append(stream)
+      params.append(("file%d" % index, stream))
+      params.append(("filereference%d" % index, reference))
+    cb = progress and ByteProgress(progress)
+    datagen = MultipartBody(params, cb=cb)
+    body = _TimedBody(datagen)
+    request = urllib2.Request(url, body, datagen.headers)
+    try:
+      resp = _open_request(request)
+      body.finish(True)
+    finally:
+      body.finish(False)
+      if cb:
+        cb.rollback()
+  finally:
+    for stream in streams:
+      stream.close()
+
+  results = [ClientException("No result returned for the file.", url=url,
+                             local_path=path) for path, _junk in items]
+  for result_obj in json.loads(resp)["results"]:
+    index = int(result_obj["index"])
+    if result_obj.get("error"):
+      metrics.failures.inc(cause="batch_member")
+      results[index] = ClientException(
+          "Failed to POST the media to server", url=url,
+          reason=result_obj["error"], local_path=items[index][0])
+    else:
+      results[index] = json.dumps(result_obj)
+  return results
+
+def _post_csv(path, content_encoding=None):
+  """
+  POSTs the dataset CSV file at path. If content_encoding is "gzip", the file
+  at path is the gzip-encoded CSV and the server is asked to decode it.
+  """
+  with open(path, "rb") as stream:
+    return _post_csv_stream(stream, os.path.basename(path), content_encoding)
+
+def _post_csv_stream(stream, filename, content_encoding=None):
+  """
+  POSTs the dataset CSV read from stream, from its beginning, as filename.
+  """
+  url = _build_url("datasets")
+  path = filename
+  stream.seek(0, 2)
+  filesize = stream.tell()
+  stream.seek(0)
+  if content_encoding == "gzip":
+    params = [MultipartParam("file", filename=filename,
+                             filetype="application/gzip", filesize=filesize,
+                             fileobj=stream),
+              ("content_encoding", content_encoding)]
+  else:
+    params = [MultipartParam("file", filename=filename, filetype="text/csv",
+                             filesize=filesize, fileobj=stream)]
+  datagen = MultipartBody(params)
+  body = _TimedBody(datagen)
   try:
-    request = urllib2.Request(url, datagen, headers)
+    request = urllib2.Request(url, body, datagen.headers)
     request.add_header("Authorization", "Basic %s" % auth_string)
-    starttime = time.time()
-    startptime = time.clock()
-    resp = urllib2.urlopen(request, timeout=TIMEOUT).read()
-    duration = time.time() - starttime
-    ptime = time.clock() - startptime
-    logger.debug("POSTing CSV file done. Size: {0} Duration: {1} sec. Processing time: {2} sec."
-        .format(size, duration, ptime))
+    resp = urllib2.urlopen(request, timeout=body.timeout).read()
+    body.finish(True)
     return resp
   except urllib2.HTTPError as e:
     logger.debug("urllib2.HTTPError caught: {0}".format(e.code))
-    if e.code == 500:
-      logger.error("Fatal Server Exception Detected. HTTP Error code:{0}"
-          .format(e.code))
-      raise ServerException(
-          "Fatal Server Exception Detected. HTTP Error code:{0}".format(e.code))
     logger.error("Failed to POST the media to server. url={0}, http_status={1},\
         http_response_content={2}, local_path={3}"
         .format(request.get_full_url(), e.code, e.read(), path))
@@ -113,10 +751,121 @@ def _post_csv(path):
         "Failed to POST the CSV file to server", url=request.get_full_url(),
         http_status=e.code, http_response_content=e.read())
   except (urllib2.URLError, socket.error, socket.timeout, HTTPException) as e:
+    _record_timeout(e)
     logger.error("{0} caught while POSTing the media. reason={1}, url={2}."
         .format(type(e), str(e), url))
     raise ClientException("{0} caught while POSTing the CSV file.".format(type(e)),
                           reason=str(e), url=url)
+  finally:
+    body.finish(False)
+
+def _open_request(request, local_path="", size=None):
+  """
+  Sends request and returns the response body, translating failures the same
+  way _post_stream does. The timeouts are for size bytes, by default the size
+  of the request body.
+  """
+  request.add_header("Authorization", "Basic %s" % auth_string)
+  timeout = getattr(request.get_data(), "timeout", None)
+  if timeout is None:
+    if size is None:
+      size = len(request.get_data() or "")
+    timeout = timeouts.for_size(size)
+  try:
+    return urllib2.urlopen(request, timeout=timeout).read()
+  except urllib2.HTTPError as e:
+    logger.error("urllib2.HTTPError caught: {0}".format(e.code))
+    content = e.read()
+    logger.error("Request failed. url={0}, http_status={1},\
+        http_response_content={2}, local_path={3}"
+        .format(request.get_full_url(), e.code, content, local_path))
+    raise ClientException(
+        "Request failed", url=request.get_full_url(), http_status=e.code,
+        http_response_content=content, local_path=local_path)
+  except (urllib2.URLError, socket.error, socket.timeout, HTTPException) as e:
+    _record_timeout(e)
+    logger.error("{0} caught while sending the request. reason={1}, url={2}."
+        .format(type(e), str(e), request.get_full_url()))
+    raise ClientException(
+        "{0} caught while sending the request.".format(type(e)),
+        reason=str(e), url=request.get_full_url(), local_path=local_path)
+
+def _open_upload_session(path, reference, file_md5, part_size):
+  """
+  Opens (or reopens) a chunked upload session for the file at path.
+  The server keys sessions by (reference, file_md5), so reopening the session
+  of an interrupted upload, even from a new process, returns the parts it
+  already holds.
+  Returns: The decoded session object with session_id and parts, which maps
+    the received part indexes to their MD5s.
+  """
+  body = json.dumps({
+      "filereference": reference,
+      "file_name": os.path.basename(path),
+      "file_size": os.path.getsize(path),
+      "file_md5": file_md5,
+      "part_size": part_size})
+  request = urllib2.Request(_build_url("sessions"), body,
+                            {"Content-Type": "application/json"})
+  return json.loads(_open_request(request, path))
+
+def _post_part(session_id, path, index, part_size, progress=None):
+  """
+  Uploads part index of the file at path and checks the MD5 the server
+  computed for it. The part size is added to the ByteProgress progress once
+  the part is stored.
+  """
+  with open(path, "rb") as f:
+    f.seek(index * part_size)
+    data = f.read(part_size)
+  part_md5 = hashlib.md5(data).hexdigest()
+  url = _build_url("sessions/%s/parts/%d" % (session_id, index))
+  request = urllib2.Request(url, data, {
+      "Content-Type": "application/octet-stream",
+      "Content-MD5": base64.b64encode(hashlib.md5(data).digest())})
+  result = json.loads(_open_request(request, path))
+  metrics.sent_bytes.inc(len(data))
+  if result.get("part_md5") != part_md5:
+    logger.error("Part {0} of {1} is corrupted in transfer.".format(
+        index, path))
+    raise ClientException("Part MD5 does not match.", url=url,
+                          local_path=path)
+  if progress:
+    progress.add(len(data))
+  return part_md5
+
+def _commit_upload_session(session_id, path):
+  """
+  Asks the server to assemble the parts. The response has the same format
+  as the response of a single image POST.
+  """
+  request = urllib2.Request(
+      _build_url("sessions/%s/commit" % session_id), "",
+      {"Content-Type": "application/json"})
+  # The server assembles the file before it responds.
+  return _open_request(request, path, os.path.getsize(path))
+
+def _check_existing(file_md5s):
+  """
+  Asks the server which of the given media MD5s it already stores.
+  Returns: A dict mapping each stored MD5 to the server's record of it, which
+    has the same format as the response of a single image POST.
+  """
+  request = urllib2.Request(
+      _build_url("exists"), json.dumps({"file_md5s": list(file_md5s)}),
+      {"Content-Type": "application/json"})
+  return json.loads(_open_request(request)).get("existing", {})
+
+def _file_md5(path, block_size=2 ** 20):
+  md5 = hashlib.md5()
+  with tracing.span("hash"):
+    with open(path, "rb") as f:
+      while True:
+        data = f.read(block_size)
+        if not data:
+          break
+        md5.update(data)
+  return md5.hexdigest()
 
 auth_string = None
 
@@ -143,7 +892,7 @@ def authenticate(user, key):
                           {'Content-Type': 'application/json'})
     base64string = base64.encodestring('%s:%s' % (user, key)).replace('\n', '')
     req.add_header("Authorization", "Basic %s" % base64string)
-    urllib2.urlopen(req, timeout=TIMEOUT)
+    urllib2.urlopen(req, timeout=timeouts.for_size(0))
     logger.info("Successfully logged in.")
     auth_string = base64string
     return True
@@ -159,12 +908,21 @@ def authenticate(user, key):
                             http_status=e.code, http_response_content=e.read(),
                             reason=user)
   except (urllib2.URLError, socket.error, socket.timeout, HTTPException) as e:
+    _record_timeout(e)
     logger.error("{0} caught while POSTing the media: url={1}, user={2}, key={3}"
         .format(type(e), url, user, key))
     raise ClientException("{0} caught while POSTing the media.".format(type(e)),
                           url=url, reason=user)
   return False
 
+def _failure_cause(err):
+  """
+  Returns: The failure cause label of a failed request attempt.
+  """
+  if getattr(err, "http_status", None):
+    return "http_%s" % err.http_status
+  return "network"
+
 class ClientException(Exception):
   def __init__(self, msg, url='', http_status=None, reason='', local_path='',
          http_response_content=''):
@@ -220,12 +978,171 @@ class ServerException(Exception):
     return self.msg + str(self.http_status)
 
 
+class RetryLater(ClientException):
+  """
+  Raised by a Connection with defer_retries instead of waiting before the
+  next attempt: the caller sends the request again, with attempts, once delay
+  seconds have passed. err is the failure of the last attempt, or None if the
+  circuit breaker refused the request.
+  """
+  def __init__(self, err, delay, attempts):
+    if err is None:
+      ClientException.__init__(self, "The circuit breaker is open.")
+    else:
+      ClientException.__init__(
+          self, err.msg, url=err.url, http_status=err.http_status,
+          reason=err.reason, local_path=err.local_path,
+          http_response_content=err.http_response_content)
+    self.err = err
+    self.delay = delay
+    self.attempts = attempts
+
+
+# The backoff before a retry grows up to this many seconds.
+MAX_BACKOFF = 60
+# A request refused by the circuit breaker after the server has been failing
+# for this many seconds raises ServerException.
+max_outage_seconds = 600
+
+def backoff_delay(attempts, starting_backoff=1):
+  """
+  Returns: The seconds to wait before retrying a request that failed
+    attempts times: a random time up to starting_backoff * 2 ** (attempts - 1)
+    ("full jitter"), so that the requests failing together are not retried
+    together.
+  """
+  ceiling = min(MAX_BACKOFF, starting_backoff * 2 ** max(0, attempts - 1))
+  return random.uniform(0, ceiling)
+
+def is_retryable(err, attempts):
+  """
+  Returns: Whether a request that failed with the ClientException err, after
+    attempts attempts, can be retried.
+  """
+  if err.http_status == 401: # Unauthorized
+    return attempts <= 1
+  return (err.http_status in (None, 408) # Network error, Request Timeout.
+          or 500 <= err.http_status <= 599)
+
+class CircuitBreaker(object):
+  """
+  Stops the requests of all the Connections while the server keeps failing:
+    - closed: the requests are sent. failure_threshold failures in a row open
+      the circuit.
+    - open: the requests are refused for reset_timeout seconds, then the
+      circuit is half-open.
+    - half-open: a single request, the probe, is sent. Its success closes the
+      circuit and its failure opens it again. A probe that does not report
+      back (e.g. for a local error) is replaced after reset_timeout seconds.
+  """
+  CLOSED = "closed"
+  HALF_OPEN = "half-open"
+  OPEN = "open"
+  # The value of metrics.circuit_state.
+  STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+  def __init__(self, failure_threshold=5, reset_timeout=30.0):
+    self.failure_threshold = failure_threshold
+    self.reset_timeout = reset_timeout
+    self.lock = threading.Lock()
+    self.state = self.CLOSED
+    self.failures = 0
+    self.opened_at = None
+    self.probe_started = None
+    # The time of the first of the failures in a row, None after a success.
+    self.failing_since = None
+
+  def allow(self, now=None):
+    """
+    Returns: Whether a request can be sent now.
+    """
+    if now is None:
+      now = time.time()
+    self.lock.acquire()
+    try:
+      if self.state == self.CLOSED:
+        return True
+      if self.state == self.OPEN:
+        if now - self.opened_at < self.reset_timeout:
+          return False
+        self._set_state(self.HALF_OPEN)
+      elif now - self.probe_started < self.reset_timeout:
+        return False
+      self.probe_started = now
+      return True
+    finally:
+      self.lock.release()
+
+  def retry_after(self, now=None):
+    """
+    Returns: The seconds until a request may be allowed.
+    """
+    if now is None:
+      now = time.time()
+    self.lock.acquire()
+    try:
+      if self.state == self.OPEN:
+        start = self.opened_at
+      elif self.state == self.HALF_OPEN:
+        start = self.probe_started
+      else:
+        return 0
+      return max(0, start + self.reset_timeout - now)
+    finally:
+      self.lock.release()
+
+  def outage_seconds(self, now=None):
+    """
+    Returns: The seconds since the server started failing, or 0.
+    """
+    if now is None:
+      now = time.time()
+    failing_since = self.failing_since
+    return now - failing_since if failing_since is not None else 0
+
+  def record_success(self):
+    self.lock.acquire()
+    try:
+      self.failures = 0
+      self.failing_since = None
+      if self.state != self.CLOSED:
+        logger.info("The server answers again. Closing the circuit.")
+        self._set_state(self.CLOSED)
+    finally:
+      self.lock.release()
+
+  def record_failure(self, now=None):
+    if now is None:
+      now = time.time()
+    self.lock.acquire()
+    try:
+      self.failures += 1
+      if self.failing_since is None:
+        self.failing_since = now
+      if (self.state == self.HALF_OPEN or (self.state == self.CLOSED and
+          self.failures >= self.failure_threshold)):
+        logger.error("{0} failed requests in a row. Opening the circuit for "
+                     "{1} seconds.".format(self.failures, self.reset_timeout))
+        self.opened_at = now
+        self._set_state(self.OPEN)
+    finally:
+      self.lock.release()
+
+  def _set_state(self, state):
+    self.state = state
+    self.probe_started = None
+
+# Shared by all the Connections.
+breaker = CircuitBreaker()
+metrics.circuit_state.set_function(
+    lambda: CircuitBreaker.STATE_VALUES[breaker.state])
+
 class Connection(object):
   """Convenience class to make requests that will also retry the request"""
 
   def __init__(self, authurl=None, user=None, key=None, retries=4,
                preauthurl=None, preauthtoken=None, snet=False,
-               starting_backoff=1, auth_version="1"):
+               starting_backoff=1, auth_version="1", defer_retries=False):
     """
     Params:
       authurl: authenitcation URL
@@ -236,6 +1153,7 @@ class Connection(object):
       preauthtoken: authentication token (if you have already authenticated)
       snet: use SERVICENET internal network default is False
       auth_version: Openstack auth version.
+      defer_retries: Raise RetryLater instead of waiting before a retry.
     """
     self.authurl = authurl
     self.user = user
@@ -248,43 +1166,197 @@ class Connection(object):
     self.snet = snet
     self.starting_backoff = starting_backoff
     self.auth_version = auth_version
+    self.defer_retries = defer_retries
 
   def _retry(self, reset_func, func, *args, **kwargs):
-    self.attempts = 0
-    backoff = self.starting_backoff
-    while self.attempts <= self.retries:
+    return self._retry_from(0, reset_func, func, *args, **kwargs)
+
+  def _retry_from(self, attempts, reset_func, func, *args, **kwargs):
+    """
+    Calls func until it succeeds, fails with an error that is not retried, or
+    the attempts, counting the attempts made before, exceed the retries.
+    Before each attempt, waits for the circuit breaker to allow it, and before
+    each retry, a jittered backoff. With defer_retries, raises RetryLater
+    instead of waiting.
+    """
+    self.attempts = attempts
+    while True:
+      delay = self.breaker_delay()
+      if delay is not None:
+        if self.defer_retries:
+          raise RetryLater(None, delay, self.attempts)
+        sleep(delay)
+        continue
+
       self.attempts += 1
       try:
         rv = func(*args, **kwargs)
-        return rv
       except ClientException as err:
-        logger.error("ClientException caught: {0}, Current retry attempts: {1}"
-            .format(err, self.attempts))
-
-        if self.attempts > self.retries:
-          logger.error("Retries exhausted. retry threshold: {0}"
-              .format(self.retries))
-          raise
-
-        if err.http_status == 401: # Unauthorized
-          if self.attempts > 1:
-            raise
-        elif err.http_status == 408: # Request Timeout
-          pass
-        elif 500 <= err.http_status <= 599:
-          pass
-        elif err.http_status is None:
-          pass
-        else:
-          raise
+        delay = self.attempt_failed(err)
+        if self.defer_retries:
+          raise RetryLater(err, delay, self.attempts)
+      else:
+        breaker.record_success()
+        return rv
 
-      sleep(backoff)
-      backoff *= 2
+      sleep(delay)
       if reset_func:
         reset_func(func, *args, **kwargs)
 
-  def post_image(self, path, reference):
-    return self._retry(None, _post_image, path, reference)
+  def breaker_delay(self):
+    """
+    Returns: None if the circuit breaker allows a request now, or the seconds
+      to wait before asking again.
+    Raises ServerException if the server has been failing for longer than
+    max_outage_seconds.
+    """
+    if breaker.allow():
+      return None
+    if breaker.outage_seconds() > max_outage_seconds:
+      logger.error("The server has been failing for {0:.0f} seconds."
+          .format(breaker.outage_seconds()))
+      raise ServerException("The server has been failing for {0:.0f} "
+          "seconds.".format(breaker.outage_seconds()))
+    return breaker.retry_after() + random.uniform(0, self.starting_backoff)
+
+  def attempt_failed(self, err):
+    """
+    Counts the failure err of the attempt number self.attempts.
+    Returns: The seconds to wait before the next attempt.
+    Raises err if the request is not retried.
+    """
+    metrics.failures.inc(cause=_failure_cause(err))
+    logger.error("ClientException caught: {0}, Current retry attempts: {1}"
+        .format(err, self.attempts))
+    if not is_retryable(err, self.attempts):
+      # The server is up: it answered.
+      breaker.record_success()
+      raise err
+    breaker.record_failure()
+    if self.attempts > self.retries:
+      logger.error("Retries exhausted. retry threshold: {0}"
+          .format(self.retries))
+      raise err
+    metrics.retries.inc()
+    return backoff_delay(self.attempts, self.starting_backoff)
+
+  def post_image(self, path, reference, progress=None, attempts=0):
+    """
+    If progress is given, the bytes in flight are reported to progress(delta),
+    see ByteProgress. attempts is the number of attempts made before, see
+    RetryLater.
+    """
+    return self._retry_from(attempts, None, _post_image, path, reference,
+                            progress)
+
+  def post_image_chunked(self, path, reference, file_md5=None, progress=None,
+                         attempts=0):
+    """
+    Uploads a large file as fixed-size parts followed by a commit.
+    Parts already held by the server (from an earlier, interrupted attempt)
+    are not sent again, and a failed part only retries that part.
+    The stored parts are reported to progress(delta) until the upload ends.
+    Returns: The server response of the commit, same as post_image.
+    """
+    if not file_md5:
+      file_md5 = _file_md5(path)
+    part_size = chunk_size
+    try:
+      session = self._retry_from(attempts, None, _open_upload_session, path,
+                                 reference, file_md5, part_size)
+    except ClientException as ex:
+      if ex.http_status not in (404, 405):
+        raise
+      # A server without the upload sessions: the files are sent whole.
+      global chunked_threshold
+      logger.error("The server does not support chunked uploads, sending "
+                   "the files in a single request.")
+      chunked_threshold = None
+      return self.post_image(path, reference, progress, attempts)
+    session_id = str(session["session_id"])
+    part_size = int(session.get("part_size", part_size))
+    part_count = max(1, -(-os.path.getsize(path) // part_size))
+    received = session.get("parts", {})
+    missing = [i for i in xrange(part_count) if str(i) not in received]
+    logger.debug("Chunked upload of {0}: session={1}, {2} of {3} parts to send."
+        .format(path, session_id, len(missing), part_count))
+
+    parts = Queue()
+    for index in missing:
+      parts.put(index)
+    errors = []
+    part_progress = progress and ByteProgress(progress)
+
+    def _send_parts():
+      conn = Connection(retries=self.retries,
+                        starting_backoff=self.starting_backoff)
+      while not errors:
+        try:
+          index = parts.get_nowait()
+        except Empty:
+          return
+        try:
+          conn._retry(None, _post_part, session_id, path, index, part_size,
+                      part_progress)
+        except Exception:
+          errors.append(sys.exc_info())
+          return
+
+    threads = [threading.Thread(target=_send_parts)
+               for _junk in xrange(min(chunk_parallelism, len(missing)))]
+    try:
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+      if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+      return self._retry_from(attempts, None, _commit_upload_session,
+                              session_id, path)
+    finally:
+      if part_progress:
+        part_progress.rollback()
+
+  def post_image_batch(self, items, progress=None, attempts=0):
+    """
+    Posts the (path, reference) items in one request. Members the server
+    fails to store are retried, without the others, until the retries are
+    exhausted. The bytes in flight are reported to progress(delta).
+    With defer_retries, the members are not retried: the caller retries the
+    failed ones later, with the attempts of the connection.
+    Returns: A list of server responses or ClientExceptions, as
+      _post_images_batch.
+    """
+    if self.defer_retries:
+      return self._retry_from(attempts, None, _post_images_batch, items,
+                              progress)
+    results = [None] * len(items)
+    pending = range(len(items))
+    for attempt in xrange(self.retries + 1):
+      if attempt:
+        logger.error("{0} files of an image group failed, retrying them."
+            .format(len(pending)))
+        metrics.retries.inc(len(pending))
+        sleep(backoff_delay(attempt, self.starting_backoff))
+      batch_results = self._retry(
+          None, _post_images_batch, [items[i] for i in pending], progress)
+      failed = []
+      for index, result in zip(pending, batch_results):
+        results[index] = result
+        if isinstance(result, ClientException):
+          failed.append(index)
+      pending = failed
+      if not pending:
+        break
+    return results
+
+  def check_existing(self, file_md5s):
+    return self._retry(None, _check_existing, file_md5s)
+
+  def post_csv(self, path, content_encoding=None):
+    return self._retry(None, _post_csv, path, content_encoding)
 
-  def post_csv(self, path):
-    return self._retry(None, _post_csv, path)
+  def post_csv_stream(self, stream, filename, content_encoding=None):
+    return self._retry(None, _post_csv_stream, stream, filename,
+                       content_encoding)
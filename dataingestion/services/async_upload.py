@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distributed according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+"""
+This module sends HTTP POST requests over non-blocking sockets multiplexed
+by a poll loop (select on Windows), so that a single thread keeps many
+uploads in flight. Each request opens its own connection, closed by the
+server after the response. Only plain HTTP is supported.
+"""
+import socket, select, errno, os, logging, urlparse
+from time import time
+from dataingestion.services import api_client, metrics
+from dataingestion.services.api_client import ClientException
+
+logger = logging.getLogger('iDigBioSvc.async_upload')
+
+# Bytes of the body written to a socket at a time.
+SEND_BUFFER = 64 * 1024
+RECV_SIZE = 64 * 1024
+
+_IN_PROGRESS = set(code for code in (
+    errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN,
+    getattr(errno, "WSAEWOULDBLOCK", None)) if code is not None)
+
+def supported(url):
+  """
+  Returns: Whether the requests to url can be sent by an EventLoop.
+  """
+  return urlparse.urlsplit(url).scheme == "http"
+
+
+class AsyncRequest(object):
+  """
+  A POST request sent by an EventLoop. body is an iterator of strings, such
+  as a _TimedBody, and timeout an api_client.RequestTimeout.
+  on_done(request, result) is called in the thread of the loop once the
+  request is done. result is the response body if the status is 2xx, or a
+  ClientException, as raised by api_client._post_stream.
+  """
+  CONNECTING = "connecting"
+  SENDING = "sending"
+  RECEIVING = "receiving"
+  DONE = "done"
+
+  def __init__(self, url, headers, body, timeout, on_done, local_path=""):
+    parts = urlparse.urlsplit(url)
+    self.url = url
+    self.host = parts.hostname
+    self.port = parts.port or 80
+    self.local_path = local_path
+    path = parts.path or "/"
+    if parts.query:
+      path += "?" + parts.query
+    lines = ["POST %s HTTP/1.1" % path, "Host: %s" % parts.netloc,
+             "Connection: close"]
+    lines.extend("%s: %s" % item for item in headers.items())
+    self.buffer = "\r\n".join(lines) + "\r\n\r\n"
+    self.offset = 0
+    self.body = iter(body)
+    self.body_done = False
+    self.timeout = timeout
+    self.on_done = on_done
+    self.sock = None
+    self.state = None
+    self.started = None
+    self.sending_since = None
+    self.last_activity = None
+    self.response = []
+
+  def fileno(self):
+    return self.sock.fileno()
+
+  def _fill_buffer(self):
+    """
+    Returns: False once the whole request is written.
+    """
+    if self.offset < len(self.buffer):
+      return True
+    blocks = []
+    size = 0
+    while not self.body_done and size < SEND_BUFFER:
+      try:
+        block = next(self.body)
+      except StopIteration:
+        self.body_done = True
+        break
+      blocks.append(block)
+      size += len(block)
+    self.buffer = "".join(blocks)
+    self.offset = 0
+    return bool(self.buffer)
+
+  def on_writable(self, now):
+    if self.state == self.CONNECTING:
+      error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+      if error:
+        raise socket.error(error, os.strerror(error))
+      api_client.timeouts.record_connect(now - self.started)
+      self.state = self.SENDING
+      self.sending_since = now
+    if not self._fill_buffer():
+      self.state = self.RECEIVING
+      return
+    try:
+      sent = self.sock.send(buffer(self.buffer, self.offset))
+    except socket.error as e:
+      if e.args[0] in _IN_PROGRESS:
+        return
+      raise
+    self.offset += sent
+    self.last_activity = now
+
+  def on_readable(self, now):
+    """
+    Returns: True once the response is complete.
+    """
+    try:
+      data = self.sock.recv(RECV_SIZE)
+    except socket.error as e:
+      if e.args[0] in _IN_PROGRESS:
+        return False
+      raise
+    self.last_activity = now
+    if not data:
+      return True
+    self.response.append(data)
+    return _response_complete(self.response)
+
+  def timed_out(self, now):
+    """
+    Returns: The phase that timed out, or None.
+    """
+    if self.state == self.CONNECTING:
+      if now - self.started > self.timeout.connect:
+        return "connect"
+      return None
+    if now - self.last_activity > self.timeout.read:
+      return "send" if self.state == self.SENDING else "response"
+    if (self.state == self.SENDING and
+        now - self.sending_since > self.timeout.deadline):
+      return "deadline"
+    return None
+
+  def result(self):
+    """
+    Returns: The response body, or the ClientException of an error status.
+    """
+    status, headers, body = _parse_response("".join(self.response))
+    if 200 <= status < 300:
+      return body
+    logger.error("Failed to POST the media to server. url={0}, "
+        "http_status={1}, http_response_content={2}, local_path={3}"
+        .format(self.url, status, body, self.local_path))
+    return ClientException(
+        "Failed to POST the media to server", url=self.url,
+        http_status=status, http_response_content=body,
+        local_path=self.local_path)
+
+  def error(self, err):
+    logger.error("{0} caught while POSTing the media. reason={1}, url={2}."
+        .format(type(err), str(err), self.url))
+    return ClientException(
+        "{0} caught while POSTing the media.".format(type(err)),
+        reason=str(err), url=self.url, local_path=self.local_path)
+
+
+def _split_head(data):
+  head, separator, body = data.partition("\r\n\r\n")
+  if not separator:
+    return None
+  lines = head.split("\r\n")
+  status = int(lines[0].split(None, 2)[1])
+  headers = {}
+  for line in lines[1:]:
+    name, _junk, value = line.partition(":")
+    headers[name.strip().lower()] = value.strip()
+  return status, headers, body
+
+def _response_complete(chunks):
+  """
+  Returns: Whether the response received in chunks is complete before the
+    server closes the connection, by its Content-Length.
+  """
+  parts = _split_head("".join(chunks))
+  if parts is None or "content-length" not in parts[1]:
+    return False
+  return len(parts[2]) >= int(parts[1]["content-length"])
+
+def _parse_response(data):
+  """
+  Returns: (status, headers, body) of the HTTP response data.
+  """
+  parts = _split_head(data)
+  if parts is None:
+    raise socket.error("Incomplete response.")
+  status, headers, body = parts
+  if headers.get("transfer-encoding", "").lower() == "chunked":
+    body = _dechunk(body)
+  elif "content-length" in headers:
+    body = body[:int(headers["content-length"])]
+  return status, headers, body
+
+def _dechunk(data):
+  chunks = []
+  position = 0
+  while True:
+    end = data.index("\r\n", position)
+    size = int(data[position:end].split(";")[0], 16)
+    if not size:
+      return "".join(chunks)
+    chunks.append(data[end + 2:end + 2 + size])
+    position = end + 2 + size + 2
+
+
+class _Poller(object):
+  """
+  select.poll where available, select.select otherwise (Windows).
+  """
+  def __init__(self):
+    self.poll = select.poll() if hasattr(select, "poll") else None
+    self.readers = set()
+    self.writers = set()
+
+  def register(self, fd, writing):
+    if self.poll is not None:
+      self.poll.register(fd, select.POLLOUT if writing else select.POLLIN)
+    self._discard(fd)
+    (self.writers if writing else self.readers).add(fd)
+
+  def _discard(self, fd):
+    self.readers.discard(fd)
+    self.writers.discard(fd)
+
+  def unregister(self, fd):
+    if self.poll is not None and (fd in self.readers or fd in self.writers):
+      self.poll.unregister(fd)
+    self._discard(fd)
+
+  def wait(self, timeout):
+    """
+    Returns: The (fd, readable, writable) of the sockets ready within timeout
+      seconds. A socket in error is both.
+    """
+    if self.poll is not None:
+      events = self.poll.poll(timeout * 1000)
+      return [(fd, bool(event & (select.POLLIN | select.POLLERR |
+                                 select.POLLHUP)),
+               bool(event & (select.POLLOUT | select.POLLERR)))
+              for fd, event in events]
+    if not self.readers and not self.writers:
+      return []
+    readable, writable, failed = select.select(
+        list(self.readers), list(self.writers), list(self.writers), timeout)
+    ready = {}
+    for fd in readable:
+      ready[fd] = (True, False)
+    for fd in writable + failed:
+      ready[fd] = (ready.get(fd, (False,))[0], True)
+    return [(fd, r, w) for fd, (r, w) in ready.items()]
+
+
+class EventLoop(object):
+  """
+  Sends AsyncRequests concurrently. Not thread-safe: start and poll are
+  called by the same thread.
+  """
+  def __init__(self):
+    self.requests = {}
+    self.poller = _Poller()
+    self.addresses = {}
+
+  def __len__(self):
+    return len(self.requests)
+
+  def _address(self, host, port):
+    key = (host, port)
+    if key not in self.addresses:
+      family, socktype, proto, _junk, address = socket.getaddrinfo(
+          host, port, 0, socket.SOCK_STREAM)[0]
+      self.addresses[key] = (family, socktype, proto, address)
+    return self.addresses[key]
+
+  def start(self, request):
+    """
+    Starts sending request. on_done is called with the result once the
+    request is done, possibly before start returns.
+    """
+    request.started = request.last_activity = time()
+    request.state = AsyncRequest.CONNECTING
+    try:
+      family, socktype, proto, address = self._address(request.host,
+                                                       request.port)
+      request.sock = socket.socket(family, socktype, proto)
+      request.sock.setblocking(0)
+      error = request.sock.connect_ex(address)
+      if error and error not in _IN_PROGRESS:
+        raise socket.error(error, os.strerror(error))
+    except socket.error as e:
+      self._finish(request, request.error(e))
+      return
+    self.requests[request.fileno()] = request
+    self.poller.register(request.fileno(), True)
+    metrics.async_requests.inc()
+
+  def poll(self, timeout):
+    """
+    Waits at most timeout seconds for the sockets, and moves the requests on.
+    """
+    for fd, readable, writable in self.poller.wait(timeout):
+      request = self.requests.get(fd)
+      if request is None:
+        continue
+      now = time()
+      result = None
+      try:
+        if writable and request.state != AsyncRequest.RECEIVING:
+          request.on_writable(now)
+          if request.state == AsyncRequest.RECEIVING:
+            self.poller.unregister(fd)
+            self.poller.register(fd, False)
+        elif readable and request.on_readable(now):
+          result = request.result()
+      except socket.timeout as e:
+        # The deadline of the body, see api_client._TimedBody.
+        api_client.count_timeout("deadline")
+        result = request.error(e)
+      except (EnvironmentError, ValueError, IndexError) as e:
+        # Including the IOError of reading the body.
+        result = request.error(e)
+      if result is not None:
+        self._finish(request, result)
+    now = time()
+    for request in self.requests.values():
+      phase = request.timed_out(now)
+      if phase:
+        api_client.count_timeout(phase)
+        self._finish(request, request.error(
+            socket.timeout("timed out ({0})".format(phase))))
+
+  def _finish(self, request, result):
+    if request.sock is not None:
+      fd = request.fileno()
+      if self.requests.pop(fd, None) is not None:
+        self.poller.unregister(fd)
+        metrics.async_requests.dec()
+      request.sock.close()
+    request.state = AsyncRequest.DONE
+    request.on_done(request, result)
+
+  def close(self):
+    """
+    Stops the requests in flight, and calls their on_done with an error.
+    """
+    for request in self.requests.values():
+      self._finish(request, request.error(
+          socket.error("The upload was stopped.")))
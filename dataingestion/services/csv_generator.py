@@ -9,11 +9,12 @@ import re, os, logging, csv, hashlib, threading, time
 from os.path import isdir, join, dirname, split, exists
 from dataingestion.services import user_config, constants
 from dataingestion.services.ingestion_manager import IngestServiceException
+from dataingestion.services.progress_notifier import ProgressNotifier
 from time import sleep
 
 logger = logging.getLogger('iDigBioSvc.csv_generator')
 
-class Status:
+class Status(object):
   def __init__(self):
     self.count = 0
     self.result = 0
@@ -21,6 +22,16 @@ class Status:
     self.dic = None
     self.targetfile = None
 
+  def __setattr__(self, name, value):
+    # Every change wakes up the readers waiting in wait_progress.
+    notifier.cond.acquire()
+    try:
+      object.__setattr__(self, name, value)
+      notifier.changed()
+    finally:
+      notifier.cond.release()
+
+notifier = ProgressNotifier()
 status = Status()
 
 def get_files(imagepath, recursive):
@@ -277,3 +288,11 @@ def run_gencsv(dic):
 
 def check_progress():
   return (status.count, status.result, status.targetfile, status.error)
+
+def wait_progress(since_version):
+  """
+  Blocks until the status changes from since_version, or the wait times out.
+  Returns: (version, progress) where progress is as check_progress.
+  """
+  version = notifier.wait(since_version)
+  return version, check_progress()
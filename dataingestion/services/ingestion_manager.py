@@ -8,20 +8,29 @@
 """
 This module implements the core logic that manages the upload process.
 """
-import os, logging, argparse, tempfile, atexit, cherrypy, csv, json, tempfile
-import hashlib, threading
+import os, logging, argparse, tempfile, atexit, csv, json, tempfile
+import hashlib, threading, gzip
+from cStringIO import StringIO
 from functools import partial
 from datetime import datetime
+from collections import OrderedDict
+from heapq import heappush, heappop
+from itertools import count
 from Queue import Empty, Queue
 from threading import enumerate as threading_enumerate, Thread
-from time import sleep
+from time import sleep, time
+from math import exp
 from sys import exc_info
 from os.path import join
 from traceback import format_exception
 from errno import ENOENT
 from dataingestion.services.api_client import (ClientException, Connection,
                                                ServerException)
-from dataingestion.services import model, user_config, constants
+from dataingestion.services import (api_client, model, user_config, constants,
+                                    metrics, tracing, profiling, async_upload,
+                                    upload_journal)
+from dataingestion.services.progress_notifier import ProgressNotifier
+from sqlalchemy.exc import SQLAlchemyError
 import ast
 
 logger = logging.getLogger('iDigBioSvc.ingestion_manager')
@@ -31,6 +40,21 @@ fatal_server_error = False
 input_csv_error = False 
 
 worker_thread_count = 10 # init
+# Number of queued records whose MD5s are checked against the server in one
+# request before uploading. 0 disables the check.
+md5_precheck_chunk = 0
+# Small images are packed into one request of up to batch_max_files files and
+# batch_max_bytes bytes. batch_max_files of 1 disables the packing.
+batch_max_files = 1
+batch_max_bytes = 8 * 2 ** 20
+# With "async", the single images are uploaded by an event loop thread, up
+# to async_concurrency at a time, see AsyncUploadThread, and the worker
+# threads only upload the other items.
+upload_engine = "threads"
+async_concurrency = 64
+# The trace reports of the last batches, by batch id.
+trace_reports = OrderedDict()
+TRACE_REPORTS_KEPT = 10
 
 class IngestServiceException(Exception):
   def __init__(self, msg, reason=''):
@@ -42,16 +66,67 @@ class InputCSVException(Exception):
     Exception.__init__(self, msg)
     self.reason = reason
 
-def init(wtc):
-  global worker_thread_count
-  worker_thread_count = wtc
-  print "Worker threads: %s" % worker_thread_count
+# The malformed rows listed in the reason of the InputCSVException of
+# _validate_csv. All of them are logged.
+MAX_REPORTED_CSV_ERRORS = 20
 
-def _get_conn():
+csv.register_dialect('mydialect', delimiter=',', quotechar='"',
+                     skipinitialspace=True)
+
+def _validate_csv(path):
+  """
+  Checks all the rows of the CSV file at path before any media file is read,
+  so that a malformed file fails at once rather than after the media of the
+  rows before the first malformed one are hashed.
+  Raises: InputCSVException listing the malformed rows.
+  """
+  errors = []
+  with open(path, 'rb') as csvfile:
+    reader = csv.reader(csvfile, 'mydialect')
+    headerline = next(reader, None)
+    columns = len(headerline or ())
+    for row in reader:
+      if len(row) != columns:
+        errors.append("Line {0}: {1} columns instead of {2}.".format(
+            reader.line_num, len(row), columns))
+      elif any("\"" in col for col in row):
+        errors.append("Line {0}: a field contains a double quotation mark "
+                      "(\").".format(reader.line_num))
+  if not errors:
+    return
+  for error in errors:
+    logger.error("Input CSV File error. {0}".format(error))
+  reason = "\n".join(errors[:MAX_REPORTED_CSV_ERRORS])
+  if len(errors) > MAX_REPORTED_CSV_ERRORS:
+    reason += "\n... {0} more.".format(len(errors) - MAX_REPORTED_CSV_ERRORS)
+  raise InputCSVException(
+      "Input CSV File weird. {0} rows have a different number of columns or "
+      "a field with a double quotation mark.".format(len(errors)), reason)
+
+def init(wtc, precheck_chunk=None, batch_files=None, batch_mb=None,
+         engine=None, concurrency=None):
+  global worker_thread_count, md5_precheck_chunk
+  global batch_max_files, batch_max_bytes, upload_engine, async_concurrency
+  worker_thread_count = wtc
+  if engine:
+    if engine not in ("threads", "async"):
+      raise ValueError("Unknown upload engine: {0}".format(engine))
+    upload_engine = engine
+  if concurrency:
+    async_concurrency = max(1, int(concurrency))
+  if precheck_chunk:
+    md5_precheck_chunk = int(precheck_chunk)
+  if batch_files:
+    batch_max_files = max(1, int(batch_files))
+  if batch_mb:
+    batch_max_bytes = int(float(batch_mb) * 2 ** 20)
+  logger.info("Worker threads: %s" % worker_thread_count)
+
+def _get_conn(defer_retries=False):
   """
   Get connection.
   """
-  return Connection()
+  return Connection(defer_retries=defer_retries)
 
 def _put_errors_from_threads(threads):
   """
@@ -88,8 +163,16 @@ class QueueFunctionThread(Thread):
     self.args = args
     self.kwargs = kwargs
     self.exc_infos = []
+    # Set if the upload tasks are profiled.
+    self.profile = profiling.new_profile()
 
   def run(self):
+    try:
+      profiling.call(self.profile, self._run)
+    finally:
+      model.remove_session()
+
+  def _run(self):
     global fatal_server_error
     while True:
       try:
@@ -112,8 +195,275 @@ class QueueFunctionThread(Thread):
   def abort_thread(self):
     self.abort = True
 
+class DeferredQueue(Queue):
+  """
+  A FIFO queue whose items can also be put with a delay: an item put with
+  put_later(item, delay) can only be got once delay seconds have passed.
+  The deferred items are moved into the queue when it is read, so the readers
+  must poll (get_nowait) instead of blocking.
+  """
+  def _init(self, maxsize):
+    Queue._init(self, maxsize)
+    self.deferred = []
+    self.sequence = count()
+
+  def _qsize(self, len=len):
+    now = time()
+    while self.deferred and self.deferred[0][0] <= now:
+      self.queue.append(heappop(self.deferred)[2])
+    return len(self.queue)
+
+  def put_later(self, item, delay):
+    self.mutex.acquire()
+    try:
+      heappush(self.deferred, (time() + delay, next(self.sequence), item))
+      self.unfinished_tasks += 1
+    finally:
+      self.mutex.release()
+
+  def deferred_count(self):
+    self.mutex.acquire()
+    try:
+      return len(self.deferred)
+    finally:
+      self.mutex.release()
+
+class AsyncUploadThread(Thread):
+  """
+  Uploads the single images of queue from an async_upload.EventLoop, up to
+  async_concurrency at a time, with the retries of conn. The other items
+  (image groups, chunked uploads and records with errors), and all the items
+  if the loop does not support the endpoint, are put into worker_queue for
+  the upload worker threads. Has the attributes of QueueFunctionThread used by
+  _upload_images.
+  """
+  POLL_INTERVAL = 0.05
+
+  def __init__(self, queue, worker_queue, batch_id, conn):
+    Thread.__init__(self)
+    self.abort = False
+    self.queue = queue
+    self.worker_queue = worker_queue
+    self.batch_id = batch_id
+    self.conn = conn
+    self.exc_infos = []
+    self.profile = profiling.new_profile()
+    self.supported = async_upload.supported(api_client.api_endpoint)
+
+  def run(self):
+    profiling.call(self.profile, self._run)
+
+  def _run(self):
+    global fatal_server_error
+    if not self.supported:
+      logger.warning("The event loop does not support {0}. Uploading with the "
+                     "worker threads.".format(api_client.api_endpoint))
+    loop = async_upload.EventLoop()
+    try:
+      while not self.abort:
+        while len(loop) < async_concurrency:
+          try:
+            item = self.queue.get_nowait()
+          except Empty:
+            break
+          try:
+            self._start(loop, item)
+          except ServerException:
+            logger.error("Fatal Server Error Detected")
+            fatal_server_error = True
+          except Exception as ex:
+            logger.error("Exception caught in the upload loop: {0}".format(ex))
+            self.exc_infos.append(exc_info())
+            if not isinstance(item, list):
+              self._fail(item, item.size)
+          self.queue.task_done()
+        if len(loop):
+          try:
+            loop.poll(self.POLL_INTERVAL)
+          except Exception as ex:
+            logger.error("Exception caught in the upload loop: {0}".format(ex))
+            self.exc_infos.append(exc_info())
+        else:
+          sleep(0.01)
+    finally:
+      # The requests in flight fail, so that the task counts them.
+      self.abort = True
+      loop.close()
+
+  def _start(self, loop, item):
+    if isinstance(item, list) or not self.supported:
+      self.worker_queue.put(item)
+      return
+    blocking = item.error or api_client.use_chunked_upload(item.size)
+    filename = item.path
+    reference = item.guid
+    size = item.size
+    attempts = item.upload_attempts
+    if blocking:
+      self.worker_queue.put(item)
+      return
+
+    delay = self.conn.breaker_delay()
+    if delay is not None:
+      _defer([item], delay, attempts)
+      return
+    logger.info("Image job started: OriginalFileName: {0}".format(filename))
+    try:
+      stream = open(filename, "rb")
+    except IOError as err:
+      logger.error("IOError: An image job failed.")
+      metrics.failures.inc(cause="io")
+      if err.errno != ENOENT:
+        raise
+      ongoing_upload_task.error_queue.put(
+          'Local file %s not found' % repr(filename))
+      ongoing_upload_task.add_bytes('done_bytes', size)
+      fn = partial(ongoing_upload_task.increment, 'fails')
+      ongoing_upload_task.postprocess_queue.put(fn)
+      return
+    url, body, headers, cb = api_client.encode_image(
+        stream, reference, partial(ongoing_upload_task.add_bytes,
+                                   'sending_bytes'))
+    loop.start(async_upload.AsyncRequest(
+        url, headers, body, body.timeout,
+        partial(self._done, item, stream, body, cb, attempts, size),
+        filename))
+
+  def _done(self, job, stream, body, cb, attempts, size, request, result):
+    """
+    Handles the result of the upload of the ImageJob job as
+    _upload_single_image. The database work is left to the postprocess
+    thread. The job fails without a retry once the thread is aborted.
+    """
+    success = not isinstance(result, ClientException)
+    seconds = time() - request.started
+    trace = None
+    try:
+      tracing.begin(sampled=job.trace is not None)
+      try:
+        body.finish(success)
+      finally:
+        trace = tracing.end()
+        # After finish, which stops the reads of the body.
+        stream.close()
+      if cb:
+        cb.rollback()
+      if success:
+        api_client.breaker.record_success()
+        ongoing_upload_task.postprocess_queue.put(partial(
+            _complete_upload, job, result, self.batch_id, size, trace,
+            seconds))
+        return
+
+      self.conn.attempts = attempts + 1
+      if self.abort:
+        raise result
+      delay = self.conn.attempt_failed(result)
+    except ClientException as ex:
+      logger.error("ClientException: An image job failed. Reason: %s" %ex)
+      self._fail(job, size, trace, seconds)
+    except Exception as ex:
+      # Counted, or the task would wait for the job forever.
+      logger.error("Exception caught in the upload loop: {0}".format(ex))
+      self.exc_infos.append(exc_info())
+      self._fail(job, size, trace, seconds)
+    else:
+      _report_traces([job], trace,
+                     _defer([job], delay, self.conn.attempts), seconds)
+
+  def _fail(self, job, size, trace=None, seconds=0.0):
+    ongoing_upload_task.add_bytes('done_bytes', size)
+    fn = partial(ongoing_upload_task.increment, 'fails')
+    ongoing_upload_task.postprocess_queue.put(fn)
+    _report_traces([job], trace, (), seconds)
+
+def _complete_upload(job, img_str, batch_id, size, trace, seconds):
+  """
+  Records the server response img_str of the ImageJob job uploaded by an
+  AsyncUploadThread. Called by the postprocess thread.
+  """
+  try:
+    _save_upload_result(job, img_str, batch_id)
+  except ClientException as ex:
+    logger.error("ClientException: An image job failed. Reason: %s" %ex)
+    ongoing_upload_task.increment('fails')
+  else:
+    ongoing_upload_task.increment('successes')
+  finally:
+    ongoing_upload_task.add_bytes('done_bytes', size)
+    _report_traces([job], trace, (), seconds)
+
+class ThroughputMeter(object):
+  """
+  Smoothed rate of a growing count: an exponentially weighted moving average
+  of the rates between samples, with a time constant of TAU seconds.
+  """
+  TAU = 10.0
+  MIN_SAMPLE_INTERVAL = 1.0
+
+  def __init__(self):
+    self.rate = None
+    self.last_time = None
+    self.last_count = 0
+
+  def sample(self, count, now=None):
+    """
+    Returns: The smoothed rate per second, or None until two samples at least
+      MIN_SAMPLE_INTERVAL apart are taken.
+    """
+    if now is None:
+      now = time()
+    if self.last_time is None:
+      self.last_time, self.last_count = now, count
+      return self.rate
+    interval = now - self.last_time
+    if interval < self.MIN_SAMPLE_INTERVAL:
+      return self.rate
+    current_rate = max(0, count - self.last_count) / interval
+    if self.rate is None:
+      self.rate = current_rate
+    else:
+      self.rate += (1 - exp(-interval / self.TAU)) * (current_rate - self.rate)
+    self.last_time, self.last_count = now, count
+    return self.rate
+
+def _record_size(image_record):
+  """
+  Returns: The number of bytes to upload for image_record.
+  """
+  size = image_record.MediaSizeInBytes
+  if image_record.Error or size in (None, ""):
+    return 0
+  return int(size)
+
+class ImageJob(object):
+  """
+  The upload of an image record. The queues carry jobs rather than the
+  ImageRecord instances, so that the records of a batch need not stay in
+  the session and the workers read them without commit_lock. The result is
+  written back to the record by record_id.
+  """
+  __slots__ = ("record_id", "path", "guid", "md5", "size", "error",
+               "upload_attempts", "trace", "seconds")
+
+  def __init__(self, image_record, trace=None, seconds=0.0):
+    self.record_id = image_record.id
+    self.path = image_record.OriginalFileName
+    self.guid = image_record.MediaGUID
+    self.md5 = image_record.MediaMD5
+    # Bytes to upload, 0 if unknown.
+    self.size = _record_size(image_record)
+    self.error = image_record.Error
+    # Changed by the thread that has the job: see _defer and _report_traces.
+    self.upload_attempts = 0
+    self.trace = trace
+    # The time spent on the job, ranked in the trace report.
+    self.seconds = seconds
+
 batch_attr_lock = threading.Lock()
 batch_check_lock = threading.Lock()
+# Notified, under batch_attr_lock, on every change of the upload progress.
+progress_notifier = ProgressNotifier(batch_attr_lock)
 class BatchUploadTask:
   """
   State about a single batch upload task.
@@ -122,10 +472,13 @@ class BatchUploadTask:
   """
   STATUS_FINISHED = "finished"
   STATUS_RUNNING = "running"
+  # The result label of metrics.files for the counters.
+  FILE_RESULTS = {"successes": "success", "fails": "fail", "skips": "skip"}
 
   def __init__(self, batch=None, max_continuous_fails=1000):
     self.batch = batch
-    self.object_queue = Queue() # Thread safe object in python.
+    # Failed uploads are put back with a delay, see _defer.
+    self.object_queue = DeferredQueue() # Thread safe object in python.
     self.postprocess_queue = Queue() # Thread safe object in python.
     self.error_queue = Queue() # Thread safe object in python.
 
@@ -138,6 +491,43 @@ class BatchUploadTask:
     self._continuous_fails = 0
     self._max_continuous_fails = max_continuous_fails
     self._csv_uploaded = False
+    # Bytes of the media to upload, of the media done (uploaded or failed), and
+    # sent for the media in flight.
+    self._total_bytes = 0
+    self._done_bytes = 0
+    self._sending_bytes = 0
+    self._throughput = ThroughputMeter()
+    self.trace_report = tracing.TraceReport()
+
+    # The small image records waiting to be put into object_queue as a group.
+    self.image_group = []
+    self.image_group_bytes = 0
+
+  def enqueue(self, job):
+    """
+    Puts the ImageJob job into object_queue, packing small images into
+    groups. Not thread-safe: only called by the thread that reads the CSV
+    file.
+    """
+    size = job.size
+    if (batch_max_files <= 1 or job.error or not size
+        or api_client.use_chunked_upload(size) or size >= batch_max_bytes):
+      self.object_queue.put(job)
+      return
+    if self.image_group_bytes + size > batch_max_bytes:
+      self.flush_image_group()
+    self.image_group.append(job)
+    self.image_group_bytes += size
+    if len(self.image_group) >= batch_max_files:
+      self.flush_image_group()
+
+  def flush_image_group(self):
+    if len(self.image_group) == 1:
+      self.object_queue.put(self.image_group[0])
+    elif self.image_group:
+      self.object_queue.put(self.image_group)
+    self.image_group = []
+    self.image_group_bytes = 0
 
   def not_started(self):
     batch_attr_lock.acquire()
@@ -166,6 +556,7 @@ class BatchUploadTask:
   def set_csv_uploaded(self):
     batch_attr_lock.acquire()
     self._csv_uploaded = True
+    progress_notifier.changed()
     batch_attr_lock.release()
 
   def csv_uploaded(self):
@@ -207,6 +598,7 @@ class BatchUploadTask:
   def set_status(self, status):
     batch_attr_lock.acquire()
     self._status = status
+    progress_notifier.changed()
     batch_attr_lock.release()
 
   # Increment a field's value by 1.
@@ -216,6 +608,9 @@ class BatchUploadTask:
     try:
       if hasattr(self, field_name) and type(getattr(self, field_name)) == int:
         setattr(self, field_name, getattr(self, field_name) + 1)
+        progress_notifier.changed()
+        if field_name_orig in self.FILE_RESULTS:
+          metrics.files.inc(result=self.FILE_RESULTS[field_name_orig])
       else:
         logger.error("BatchUploadTask object doesn't have this field or " +
             "has a field that cannot be incremented: {0}".format(field_name))
@@ -224,6 +619,41 @@ class BatchUploadTask:
     finally:
       batch_attr_lock.release()
 
+  def add_bytes(self, field_name_orig, count):
+    """
+    Adds count to one of the byte counters: total_bytes, done_bytes or
+    sending_bytes.
+    """
+    if not count:
+      return
+    batch_attr_lock.acquire()
+    try:
+      field_name = "_" + field_name_orig
+      setattr(self, field_name, getattr(self, field_name) + count)
+      progress_notifier.changed()
+    finally:
+      batch_attr_lock.release()
+
+  def get_byte_progress(self):
+    """
+    Returns: (bytes done, total bytes, smoothed rate in bytes per second or
+      None, estimated seconds remaining or None).
+    """
+    batch_attr_lock.acquire()
+    try:
+      done = self._done_bytes + self._sending_bytes
+      total = self._total_bytes
+      rate = self._throughput.sample(done)
+      if self._status == self.STATUS_FINISHED:
+        eta = 0
+      elif rate:
+        eta = max(0, total - done) / rate
+      else:
+        eta = None
+      return done, total, rate, eta
+    finally:
+      batch_attr_lock.release()
+
   # Update the continuous failure times.
   def check_continuous_fails(self, succ_this_time):
     """
@@ -244,9 +674,23 @@ class BatchUploadTask:
     finally:
       batch_check_lock.release()
 
+def _queue_size(queue_name):
+  task = ongoing_upload_task
+  return getattr(task, queue_name).qsize() if task else 0
+
+def _deferred_count():
+  task = ongoing_upload_task
+  return task.object_queue.deferred_count() if task else 0
+
+for _queue in ("object", "postprocess", "error"):
+  metrics.queue_depth.set_function(partial(_queue_size, _queue + "_queue"),
+                                   queue=_queue)
+metrics.queue_depth.set_function(_deferred_count, queue="deferred")
+
 def get_progress():
   """
   Return (total items, skips, successes, fails).
+  The counters are a snapshot; total is 0 until the CSV file is read.
   """
   task = ongoing_upload_task
   global fatal_server_error
@@ -256,21 +700,44 @@ def get_progress():
     logger.error("No ongoing upload task.")
     raise IngestServiceException("No ongoing upload task.")
 
-  while(task.not_started()):
-    sleep(0.2)
-
   total, skips, successes, fails, csv, status = task.get_all_information()
   return (fatal_server_error, input_csv_error, total, skips, successes, fails,
           csv,
           True if status == BatchUploadTask.STATUS_FINISHED else False)
 
+def get_byte_progress():
+  """
+  Return (bytes done, total bytes, rate in bytes per second, ETA in seconds)
+  of the ongoing task. The rate and ETA are None until they can be estimated.
+  """
+  task = ongoing_upload_task
+  if task is None:
+    logger.error("No ongoing upload task.")
+    raise IngestServiceException("No ongoing upload task.")
+  return task.get_byte_progress()
+
+def wait_progress(since_version):
+  """
+  Blocks until the progress changes from since_version, or the wait times
+  out. Changes are coalesced to at most one answer per
+  progress_notifier.MIN_INTERVAL.
+  Returns: (version, progress) where progress is as get_progress, or None if
+    there is still no upload task.
+  """
+  version = progress_notifier.wait(since_version)
+  if ongoing_upload_task is None:
+    return version, None
+  return version, get_progress()
+
 def get_result():
   """
   Return the details of the ongoing task.
   """
   # The result is given only when all the tasks are finished.
-  while ongoing_upload_task.get_status() != BatchUploadTask.STATUS_FINISHED:
-    sleep(0.2)
+  if (ongoing_upload_task is None or
+      ongoing_upload_task.get_status() != BatchUploadTask.STATUS_FINISHED):
+    logger.error("The upload task is not finished.")
+    raise IngestServiceException("The upload task is not finished.")
   if ongoing_upload_task.batch:
     return model.get_batch_details_brief(ongoing_upload_task.batch.id)
   else:
@@ -315,6 +782,7 @@ def upload_task(values):
       func and func(*args)
 
     postprocess_thread = QueueFunctionThread(postprocess_queue, _postprocess)
+    postprocess_thread.name = "postprocess"
     postprocess_thread.start()
 
     def _error(item):
@@ -323,11 +791,14 @@ def upload_task(values):
     # error_thread is a new thread logging the errors.
     error_queue = ongoing_upload_task.error_queue
     error_thread = QueueFunctionThread(error_queue, _error)
+    error_thread.name = "error"
     error_thread.start()
 
     # Multi-threaded from here.
+    main_profile = profiling.new_profile()
     try:
-      _upload_images(ongoing_upload_task, values)
+      profiling.call(main_profile, _upload_images, ongoing_upload_task,
+                     values)
     except (ClientException, IOError):
       error_queue.put(str(IOError))
     while not postprocess_queue.empty():
@@ -335,6 +806,11 @@ def upload_task(values):
     postprocess_thread.abort = True
     while postprocess_thread.isAlive():
       postprocess_thread.join(0.01)
+    if not any(thread.isAlive() for thread in
+               getattr(ongoing_upload_task, "object_threads", [])):
+      # The results of the uploads are all committed.
+      model.commit()
+      upload_journal.reset()
     try:
       _upload_csv(_get_conn())
       if (ongoing_upload_task.get_fails() == 0
@@ -350,9 +826,15 @@ def upload_task(values):
       error_thread.join(0.01)
 
     logger.info("Upload task execution completed.")
+    _dump_profiles(ongoing_upload_task, [
+        ("upload", main_profile), (postprocess_thread.name,
+                                   postprocess_thread.profile),
+        (error_thread.name, error_thread.profile)])
   except InputCSVException as e: 
     logger.debug("Input CSV File error ")  
     input_csv_error = True
+    postprocess_thread.abort = True
+    error_thread.abort = True
 
   except (SystemExit, Exception) as ex:
     logger.error("Error happens in _upload: %s" %ex)
@@ -361,9 +843,26 @@ def upload_task(values):
       thread.abort = True
     raise
   finally:
+    model.remove_session()
     # Reset of singleton task in the module.
     ongoing_upload_task.set_status(BatchUploadTask.STATUS_FINISHED)
 
+def _dump_profiles(task, profiles):
+  """
+  Writes the profiles of the upload task threads, and of the workers, under
+  a directory named after the batch.
+  """
+  if not profiling.profile_dir:
+    return
+  profiles = profiles + [(thread.name, thread.profile)
+                         for thread in getattr(task, "object_threads", [])]
+  name = "batch-{0}-{1}".format(task.batch.id if task.batch else "none",
+                                datetime.now().strftime("%Y%m%d-%H%M%S"))
+  try:
+    profiling.dump(name, profiles)
+  except (IOError, OSError) as ex:
+    logger.error("Cannot write the profiles: {0}".format(ex))
+
 def _upload_images(ongoing_upload_task, values):
   object_queue = ongoing_upload_task.object_queue
   postprocess_queue = ongoing_upload_task.postprocess_queue
@@ -382,6 +881,7 @@ def _upload_images(ongoing_upload_task, values):
         raise IngestServiceException("Last batch already finished, why resume?")
       # Assign local variables with values in DB.
       CSVfilePath = oldbatch.CSVfilePath
+      _validate_csv(CSVfilePath)
       batch = model.add_batch(
           oldbatch.CSVfilePath, oldbatch.iDigbioProvidedByGUID,
           oldbatch.RightsLicense, oldbatch.RightsLicenseStatementUrl,
@@ -396,6 +896,7 @@ def _upload_images(ongoing_upload_task, values):
       license_set = constants.IMAGE_LICENSES[RightsLicense]
       RightsLicenseStatementUrl = license_set[2]
       RightsLicenseLogoUrl = license_set[3]
+      _validate_csv(CSVfilePath)
 
       # Insert into the database.
       logger.debug("Insert batch into the database")
@@ -406,10 +907,22 @@ def _upload_images(ongoing_upload_task, values):
     model.commit()
     ongoing_upload_task.batch = batch
     batch_id = str(batch.id)
-
-    # the object_queue and _upload_single_image are passed to the thread.
-    object_threads = [QueueFunctionThread(object_queue, _upload_single_image,
-        batch_id, _get_conn()) for _junk in xrange(int(worker_thread_count))]
+    _keep_trace_report(batch.id, ongoing_upload_task.trace_report)
+
+    # the object_queue and _upload_queue_item are passed to the thread.
+    worker_queue = object_queue
+    if upload_engine == "async":
+      worker_queue = Queue()
+    object_threads = [QueueFunctionThread(worker_queue, _upload_queue_item,
+        batch_id, _get_conn(defer_retries=True))
+        for _junk in xrange(int(worker_thread_count))]
+    for index, thread in enumerate(object_threads):
+      thread.name = "upload-worker-{0}".format(index)
+    if upload_engine == "async":
+      thread = AsyncUploadThread(object_queue, worker_queue, batch_id,
+                                 _get_conn(defer_retries=True))
+      thread.name = "upload-loop"
+      object_threads.append(thread)
     ongoing_upload_task.object_threads = object_threads
 
     # Put all the records to the data base and the job queue.
@@ -417,46 +930,54 @@ def _upload_images(ongoing_upload_task, values):
     # In current version, the row is simply [path, providerid].
     logger.debug('Put all image records into db...')
     with open(CSVfilePath, 'rb') as csvfile:
-      csv.register_dialect('mydialect', delimiter=',', quotechar='"',
-                           skipinitialspace=True)
       reader = csv.reader(csvfile, 'mydialect')
-      headerline = None
+      row_mapper = None
       recordCount = 0
+      precheck_records = []
+      # The rows are checked by _validate_csv.
       for row in reader: # For each line do the work.
-        if not headerline:
-          batch.ErrorCode = "CSV File Format Error."
-          headerline = row
-          batch.ErrorCode = ""
+        if row_mapper is None:
+          row_mapper = model.RowMapper(row)
           continue
 
-        # Validity test for each line in CSV file  
-        if len(row) != len(headerline):
-          logger.debug("Input CSV File weird. At least one row has different"
-              + " number of columns")
-          raise InputCSVException("Input CSV File weird. At least one row has"
-              + " different number of columns")
-
-        for col in row: 
-          if "\"" in col:
-            logger.debug("One of CSV field contains \"(Double Quatation)")
-            raise InputCSVException(
-                "One of CSV field contains Double Quatation Mark(\")") 
-
         # Get the image record
-        image_record = model.add_image(batch, row, headerline)
+        start = time()
+        tracing.begin()
+        image_record = model.add_image(batch, row, row_mapper)
+        trace = tracing.end()
+        seconds = time() - start
 
-        fn = partial(ongoing_upload_task.increment, 'total_count')
-        ongoing_upload_task.postprocess_queue.put(fn)
+        # Counted here rather than by the postprocess thread: is_finished
+        # would hold while the total is behind the results.
+        ongoing_upload_task.increment('total_count')
 
         if image_record is None:
           # Skip this one because it's already uploaded.
           # Increment skips count and return.
           fn = partial(ongoing_upload_task.increment, 'skips')
           ongoing_upload_task.postprocess_queue.put(fn)
+          recordCount = recordCount + 1
+          continue
+
+        # The trace is completed by the upload of the record.
+        if trace:
+          trace.name = image_record.OriginalFileName
+        job = ImageJob(image_record, trace, seconds)
+        ongoing_upload_task.add_bytes('total_bytes', job.size)
+        if md5_precheck_chunk and not job.error:
+          precheck_records.append(job)
+          if len(precheck_records) >= md5_precheck_chunk:
+            _precheck_and_enqueue(
+                ongoing_upload_task, conn, precheck_records, batch_id)
+            precheck_records = []
         else:
-          object_queue.put(image_record)
+          ongoing_upload_task.enqueue(job)
 
         recordCount = recordCount + 1
+      if precheck_records:
+        _precheck_and_enqueue(
+            ongoing_upload_task, conn, precheck_records, batch_id)
+      ongoing_upload_task.flush_image_group()
       batch.RecordCount = recordCount
       model.commit()
     logger.debug('Put all image records into db done.')
@@ -470,8 +991,8 @@ def _upload_images(ongoing_upload_task, values):
     #while not object_queue.empty():
     #  sleep(0.01)
     while (not ongoing_upload_task.is_finished()):
-      if fatal_server_error: 
-        raise ServerException  
+      if fatal_server_error:
+        raise ServerException("Fatal server error.")
       sleep(1)
     
     for thread in object_threads:
@@ -498,62 +1019,287 @@ def _upload_images(ongoing_upload_task, values):
 
 commit_lock = threading.Lock()
 
-def _upload_single_image(image_record, batch_id, conn):
-  '''
-  This function is passed to the threads.
-  Note: session in model is singleton. It is not thread-safe.
-  commit_lock makes sure any access to image_record to be exclusive.
-  '''
-  global ongoing_upload_task
-
-  filename = ""
-  mediaGUID = ""
-
-  commit_lock.acquire()
+def _precheck_and_enqueue(ongoing_upload_task, conn, jobs, batch_id):
+  """
+  Asks the server which of the records of the ImageJobs jobs it already
+  stores by MD5. Those are recorded as uploaded with the server's existing
+  file_url; the others are put into the object queue. If the check fails,
+  all the records are uploaded.
+  """
+  try:
+    existing = conn.check_existing(set(job.md5 for job in jobs))
+  except ClientException as ex:
+    logger.error("MD5 pre-check failed, uploading all records. Reason: %s" %ex)
+    existing = {}
+
+  stored = []
+  for job in jobs:
+    result_obj = existing.get(job.md5)
+    if not result_obj or result_obj.get("file_md5") != job.md5:
+      ongoing_upload_task.enqueue(job)
+      continue
+    logger.debug("Already stored on the server: {0}".format(job.path))
+    _report_job(job)
+    content = json.dumps(result_obj)
+    upload_journal.record(job.record_id, batch_id, result_obj["file_url"],
+                          job.md5, content)
+    stored.append((job, content, result_obj["file_url"]))
+  if not stored:
+    return
+
+  tracing.acquire(commit_lock)
   try:
-    if not image_record:
-      logger.error("image_record is None.")
-      raise ClientException("image_record is None.")
-
-    logger.info("Image job started: OriginalFileName: {0}"
-        .format(image_record.OriginalFileName))
-
-    if image_record.Error:
-      logger.error("image record has error: {0}".format(image_record.Error))
-      raise ClientException(image_record.Error)
-    filename = image_record.OriginalFileName
-    mediaGUID = image_record.MediaGUID
+    for job, content, url in stored:
+      model.set_upload_result(job.record_id, batch_id, content, url)
+    # Ends the write transaction before the workers write.
+    model.commit()
+  except SQLAlchemyError:
+    model.rollback()
+    raise
   finally:
     commit_lock.release()
+  for job, content, url in stored:
+    ongoing_upload_task.add_bytes('done_bytes', job.size)
+    fn = partial(ongoing_upload_task.increment, 'successes')
+    ongoing_upload_task.postprocess_queue.put(fn)
 
+def _save_upload_result(job, img_str, batch_id):
+  """
+  Records the server response img_str of the upload of the ImageJob job.
+  Raises ClientException if the returned eTag does not match the local MD5.
+  """
   try:
-    # Post image to API.
-    # ma_str is the return from server
-    img_str = conn.post_image(filename, mediaGUID)
-    #    image_record.OriginalFileName, image_record.MediaGUID)
     result_obj = json.loads(img_str)
     url = result_obj["file_url"]
-
     # img_etag is not stored in the db.
     img_etag = result_obj["file_md5"]
+  except (ValueError, TypeError, KeyError):
+    # Otherwise the job would neither succeed nor fail, and the task would
+    # never finish.
+    metrics.failures.inc(cause="bad_response")
+    raise ClientException("The server response is not a valid upload result.",
+                          http_response_content=img_str)
+
+  # Check the image integrity.
+  verified = img_etag and job.md5 == img_etag
+  if verified:
+    # Replayed at the next start if the process dies before the commit.
+    upload_journal.record(job.record_id, batch_id, url, img_etag, img_str)
+  tracing.acquire(commit_lock)
+  try:
+    # The batch ID is changed to this one. This field is overwriten.
+    model.set_upload_result(job.record_id, batch_id, img_str,
+                            url if verified else None)
+    # Each write ends its transaction: an open one would keep the database
+    # locked for the sessions of the other threads.
+    model.commit()
+  except SQLAlchemyError as e:
+    model.rollback()
+    metrics.failures.inc(cause="database")
+    logger.error("Failed to record the upload result: {0}".format(e))
+    raise ClientException("Failed to record the upload result.",
+                          reason=str(e), local_path=job.path)
+  finally:
+    commit_lock.release()
+  if not verified:
+    metrics.failures.inc(cause="md5_mismatch")
+    logger.error("Upload failed because local MD5 does not match the eTag"
+        + " or no eTag is returned.")
+    raise ClientException("Upload failed because local MD5 does not match"
+        + " the eTag or no eTag is returned.")
+
+def _upload_queue_item(item, batch_id, conn):
+  """
+  This function is passed to the threads. An item of the object queue is
+  either an ImageJob or a list of small image jobs sent in one request.
+  """
+  jobs = item if isinstance(item, list) else [item]
+  start = time()
+  tracing.begin(sampled=any(job.trace for job in jobs))
+  metrics.active_workers.inc()
+  deferred = None
+  try:
+    if isinstance(item, list):
+      deferred = _upload_image_group(item, batch_id, conn)
+    else:
+      deferred = _upload_single_image(item, batch_id, conn)
+  finally:
+    metrics.active_workers.dec()
+    _report_traces(jobs, tracing.end(), deferred or (), time() - start)
+
+def _report_traces(jobs, upload_trace, deferred=(), seconds=0.0):
+  """
+  Completes the ImageJobs jobs, whose records were read from the CSV file,
+  with their share of the upload that took seconds and of its upload_trace,
+  and adds them to the report of the ongoing task. The deferred jobs are
+  completed by their next upload.
+  """
+  share = 1.0 / len(jobs)
+  for job in jobs:
+    job.seconds += seconds * share
+    if job.trace is not None and upload_trace is not None:
+      job.trace.merge(upload_trace, share)
+    if job not in deferred:
+      _report_job(job)
+
+def _report_job(job):
+  """
+  Adds the ImageJob job, done, to the trace report of the ongoing task.
+  """
+  ongoing_upload_task.trace_report.add(job.trace, job.path, job.seconds)
+  job.trace = None
+
+def _defer(jobs, delay, attempts):
+  """
+  Puts the ImageJobs jobs, whose upload failed after attempts attempts, back
+  into the object queue to be uploaded again after delay seconds. Meanwhile,
+  the worker goes on with the other jobs.
+  Returns: jobs.
+  """
+  for job in jobs:
+    job.upload_attempts = attempts
+  logger.info("Retrying {0} files in {1:.1f} seconds, attempt {2}.".format(
+      len(jobs), delay, attempts + 1))
+  item = jobs if len(jobs) > 1 else jobs[0]
+  ongoing_upload_task.object_queue.put_later(item, delay)
+  return jobs
+
+def _upload_attempts(jobs):
+  return max(job.upload_attempts for job in jobs)
+
+def _keep_trace_report(batch_id, report):
+  report.batch_id = batch_id
+  trace_reports[batch_id] = report
+  while len(trace_reports) > TRACE_REPORTS_KEPT:
+    trace_reports.popitem(last=False)
+
+def get_trace_report(batch_id=None, top_n=None):
+  """
+  Returns: The trace report of the batch with batch_id, by default of the
+    last batch, as tracing.TraceReport.report.
+  """
+  if not trace_reports:
+    raise IngestServiceException("No batch is traced.")
+  if batch_id in (None, ""):
+    report = trace_reports[next(reversed(trace_reports))]
+  else:
+    report = trace_reports.get(int(batch_id))
+    if report is None:
+      raise IngestServiceException(
+          "No trace report for batch {0}.".format(batch_id))
+  return report.report(top_n and int(top_n))
+
+def _upload_image_group(jobs, batch_id, conn):
+  """
+  Uploads the ImageJobs jobs in one multipart request. Only the members the
+  server fails to store are retried, and each member is counted on its own.
+  Returns: The jobs deferred to be retried later.
+  """
+  items = [(job.path, job.guid) for job in jobs]
+  sizes = [job.size for job in jobs]
+  attempts = _upload_attempts(jobs)
+  logger.info("Image group job started: {0} files.".format(len(items)))
 
-    commit_lock.acquire()
+  try:
+    results = conn.post_image_batch(
+        items, partial(ongoing_upload_task.add_bytes, 'sending_bytes'),
+        attempts)
+  except api_client.RetryLater as ex:
+    return _defer(jobs, ex.delay, ex.attempts)
+  except IOError:
+    # A member went missing after it was hashed. Send the members one by one
+    # so that only that one fails.
+    logger.error("IOError in an image group, uploading its files one by one.")
+    deferred = []
+    error = None
+    for job in jobs:
+      # Each member is counted by _upload_single_image, whatever it raises.
+      try:
+        deferred.extend(_upload_single_image(job, batch_id, conn))
+      except ClientException:
+        pass
+      except Exception:
+        logger.error("Exception caught in an image group member: {0}"
+                     .format(job.path))
+        error = error or exc_info()
+    if error:
+      raise error[0], error[1], error[2]
+    return deferred
+  except ClientException as ex:
+    logger.error("ClientException: An image group job failed. Reason: %s" %ex)
+    ongoing_upload_task.add_bytes('done_bytes', sum(sizes))
+    fn = partial(ongoing_upload_task.increment, 'fails')
+    for _junk in jobs:
+      ongoing_upload_task.postprocess_queue.put(fn)
+    raise
+
+  error = None
+  retried = []
+  for job, size, result in zip(jobs, sizes, results):
+    if (isinstance(result, ClientException) and conn.attempts <= conn.retries
+        and api_client.is_retryable(result, conn.attempts)):
+      retried.append(job)
+      continue
     try:
-      # First, change the batch ID to this one. This field is overwriten.
-      image_record.BatchID = batch_id
-      image_record.MediaAPContent = img_str
-      # Check the image integrity.
-      if img_etag and image_record.MediaMD5 == img_etag:
-        image_record.UploadTime = str(datetime.utcnow())
-        image_record.MediaURL = url
-      else:
-        logger.error("Upload failed because local MD5 does not match the eTag"
-            + " or no eTag is returned.")
-        raise ClientException("Upload failed because local MD5 does not match"
-            + " the eTag or no eTag is returned.")
-      model.commit()
-    finally:
-      commit_lock.release()
+      if isinstance(result, ClientException):
+        raise result
+      _save_upload_result(job, result, batch_id)
+    except ClientException as ex:
+      logger.error("ClientException: An image job failed. Reason: %s" %ex)
+      error = ex
+      fn = partial(ongoing_upload_task.increment, 'fails')
+    else:
+      fn = partial(ongoing_upload_task.increment, 'successes')
+    ongoing_upload_task.add_bytes('done_bytes', size)
+    ongoing_upload_task.postprocess_queue.put(fn)
+  if retried:
+    metrics.retries.inc(len(retried))
+    _defer(retried, api_client.backoff_delay(conn.attempts,
+                                             conn.starting_backoff),
+           conn.attempts)
+  if error:
+    raise error
+  return retried
+
+def _upload_single_image(job, batch_id, conn):
+  '''
+  Uploads the image of the ImageJob job.
+  Note: the database has a single writer at a time. commit_lock makes the
+  threads write their results one after the other.
+  Returns: [job] if it is deferred to be retried later, or []. The job is
+    counted as a success or a failure unless it is deferred, also when an
+    exception is raised.
+  '''
+  global ongoing_upload_task
+
+  if not job:
+    logger.error("image job is None.")
+    raise ClientException("image job is None.")
+
+  logger.info("Image job started: OriginalFileName: {0}".format(job.path))
+
+  if job.error:
+    logger.error("image record has error: {0}".format(job.error))
+    ongoing_upload_task.add_bytes('done_bytes', job.size)
+    fn = partial(ongoing_upload_task.increment, 'fails')
+    ongoing_upload_task.postprocess_queue.put(fn) # Multi-thread
+    raise ClientException(job.error)
+  filename = job.path
+  mediaGUID = job.guid
+  mediaMD5 = job.md5
+  size = job.size
+  attempts = job.upload_attempts
+
+  progress = partial(ongoing_upload_task.add_bytes, 'sending_bytes')
+  try:
+    # Post image to API.
+    # ma_str is the return from server
+    if api_client.use_chunked_upload(size):
+      img_str = conn.post_image_chunked(filename, mediaGUID, mediaMD5,
+                                        progress, attempts)
+    else:
+      img_str = conn.post_image(filename, mediaGUID, progress, attempts)
+    _save_upload_result(job, img_str, batch_id)
 
     if conn.attempts > 1:
       logger.debug('Done after %d attempts' % (conn.attempts))
@@ -564,6 +1310,11 @@ def _upload_single_image(image_record, batch_id, conn):
     # It's sccessful this time.
     #fn = partial(ongoing_upload_task.check_continuous_fails, True)
     #ongoing_upload_task.postprocess_queue.put(fn) # Multi-thread
+    return []
+  except api_client.RetryLater as ex:
+    # Not done yet.
+    size = 0
+    return _defer([job], ex.delay, ex.attempts)
   except ClientException as ex:
     logger.error("ClientException: An image job failed. Reason: %s" %ex)
     fn = partial(ongoing_upload_task.increment, 'fails')
@@ -577,13 +1328,22 @@ def _upload_single_image(image_record, batch_id, conn):
     raise
   except IOError as err:
     logger.error("IOError: An image job failed.")
+    metrics.failures.inc(cause="io")
+    fn = partial(ongoing_upload_task.increment, 'fails')
+    ongoing_upload_task.postprocess_queue.put(fn) # Multi-thread
     if err.errno == ENOENT: # No such file or directory.
-      error_queue.put(
-          'Local file %s not found' % repr(image_record.OriginalFileName))
-      fn = partial(ongoing_upload_task.increment, 'fails')
-      ongoing_upload_task.postprocess_queue.put(fn) # Multi-thread
+      ongoing_upload_task.error_queue.put(
+          'Local file %s not found' % repr(filename))
+      return []
     else:
       raise
+  except Exception:
+    # Counted, or the task would wait for the job forever.
+    fn = partial(ongoing_upload_task.increment, 'fails')
+    ongoing_upload_task.postprocess_queue.put(fn) # Multi-thread
+    raise
+  finally:
+    ongoing_upload_task.add_bytes('done_bytes', size)
 
 def _upload_csv(conn):
   '''
@@ -594,9 +1354,31 @@ def _upload_csv(conn):
 
     # Post csv file to API.
     # ma_str is the return from server
-    name, f_md5 = _make_csvtempfile()
-    csv_str = conn.post_csv(name)
-    result_obj = json.loads(csv_str)
+    result_obj = None
+    if api_client.csv_gzip:
+      csvfile, f_md5, _junk = _make_csvtempfile(compress=True)
+      try:
+        result_obj = json.loads(
+            conn.post_csv_stream(csvfile, "temp.csv.gz", "gzip"))
+      except ClientException as ex:
+        if ex.http_status not in (400, 415):
+          raise
+      finally:
+        csvfile.close()
+      # A server that decodes the upload echoes the content encoding.
+      # Otherwise it stored the gzip file as the dataset, which is sent
+      # again uncompressed.
+      if result_obj is None or result_obj.get('content_encoding') != 'gzip':
+        logger.error("The server does not accept a compressed CSV file, "
+                     "sending it uncompressed.")
+        api_client.csv_gzip = False
+        result_obj = None
+    if result_obj is None:
+      csvfile, f_md5, _junk = _make_csvtempfile()
+      try:
+        result_obj = json.loads(conn.post_csv_stream(csvfile, "temp.csv"))
+      finally:
+        csvfile.close()
 
     # img_etag is not stored in the db.
     csv_etag = result_obj['file_md5']
@@ -609,7 +1391,17 @@ def _upload_csv(conn):
           + " the eTag or no eTag is returned.")
     logger.debug('Done after %d attempts' % (conn.attempts))
     ongoing_upload_task.set_csv_uploaded()
-    model.set_all_csv_uploaded()
+    # Committed whether or not the batch is finished, so that a resume does
+    # not send the dataset again.
+    tracing.acquire(commit_lock)
+    try:
+      model.set_all_csv_uploaded()
+      model.commit()
+    except SQLAlchemyError:
+      model.rollback()
+      raise
+    finally:
+      commit_lock.release()
   except ClientException as ex:
     logger.error("ClientException: A CSV job failed. Reason: %s" %ex)
     raise
@@ -617,28 +1409,67 @@ def _upload_csv(conn):
     logger.error("IOError: A CSV job failed.")
     raise
 
-def _make_csvtempfile():
+# The temporary CSV file is kept in memory up to this size.
+CSV_SPOOL_MAX_SIZE = 16 * 2 ** 20
+
+def _make_csvtempfile(compress=False):
+  """
+  Writes the unuploaded records to a new temporary file in a single pass over
+  the query, computing the MD5s while the bytes are written.
+  Returns: (file, csv_md5, gzip_md5). file is positioned at its end and holds
+    the gzip-encoded CSV if compress is True. gzip_md5 is the MD5 of that
+    encoding, or None.
+  """
   logger.debug("Making temporary CSV file ...")
-  fname = os.path.join(tempfile.gettempdir(), "temp.csv")
-  md5 = ""
-  with open(fname, "wb") as f:
-    csvwriter = csv.writer(
-        f, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-    header = model.get_batch_details_fieldnames()
-    csvwriter.writerow(header)
-    rows = model.get_unuploaded_information()
-    for row in rows:
-      csvwriter.writerow(row)
-  with open(fname, "rb") as f:
-    md5 = _md5_file(f)
+  f = tempfile.SpooledTemporaryFile(max_size=CSV_SPOOL_MAX_SIZE,
+                                    prefix="idigbio-", suffix=".csv")
+  try:
+    if compress:
+      gz_writer = _MD5Writer(f)
+      gz = gzip.GzipFile("temp.csv", "wb", 6, gz_writer)
+      csv_writer = _MD5Writer(gz)
+    else:
+      gz_writer = None
+      csv_writer = _MD5Writer(f)
+    for data in _csv_lines(model.iter_unuploaded_information()):
+      csv_writer.write(data)
+    if compress:
+      gz.close()
+  except:
+    f.close()
+    raise
   logger.debug("Making temporary CSV file done.")
-  return fname, md5
-
-def _md5_file(f, block_size=2*20):
-  md5 = hashlib.md5()
-  while True:
-    data = f.read(block_size)
-    if not data:
-      break
-    md5.update(data)
-  return md5.hexdigest()
+  return (f, csv_writer.hexdigest(),
+          gz_writer.hexdigest() if gz_writer else None)
+
+def _csv_lines(rows):
+  """
+  Yields the CSV encoding of the header and rows, a chunk of lines at a time.
+  """
+  buf = StringIO()
+  csvwriter = csv.writer(
+      buf, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+  csvwriter.writerow(model.get_batch_details_fieldnames())
+  for row in rows:
+    csvwriter.writerow(row)
+    if buf.tell() >= 2 ** 16:
+      yield buf.getvalue()
+      buf.seek(0)
+      buf.truncate()
+  yield buf.getvalue()
+
+class _MD5Writer(object):
+  """A file-like object that writes through to f while computing the MD5."""
+  def __init__(self, f):
+    self.f = f
+    self.md5 = hashlib.md5()
+
+  def write(self, data):
+    self.md5.update(data)
+    self.f.write(data)
+
+  def flush(self):
+    self.f.flush()
+
+  def hexdigest(self):
+    return self.md5.hexdigest()
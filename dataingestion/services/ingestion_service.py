@@ -16,9 +16,9 @@ from dataingestion.services import (ingestion_manager, constants, api_client,
 from dataingestion.services.user_config import (get_user_config,
                                                 set_user_config, rm_user_config)
 
+# The task thread starts and stops with the CherryPy engine, not at import.
 singleton_task = BackgroundTaskQueue(cherrypy.engine, qsize=1, qwait=20)
 singleton_task.subscribe()
-singleton_task.start()
 
 logger = logging.getLogger("iDigBioSvc.ingestion_service")
 
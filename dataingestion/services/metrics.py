@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distributed according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+"""
+This module keeps the upload metrics of the process and renders them in the
+Prometheus text exposition format, served at /services/metrics.
+"""
+import threading
+from time import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, float("inf"))
+
+_registry = []
+
+def _format_value(value):
+  value = float(value)
+  if value == float("inf"):
+    return "+Inf"
+  return repr(value)
+
+def _format_labels(labels):
+  if not labels:
+    return ""
+  return "{%s}" % ",".join(
+      '%s="%s"' % (name, str(value).replace("\\", "\\\\")
+                   .replace("\n", "\\n").replace('"', '\\"'))
+      for name, value in labels)
+
+def _label_key(labels):
+  return tuple(sorted(labels.items()))
+
+
+class _Metric(object):
+  type_name = None
+
+  def __init__(self, name, help_text):
+    self.name = name
+    self.help = help_text
+    self.lock = threading.Lock()
+    _registry.append(self)
+
+  def samples(self):
+    """
+    Returns: A list of (name suffix, label pairs, value).
+    """
+    raise NotImplementedError
+
+  def render(self):
+    lines = ["# HELP %s %s" % (self.name, self.help),
+             "# TYPE %s %s" % (self.name, self.type_name)]
+    for suffix, labels, value in self.samples():
+      lines.append("%s%s%s %s" % (self.name, suffix, _format_labels(labels),
+                                  _format_value(value)))
+    return "\n".join(lines)
+
+
+class Counter(_Metric):
+  type_name = "counter"
+
+  def __init__(self, name, help_text):
+    _Metric.__init__(self, name, help_text)
+    self.values = {}
+
+  def inc(self, amount=1, **labels):
+    key = _label_key(labels)
+    self.lock.acquire()
+    try:
+      self.values[key] = self.values.get(key, 0) + amount
+    finally:
+      self.lock.release()
+
+  def get(self, **labels):
+    return self.values.get(_label_key(labels), 0)
+
+  def samples(self):
+    self.lock.acquire()
+    try:
+      return [("", key, value) for key, value in sorted(self.values.items())]
+    finally:
+      self.lock.release()
+
+
+class Gauge(_Metric):
+  """
+  A value that goes up and down. A gauge can also be read from a function at
+  render time, see set_function.
+  """
+  type_name = "gauge"
+
+  def __init__(self, name, help_text):
+    _Metric.__init__(self, name, help_text)
+    self.values = {}
+    self.functions = {}
+
+  def set(self, value, **labels):
+    self.lock.acquire()
+    try:
+      self.values[_label_key(labels)] = value
+    finally:
+      self.lock.release()
+
+  def inc(self, amount=1, **labels):
+    key = _label_key(labels)
+    self.lock.acquire()
+    try:
+      self.values[key] = self.values.get(key, 0) + amount
+    finally:
+      self.lock.release()
+
+  def dec(self, amount=1, **labels):
+    self.inc(-amount, **labels)
+
+  def set_function(self, func, **labels):
+    """
+    The value of the gauge with labels is func() at render time.
+    """
+    self.lock.acquire()
+    try:
+      self.functions[_label_key(labels)] = func
+    finally:
+      self.lock.release()
+
+  def get(self, **labels):
+    key = _label_key(labels)
+    if key in self.functions:
+      return self.functions[key]()
+    return self.values.get(key, 0)
+
+  def samples(self):
+    self.lock.acquire()
+    try:
+      values = dict(self.values)
+      functions = dict(self.functions)
+    finally:
+      self.lock.release()
+    for key, func in functions.items():
+      values[key] = func()
+    return [("", key, value) for key, value in sorted(values.items())]
+
+
+class Histogram(_Metric):
+  type_name = "histogram"
+
+  def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+    _Metric.__init__(self, name, help_text)
+    self.buckets = tuple(buckets)
+    if self.buckets[-1] != float("inf"):
+      self.buckets += (float("inf"),)
+    # Maps a label key to [bucket counts, sum, count].
+    self.values = {}
+
+  def observe(self, value, **labels):
+    key = _label_key(labels)
+    self.lock.acquire()
+    try:
+      entry = self.values.get(key)
+      if entry is None:
+        entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+      for index, bound in enumerate(self.buckets):
+        if value <= bound:
+          entry[0][index] += 1
+          break
+      entry[1] += value
+      entry[2] += 1
+    finally:
+      self.lock.release()
+
+  def time(self, **labels):
+    """
+    Returns a context manager that observes the duration of its block.
+    """
+    return _Timer(self, labels)
+
+  def get_count(self, **labels):
+    entry = self.values.get(_label_key(labels))
+    return entry[2] if entry else 0
+
+  def samples(self):
+    self.lock.acquire()
+    try:
+      values = sorted((key, (list(entry[0]), entry[1], entry[2]))
+                      for key, entry in self.values.items())
+    finally:
+      self.lock.release()
+    samples = []
+    for key, (counts, total, count) in values:
+      cumulative = 0
+      for bound, bucket_count in zip(self.buckets, counts):
+        cumulative += bucket_count
+        samples.append(("_bucket", key + (("le", _format_value(bound)),),
+                        cumulative))
+      samples.append(("_sum", key, total))
+      samples.append(("_count", key, count))
+    return samples
+
+
+class _Timer(object):
+  def __init__(self, histogram, labels):
+    self.histogram = histogram
+    self.labels = labels
+
+  def __enter__(self):
+    self.start = time()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.histogram.observe(time() - self.start, **self.labels)
+    return False
+
+
+def render():
+  """
+  Returns: All the metrics in the Prometheus text exposition format.
+  """
+  return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+files = Counter("idigbio_files_total",
+                "Media files processed, by result (success, fail, skip).")
+sent_bytes = Counter("idigbio_sent_bytes_total",
+                     "Request body bytes sent to the server, retries included.")
+retries = Counter("idigbio_retries_total",
+                  "Requests retried after a failed attempt.")
+failures = Counter("idigbio_request_failures_total",
+                   "Failed request attempts, by cause.")
+phase_seconds = Histogram(
+    "idigbio_upload_phase_seconds",
+    "Time spent per file in each upload phase: hash (local MD5), encode "
+    "(reading and encoding the body), send (writing it to the network) and "
+    "server_wait (from the last body byte to the response).")
+queue_depth = Gauge("idigbio_queue_depth",
+                    "Items waiting in the queues of the ongoing upload task.")
+active_workers = Gauge("idigbio_active_workers",
+                       "Upload worker threads currently sending media.")
+timeouts = Counter(
+    "idigbio_request_timeouts_total",
+    "Requests that timed out, by phase: connect, send, deadline (the body "
+    "took too long to send) and response.")
+throughput_estimate = Gauge(
+    "idigbio_throughput_estimate_bytes_per_second",
+    "The upload throughput the request timeouts are derived from.")
+async_requests = Gauge(
+    "idigbio_async_requests",
+    "Requests in flight in the event loop upload engine.")
+circuit_state = Gauge(
+    "idigbio_circuit_state",
+    "State of the circuit breaker of the server requests: 0 closed, "
+    "1 half-open, 2 open.")
+db_commit_seconds = Histogram("idigbio_db_commit_seconds",
+                              "Latency of the local database commits.")
+db_query_seconds = Histogram(
+    "idigbio_db_query_seconds",
+    "Latency of the local database statements, by kind and table.")
+db_slow_queries = Counter(
+    "idigbio_db_slow_queries_total",
+    "Local database statements slower than idigbio.slow_query_ms.")
@@ -7,7 +7,7 @@
 """
 This module implements the data model for the service.
 """
-from sqlalchemy import (create_engine, Column, Integer, String, DateTime,
+from sqlalchemy import (event, create_engine, Column, Integer, String, DateTime,
                         Boolean, types, distinct)
 from sqlalchemy.orm import scoped_session, sessionmaker, relationship
 from sqlalchemy.ext.declarative import declarative_base
@@ -17,7 +17,7 @@ import logging, hashlib, argparse, os, time, struct, re, json
 # import pyexiv2
 from datetime import datetime
 import types as pytypes
-from dataingestion.services import constants
+from dataingestion.services import constants, metrics, tracing, query_stats
 
 THRESHOLD_TIME = 2 # sec
 
@@ -33,6 +33,8 @@ Base = declarative_base()
 
 logger = logging.getLogger('iDigBioSvc.model')
 
+_allowed_files = re.compile(constants.ALLOWED_FILES, re.IGNORECASE)
+
 def check_session(func):
   def wrapper(*args):
     if session is None:
@@ -40,6 +42,22 @@ def check_session(func):
     return func(*args)
   return wrapper
 
+def read_only(func):
+  """
+  Calls func with a new session of the read-only engine as its first
+  argument, and closes the session once func returns. The readers, such as
+  the REST queries, see the committed data and do not wait for the writers.
+  """
+  def wrapper(*args):
+    if read_session is None:
+      raise ValueError('DB session is None.')
+    reader = read_session()
+    try:
+      return func(reader, *args)
+    finally:
+      reader.close()
+  return wrapper
+
 
 class ModelException(Exception):
   def __init__(self, msg, reason=''):
@@ -183,40 +201,106 @@ class ImageRecord(Base):
     self.BatchID = batch.id
 
 
+# The session of the calling thread, used by the writers: a scoped_session,
+# so that each thread has its own. A thread calls remove_session once it is
+# done with the database.
 session = None
+# Makes the sessions of read_only, bound to read_engine.
+read_session = None
+read_engine = None
+
+def _set_query_only(dbapi_connection, connection_record):
+  dbapi_connection.execute("PRAGMA query_only = ON")
 
 def setup(db_file):
   """
   Set up the database.
   """
-  global session
+  global session, read_session, read_engine
 
   db_conn = "sqlite:///%s" % db_file
   logger.info("DB Connection: %s" % db_conn)
   engine = create_engine(db_conn, connect_args={'check_same_thread':False})
-  engine.Echo = True
+  query_stats.instrument(engine)
   Base.metadata.create_all(engine)
+  # The readers neither block the writer nor wait for it.
+  engine.execute("PRAGMA journal_mode = WAL")
 
-  Session = scoped_session(sessionmaker(bind=engine))
-  session = Session()
-  print "DB Connection: %s" % db_conn
+  read_engine = create_engine(db_conn,
+                              connect_args={'check_same_thread':False})
+  event.listen(read_engine, "connect", _set_query_only)
+  query_stats.instrument(read_engine)
+
+  # The instances stay loaded after a commit, so that the other threads can
+  # read them, such as the batch of the upload task, without a query in the
+  # session of the thread that loaded them.
+  session = scoped_session(sessionmaker(bind=engine, expire_on_commit=False))
+  read_session = sessionmaker(bind=read_engine)
+
+def checkpoint(db_file):
+  """
+  Writes the pages of the write-ahead log of db_file, such as the log left by
+  a crash, into db_file and empties the log, so that db_file can be moved
+  alone. The database is not set up.
+  """
+  engine = create_engine("sqlite:///%s" % db_file)
+  try:
+    engine.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+  finally:
+    engine.dispose()
 
 def _md5_file(f, block_size=2 ** 20):
   """
-  Get MD5 of the file.
+  Get MD5 of the file. The time reading and hashing is traced.
   """
   md5 = hashlib.md5()
+  read_time = hash_time = 0.0
   while True:
+    start = time.time()
     data = f.read(block_size)
+    read_time += time.time() - start
     if not data:
       break
+    start = time.time()
     md5.update(data)
+    hash_time += time.time() - start
+  tracing.record("read", read_time)
+  tracing.record("hash", hash_time)
   return md5
 
-def _generate_record(csvrow, headerline):
-  mediapath = ""
-  mediaguid = ""
-  sruuid = ""
+class RowMapper(object):
+  """
+  The columns of a CSV header line, resolved once for all the rows under it.
+  """
+  def __init__(self, headerline):
+    self.mediapath = None
+    self.mediaguid = None
+    self.sruuid = None
+    annotations = []
+    for index, elem in enumerate(headerline):
+      if elem == "idigbio:OriginalFileName":
+        self.mediapath = index
+      elif elem == "idigbio:MediaGUID":
+        self.mediaguid = index
+      elif elem == "idigbio:SpecimenRecordUUID":
+        self.sruuid = index
+      else:
+        annotations.append((elem, index))
+    # (column name, index) of the other columns.
+    self.annotations = tuple(annotations)
+
+  def map(self, csvrow):
+    """
+    Returns: (mediapath, mediaguid, sruuid, annotations_dict) of csvrow.
+    """
+    mediapath = "" if self.mediapath is None else csvrow[self.mediapath]
+    mediaguid = "" if self.mediaguid is None else csvrow[self.mediaguid]
+    sruuid = ("" if self.sruuid is None else
+              csvrow[self.sruuid].replace(" ", ""))
+    return (mediapath, mediaguid, sruuid,
+            dict((elem, csvrow[index]) for elem, index in self.annotations))
+
+def _generate_record(csvrow, row_mapper):
   error = ""
   warnings = ""
   mimetype = ""
@@ -224,20 +308,10 @@ def _generate_record(csvrow, headerline):
   ctime = ""
   fowner = ""
   exif = ""
-  annotations_dict = {}
   mmd5 = ""
   amd5 = ""
 
-  index = 0
-  for index, elem in enumerate(headerline):
-    if elem == "idigbio:OriginalFileName":
-      mediapath = csvrow[index]
-    elif elem == "idigbio:MediaGUID":
-      mediaguid = csvrow[index]
-    elif elem == "idigbio:SpecimenRecordUUID":
-      sruuid = csvrow[index].replace(" ", "")
-    else:
-      annotations_dict[elem] = csvrow[index]
+  mediapath, mediaguid, sruuid, annotations_dict = row_mapper.map(csvrow)
 
   recordmd5 = hashlib.md5()
   # Note that mediapath can be different and the image is the same,
@@ -248,7 +322,7 @@ def _generate_record(csvrow, headerline):
   exifinfo = None
   filemd5hexdigest = ""
 
-  if not re.compile(constants.ALLOWED_FILES, re.IGNORECASE).match(mediapath):
+  if not _allowed_files.match(mediapath):
     error = "File type unsupported."
   else:
     try:
@@ -325,22 +399,26 @@ def _generate_record(csvrow, headerline):
           recordmd5.hexdigest())
 
 @check_session
-def add_image(batch, csvrow, headerline):
+def add_image(batch, csvrow, row_mapper):
   """
   Parameters:
     batch: The UploadBatch instance this image belongs to.
     csvrow: A list of values of the current csvrow.
-    headerline: The header line of the csv file.
+    row_mapper: The RowMapper of the header line of the csv file, or the
+      header line itself.
   Return the image or None is the image should not be uploaded.
   Return type: ImageRecord or None.
   Note: Image identity is not determined by path but rather by its MD5.
   """
+  if not isinstance(row_mapper, RowMapper):
+    row_mapper = RowMapper(row_mapper)
   (mediapath, mediaguid, sruuid, error, warnings, mimetype, msize, ctime,
    fowner, exif, annotations, mmd5, amd5) = _generate_record(
-       csvrow, headerline)
+       csvrow, row_mapper)
 
   try:
-    record = session.query(ImageRecord).filter_by(AllMD5=amd5).first()
+    with tracing.span("db_query"):
+      record = session.query(ImageRecord).filter_by(AllMD5=amd5).first()
   except Exception as e:
     logger.error('add_image: error occur during SQLITE access:{0}'.format(e))
     raise ModelException("Error occur during SQLITE access:{0}".format(e))
@@ -351,6 +429,8 @@ def add_image(batch, csvrow, headerline):
                          mmd5, amd5, batch)
     try:
       session.add(record)
+      # Gives the record its id.
+      session.flush()
     except Exception as e:
       logger.error('add_image: error occur during SQLITE add:{0}'.format(e))
       raise ModelException("Error occur during SQLITE add:{0}".format(e))
@@ -362,6 +442,22 @@ def add_image(batch, csvrow, headerline):
     record.BatchID = batch.id
     return record
 
+@check_session
+def set_upload_result(record_id, batch_id, content, url=None):
+  """
+  Records the server response content to the upload of the image record with
+  record_id, in the batch with batch_id. If url is given, the upload is
+  verified and the record is marked as uploaded to url.
+  The record is updated in the database without being loaded. An instance
+  already in the session is not updated.
+  """
+  values = {"BatchID": batch_id, "MediaAPContent": content}
+  if url is not None:
+    values["UploadTime"] = str(datetime.utcnow())
+    values["MediaURL"] = url
+  session.query(ImageRecord).filter_by(id=record_id).update(
+      values, synchronize_session=False)
+
 @check_session
 def add_batch(path, accountID, license, licenseStatementUrl, licenseLogoUrl):
   """
@@ -412,12 +508,12 @@ def get_batch_details_fieldnames():
       "RightsLicenseLogoUrl", "batchID"]
       # 11 - 19 above.
 
-@check_session
-def get_batch_details_brief(batch_id):
+@read_only
+def get_batch_details_brief(reader, batch_id):
   '''Gets all the image records for a batch with batch_id.'''
   batch_id = int(batch_id)
   
-  query = session.query(
+  query = reader.query(
       ImageRecord.OriginalFileName,
       ImageRecord.Error,
       ImageRecord.MediaURL,
@@ -428,13 +524,13 @@ def get_batch_details_brief(batch_id):
 
   return query.all()
 
-@check_session
-def get_batch_details(batch_id):
+@read_only
+def get_batch_details(reader, batch_id):
   '''Gets all the image records for a batch with batch_id.'''
   batch_id = int(batch_id)
   if (batch_id == 0): # Get the last batch.
-    batch_id = int(session.query(UploadBatch.id).order_by(desc(UploadBatch.id)).first()[0])
-  query = session.query(
+    batch_id = int(reader.query(UploadBatch.id).order_by(desc(UploadBatch.id)).first()[0])
+  query = reader.query(
       ImageRecord.MediaGUID,
       ImageRecord.OriginalFileName,
       ImageRecord.SpecimenRecordUUID,
@@ -466,6 +562,13 @@ def get_batch_details(batch_id):
 @check_session
 def get_unuploaded_information():
   '''Gets all the image records for a batch with batch_id.'''
+  query = _unuploaded_information_query()
+
+  logger.debug("get_unuploaded_information: record count={0}.".format(query.count()))
+
+  return query.all()
+
+def _unuploaded_information_query():
   query = session.query(
       ImageRecord.MediaGUID,
       ImageRecord.OriginalFileName,
@@ -491,21 +594,26 @@ def get_unuploaded_information():
       # 11 - 19 above
     ).filter(UploadBatch.CSVUploaded == False).filter(ImageRecord.BatchID == UploadBatch.id
     ).order_by(ImageRecord.id) # 20 elements.
+  return query
 
-  logger.debug("get_unuploaded_information: record count={0}.".format(query.count()))
-
-  return query.all()
+@check_session
+def iter_unuploaded_information(batch_size=1000):
+  '''
+  Iterates over the same rows as get_unuploaded_information, fetching
+  batch_size rows at a time instead of loading all of them.
+  '''
+  return _unuploaded_information_query().yield_per(batch_size)
 
 @check_session
 def set_all_csv_uploaded():
   session.query(UploadBatch).filter(UploadBatch.CSVUploaded==False).update(
       {"CSVUploaded": True})
 
-@check_session
-def get_all_success_details():
+@read_only
+def get_all_success_details(reader):
   '''Gets all the image records for all batches.'''
   
-  query = session.query(
+  query = reader.query(
       ImageRecord.MediaGUID,
       ImageRecord.OriginalFileName,
       ImageRecord.SpecimenRecordUUID,
@@ -537,14 +645,14 @@ def get_all_success_details():
   return query.all()
 
 
-@check_session
-def get_all_batches():
+@read_only
+def get_all_batches(reader):
   """
   Get all the batches in the batch table.
   Return: A list of all batches, each batch is a list of all fields.
   """
 
-  query = session.query(
+  query = reader.query(
     UploadBatch.id,
     UploadBatch.CSVfilePath,
     UploadBatch.iDigbioProvidedByGUID,
@@ -573,14 +681,14 @@ def get_all_batches():
   logger.debug("get_all_batches: batch count={0}.".format(len(ret)))
   return ret
 
-@check_session
-def get_last_batch_info():
+@read_only
+def get_last_batch_info(reader):
   """
   Returns info about the last batch.
   Returns:
     A dictionary of simple information about last batch. 
   """
-  batch = session.query(UploadBatch).order_by(desc(UploadBatch.id)).first()
+  batch = reader.query(UploadBatch).order_by(desc(UploadBatch.id)).first()
   if batch:
     starttime = str(batch.start_time)
     starttime = starttime[0:starttime.index('.')]
@@ -612,17 +720,35 @@ def load_last_batch():
   batch = session.query(UploadBatch).order_by(desc(UploadBatch.id)).first()
   return batch
 
-@check_session
-def get_csv_path(batch_id):
-  batch = session.query(UploadBatch).filter_by(id=batch_id).first()
+@read_only
+def get_csv_path(reader, batch_id):
+  batch = reader.query(UploadBatch).filter_by(id=batch_id).first()
   return batch.CSVfilePath
 
 @check_session
 def commit():
-  session.commit()
+  with tracing.span("db_commit", metrics.db_commit_seconds):
+    session.commit()
+
+@check_session
+def rollback():
+  session.rollback()
+
+def remove_session():
+  """
+  Closes the session of the calling thread, once it is done with the
+  database. Its instances stay readable, detached.
+  """
+  if session is not None:
+    session.remove()
 
 def close():
-  global session
+  global session, read_session, read_engine
   if session:
-    session.close()
+    session.remove()
+    session.bind.dispose()
+    # The pooled connections of the readers keep the file open otherwise.
+    read_engine.dispose()
     session = None
+    read_session = None
+    read_engine = None
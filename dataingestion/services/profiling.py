@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distributed according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+"""
+This module finds out what the upload threads are doing:
+  - With a profile directory (main.py --profile), each thread of an upload
+    task runs under cProfile and the profiles are written per batch, in the
+    pstats format.
+  - format_thread_stacks dumps the stacks of all the threads.
+  - Sampler samples the stacks of all the threads for a while and returns
+    them in the collapsed format of flame graph tools.
+"""
+import sys, os, threading, traceback, cProfile, pstats, logging
+from collections import defaultdict
+from time import time, sleep
+
+logger = logging.getLogger('iDigBioSvc.profiling')
+
+# Where the profiles of the upload tasks are written. None disables them.
+profile_dir = None
+SAMPLE_INTERVAL = 0.01
+MAX_SAMPLE_SECONDS = 600
+
+# The last sampler started.
+sampler = None
+sampler_lock = threading.Lock()
+
+def init(directory=None):
+  global profile_dir
+  profile_dir = directory or None
+  if profile_dir and not os.path.exists(profile_dir):
+    os.makedirs(profile_dir)
+
+def new_profile():
+  """
+  Returns: A new cProfile.Profile if the upload tasks are profiled, or None.
+  """
+  return cProfile.Profile() if profile_dir else None
+
+def call(profile, func, *args, **kwargs):
+  """
+  Calls func under profile, unless profile is None.
+  """
+  if profile is None:
+    return func(*args, **kwargs)
+  return profile.runcall(func, *args, **kwargs)
+
+def dump(name, profiles):
+  """
+  Writes the (thread name, profile) pairs to profile_dir/name/thread.prof,
+  and all of them merged to profile_dir/name/all.prof.
+  Returns: The directory written, or None.
+  """
+  profiles = [(thread, profile) for thread, profile in profiles if profile]
+  if not profile_dir or not profiles:
+    return None
+  directory = os.path.join(profile_dir, name)
+  if not os.path.exists(directory):
+    os.makedirs(directory)
+  merged = None
+  for thread, profile in profiles:
+    profile.create_stats()
+    if not profile.stats:
+      continue
+    profile.dump_stats(os.path.join(directory, thread + ".prof"))
+    if merged is None:
+      merged = pstats.Stats(profile)
+    else:
+      merged.add(profile)
+  if merged is not None:
+    merged.dump_stats(os.path.join(directory, "all.prof"))
+  logger.info("Profiles written to {0}.".format(directory))
+  return directory
+
+
+def format_thread_stacks():
+  """
+  Returns: The current stack of every thread, as text.
+  """
+  threads = dict((thread.ident, thread) for thread in threading.enumerate())
+  lines = []
+  for ident, frame in sorted(sys._current_frames().items()):
+    thread = threads.get(ident)
+    name = thread.name if thread else "?"
+    daemon = " daemon" if thread and thread.daemon else ""
+    lines.append("Thread {0} ({1}{2}):\n".format(name, ident, daemon))
+    lines.extend(traceback.format_stack(frame))
+    lines.append("\n")
+  return "".join(lines)
+
+
+def _frame_name(code):
+  return "{0}:{1}".format(os.path.basename(code.co_filename), code.co_name)
+
+class Sampler(threading.Thread):
+  """
+  Samples the stacks of all the other threads every interval seconds, for
+  seconds or until stopped.
+  """
+  def __init__(self, seconds, interval=SAMPLE_INTERVAL):
+    threading.Thread.__init__(self, name="profiling-sampler")
+    self.daemon = True
+    self.seconds = min(float(seconds), MAX_SAMPLE_SECONDS)
+    self.interval = max(float(interval), 0.001)
+    self.counts = defaultdict(int)
+    self.samples = 0
+    self.started_at = None
+    self.stopped = False
+    self.lock = threading.Lock()
+
+  def run(self):
+    self.started_at = time()
+    deadline = self.started_at + self.seconds
+    while not self.stopped and time() < deadline:
+      self._sample()
+      sleep(self.interval)
+    self.stopped = True
+
+  def stop(self):
+    self.stopped = True
+
+  def running(self):
+    return self.is_alive() and not self.stopped
+
+  def _sample(self):
+    names = dict((thread.ident, thread.name)
+                 for thread in threading.enumerate())
+    stacks = []
+    for ident, frame in sys._current_frames().items():
+      if ident == self.ident:
+        continue
+      frames = []
+      while frame is not None:
+        frames.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+      frames.append(names.get(ident, "thread-%d" % ident))
+      frames.reverse()
+      stacks.append(";".join(frames))
+    self.lock.acquire()
+    try:
+      for stack in stacks:
+        self.counts[stack] += 1
+      self.samples += 1
+    finally:
+      self.lock.release()
+
+  def collapsed(self):
+    """
+    Returns: One line "thread;outer frame;...;inner frame count" per distinct
+      stack, the input of flamegraph.pl and speedscope.
+    """
+    self.lock.acquire()
+    try:
+      items = sorted(self.counts.items())
+    finally:
+      self.lock.release()
+    return "".join("{0} {1}\n".format(stack, count) for stack, count in items)
+
+def start_sampling(seconds, interval=SAMPLE_INTERVAL):
+  """
+  Starts a new Sampler, unless one is running.
+  Returns: The new Sampler, or None if one is running.
+  """
+  global sampler
+  sampler_lock.acquire()
+  try:
+    if sampler is not None and sampler.running():
+      return None
+    sampler = Sampler(seconds, interval)
+    sampler.start()
+    return sampler
+  finally:
+    sampler_lock.release()
+
+def stop_sampling():
+  if sampler is not None:
+    sampler.stop()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distributed according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+"""
+This module lets progress readers wait for the next change instead of polling.
+"""
+import threading
+from time import time
+
+# Changes are reported to a waiting reader at most once in this many seconds.
+MIN_INTERVAL = 0.25
+# A waiting reader is answered after this many seconds even if nothing changed.
+WAIT_TIMEOUT = 20
+
+class ProgressNotifier(object):
+  """
+  A version number that is bumped on every progress change, and a condition
+  to wait for the next bump.
+  """
+  def __init__(self, lock=None):
+    self.cond = threading.Condition(lock or threading.Lock())
+    self.version = 0
+
+  def changed(self):
+    """
+    Records a change and wakes up the waiting readers.
+    Note: The caller must hold the lock of the notifier.
+    """
+    self.version += 1
+    self.cond.notify_all()
+
+  def wait(self, since_version, timeout=WAIT_TIMEOUT,
+           min_interval=MIN_INTERVAL):
+    """
+    Blocks until the version differs from since_version and min_interval has
+    passed since the call, so that a burst of changes is answered once, or
+    until timeout.
+    Returns: The current version.
+    """
+    start = time()
+    earliest = start + min_interval
+    deadline = start + timeout
+    self.cond.acquire()
+    try:
+      while True:
+        now = time()
+        if now >= deadline:
+          break
+        if self.version != since_version:
+          if now >= earliest:
+            break
+          self.cond.wait(earliest - now)
+        else:
+          self.cond.wait(deadline - now)
+      return self.version
+    finally:
+      self.cond.release()
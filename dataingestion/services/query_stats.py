@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distributed according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+"""
+This module times the SQL statements of the local database through the
+SQLAlchemy cursor execute events: it keeps the count and time per statement,
+feeds the query metrics, and logs the statements slower than a threshold
+with their query plan.
+"""
+import re, threading, logging
+from time import time
+from sqlalchemy import event
+from dataingestion.services import metrics
+
+logger = logging.getLogger('iDigBioSvc.query_stats')
+
+# Statements taking longer are logged with their plan. None disables the log.
+slow_query_seconds = 0.5
+# Characters of the statements kept in the stats, and of the parameters
+# logged.
+MAX_TEXT = 500
+
+_stats_lock = threading.Lock()
+# statement: [count, total seconds, max seconds, rows changed]
+_stats = {}
+
+_TABLE_RE = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE)\s+[\"`]?(\w+)", re.I)
+_PLANNED = ("SELECT", "UPDATE", "DELETE", "INSERT")
+
+def init(slow_query_ms=None):
+  global slow_query_seconds
+  if slow_query_ms not in (None, ""):
+    slow_query_ms = float(slow_query_ms)
+    slow_query_seconds = slow_query_ms / 1000.0 if slow_query_ms >= 0 else None
+
+def instrument(engine):
+  """
+  Times the statements executed by engine.
+  """
+  event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+  event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+def statement_kind(statement):
+  """
+  Returns: A short label of statement, such as "SELECT imagesV9_0_2".
+  """
+  words = statement.split(None, 1)
+  if not words:
+    return "unknown"
+  match = _TABLE_RE.search(statement)
+  return " ".join([words[0].upper()] + ([match.group(1)] if match else []))
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+  conn.info.setdefault("query_start_time", []).append(time())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+  starts = conn.info.get("query_start_time")
+  if not starts:
+    return
+  seconds = time() - starts.pop()
+  kind = statement_kind(statement)
+  metrics.db_query_seconds.observe(seconds, statement=kind)
+  _add_stats(statement, seconds, cursor.rowcount)
+  if slow_query_seconds is not None and seconds >= slow_query_seconds:
+    metrics.db_slow_queries.inc(statement=kind)
+    _log_slow_query(conn, statement, parameters, executemany, seconds)
+
+def _add_stats(statement, seconds, rows):
+  key = statement[:MAX_TEXT]
+  _stats_lock.acquire()
+  try:
+    entry = _stats.get(key)
+    if entry is None:
+      entry = _stats[key] = [0, 0.0, 0.0, 0]
+    entry[0] += 1
+    entry[1] += seconds
+    entry[2] = max(entry[2], seconds)
+    if rows is not None and rows > 0:
+      entry[3] += rows
+  finally:
+    _stats_lock.release()
+
+def _query_plan(conn, statement, parameters):
+  """
+  Returns: The SQLite query plan of statement, one step per line.
+  """
+  cursor = conn.connection.cursor()
+  try:
+    cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+    return "\n".join("  " + " ".join(str(column) for column in row)
+                     for row in cursor.fetchall())
+  finally:
+    cursor.close()
+
+def _log_slow_query(conn, statement, parameters, executemany, seconds):
+  plan = ""
+  if (not executemany and
+      statement.lstrip().split(None, 1)[0].upper() in _PLANNED):
+    try:
+      plan = "\nPlan:\n" + _query_plan(conn, statement, parameters)
+    except Exception as ex:
+      plan = "\nNo plan: {0}".format(ex)
+  logger.warning("Slow query ({0:.3f} s): {1}\nParameters: {2}{3}".format(
+      seconds, statement, repr(parameters)[:MAX_TEXT], plan))
+
+def get_stats(top_n=None):
+  """
+  Returns: The count, total, mean and max seconds and rows changed of each
+    statement, by descending total time.
+  """
+  _stats_lock.acquire()
+  try:
+    items = [(entry[1], statement, list(entry))
+             for statement, entry in _stats.items()]
+  finally:
+    _stats_lock.release()
+  items.sort(reverse=True)
+  return [dict(statement=statement, count=count, total=total,
+               mean=total / count, max=maximum, rows=rows)
+          for _junk, statement, (count, total, maximum, rows)
+          in items[:top_n or None]]
+
+def reset():
+  _stats_lock.acquire()
+  try:
+    _stats.clear()
+  finally:
+    _stats_lock.release()
@@ -96,7 +96,7 @@ def generateZip(batch_id, target_path):
   annotation = {}
   try:
     annotation = ast.literal_eval(result[0][14])
-  except ex:
+  except (ValueError, SyntaxError):
     annotation = {}
   for key in annotation:
     stub_csv_headerline.append(key)
@@ -112,7 +112,7 @@ def generateZip(batch_id, target_path):
     del record[14]
     try:
       annotation = ast.literal_eval(item[14])
-    except ex:
+    except (ValueError, SyntaxError):
       annotation = {}
     for key in annotation:
       record.append(annotation[key])
@@ -12,7 +12,8 @@ from cherrypy import HTTPError
 from cherrypy._cpcompat import ntob
 from dataingestion.services import (constants, ingestion_service, csv_generator,
                                     ingestion_manager, api_client, model,
-                                    result_generator, user_config)
+                                    result_generator, user_config, metrics,
+                                    profiling, query_stats)
 
 logger = logging.getLogger('iDigBioSvc.service_rest')
 
@@ -68,8 +69,8 @@ class Authentication(object):
 
     if ret:
       # Set the attributes.
-      user_config.set_user_config('accountuuid', accountuuid)
-      user_config.set_user_config('apikey', apikey)
+      user_config.set_user_configs(
+          {'accountuuid': accountuuid, 'apikey': apikey})
     else:
       error = "Authentication combination incorrect."
       print error
@@ -129,9 +130,11 @@ class LastBatchInfo(object):
 class IngestionProgress(object):
   exposed = True
 
-  def GET(self, **params):
+  def GET(self, version=None, **params):
     """
     Get ingestion status.
+    If version is given, this is a long poll: the response is sent when the
+    status differs from the one with that version, or the wait times out.
     """
     # **params added by Kyuho in July 23rd 2013 
     # It is required to accept dummy parameters. 
@@ -139,14 +142,24 @@ class IngestionProgress(object):
     # cache. Internet explorer does execute $.get when the url is the same for
     # the time being. 
     try:
+      if version is None:
+        new_version = ingestion_manager.progress_notifier.version
+        progress = ingestion_manager.get_progress()
+      else:
+        new_version, progress = ingestion_manager.wait_progress(int(version))
+        if progress is None:
+          return json.dumps(dict(version=new_version, started=False))
       (fatal_server_error, input_csv_error, total, skips, successes, fails,
-       csvuploaded, finished) = ingestion_manager.get_progress()
+       csvuploaded, finished) = progress
+      bytes_done, bytes_total, rate, eta = ingestion_manager.get_byte_progress()
       return json.dumps(
           dict(fatal_server_error=fatal_server_error,
                input_csv_error=input_csv_error, total=total,
                successes=successes, skips=skips, fails=fails,
                csvuploaded=csvuploaded,
-               finished=finished))
+               finished=finished, version=new_version, started=True,
+               bytes_done=bytes_done, bytes_total=bytes_total,
+               bytes_per_second=rate, eta_seconds=eta))
     except IngestServiceException as ex:
       error = "Error: " + str(ex)
       print error
@@ -209,14 +222,20 @@ class GenerateCSV(object):
 class CSVGenProgress(object):
   exposed = True
 
-  def GET(self):
+  def GET(self, version=None, **params):
     """
     Get the CSV Generation status.
+    If version is given, this is a long poll, as in IngestionProgress.
     """
     try:
-      count, result, targetfile, error = csv_generator.check_progress()
+      if version is None:
+        new_version = csv_generator.notifier.version
+        progress = csv_generator.check_progress()
+      else:
+        new_version, progress = csv_generator.wait_progress(int(version))
+      count, result, targetfile, error = progress
       return json.dumps(dict(count=count, result=result, targetfile=targetfile,
-                             error=error))
+                             error=error, version=new_version))
     except IngestServiceException as ex:
       error = "Error: " + str(ex)
       print error
@@ -325,6 +344,105 @@ class GenerateOutputZip(object):
       raise JsonHTTPError(409, str(ex))
 
 
+class TraceReport(object):
+  """
+  The time per phase of the files of a batch: percentiles and slowest files.
+  """
+  exposed = True
+
+  def GET(self, batch_id=None, top=None, **params):
+    try:
+      return json.dumps(ingestion_manager.get_trace_report(batch_id, top))
+    except (IngestServiceException, ValueError) as ex:
+      error = "Error: " + str(ex)
+      logger.error(error)
+      raise JsonHTTPError(409, str(ex))
+
+
+class Metrics(object):
+  """
+  The upload metrics in the Prometheus text exposition format, for scraping.
+  """
+  exposed = True
+
+  def GET(self, **params):
+    cherrypy.response.headers['Content-Type'] = "text/plain; version=0.0.4"
+    return metrics.render()
+
+
+class ThreadDump(object):
+  """
+  The current stack of every thread of the service, as text.
+  """
+  exposed = True
+
+  def GET(self, **params):
+    cherrypy.response.headers['Content-Type'] = "text/plain"
+    return profiling.format_thread_stacks()
+
+
+class SamplingProfile(object):
+  """
+  POST starts sampling the stacks of all the threads for the given seconds,
+  DELETE stops it, and GET returns the samples so far in the collapsed stack
+  format of flamegraph.pl.
+  """
+  exposed = True
+
+  def GET(self, **params):
+    sampler = profiling.sampler
+    if sampler is None:
+      raise JsonHTTPError(404, "No profile was sampled.")
+    cherrypy.response.headers['Content-Type'] = "text/plain"
+    cherrypy.response.headers['X-Profile-Running'] = str(sampler.running())
+    cherrypy.response.headers['X-Profile-Samples'] = str(sampler.samples)
+    return sampler.collapsed()
+
+  def POST(self, seconds=30, interval=profiling.SAMPLE_INTERVAL, **params):
+    try:
+      sampler = profiling.start_sampling(float(seconds), float(interval))
+    except ValueError as ex:
+      raise JsonHTTPError(400, str(ex))
+    if sampler is None:
+      raise JsonHTTPError(409, "A profile is being sampled.")
+    return json.dumps({"seconds": sampler.seconds,
+                       "interval": sampler.interval})
+
+  def DELETE(self, **params):
+    profiling.stop_sampling()
+    return json.dumps(True)
+
+
+class QueryStats(object):
+  """
+  The count and time of the local database statements, slowest first.
+  DELETE resets them.
+  """
+  exposed = True
+
+  def GET(self, top=None, **params):
+    try:
+      return json.dumps(query_stats.get_stats(int(top) if top else None))
+    except ValueError as ex:
+      raise JsonHTTPError(400, str(ex))
+
+  def DELETE(self, **params):
+    query_stats.reset()
+    return json.dumps(True)
+
+
+class Debug(object):
+  """
+  Diagnostics of a stalled service, at /services/debug.
+  """
+  exposed = True
+
+  def __init__(self):
+    self.threads = ThreadDump()
+    self.profile = SamplingProfile()
+    self.queries = QueryStats()
+
+
 class DataIngestionService(object):
   """
   The root RESTful web service exposed through CherryPy at /services
@@ -347,3 +465,6 @@ class DataIngestionService(object):
     self.genoutputcsv = GenerateOutputCsv()
     self.genoutputzip = GenerateOutputZip()
     self.generateallcsv = GenerateAllCsv()
+    self.metrics = Metrics()
+    self.tracereport = TraceReport()
+    self.debug = Debug()
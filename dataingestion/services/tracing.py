@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distributed according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+"""
+This module times the phases of each media file job (disk read, MD5, encoding,
+network send, server wait, lock waits, database access) and aggregates them
+into a per-batch report with percentiles per phase and the slowest files.
+The phases are traced for a sample of the files; the slowest files are ranked
+by the time spent on every file.
+
+A trace belongs to the thread that began it: span() and record() add to the
+trace of the current thread, if any, and always to the phase metrics.
+"""
+import threading, random, heapq, math
+from time import time
+from dataingestion.services import metrics
+
+# The fraction of the files whose phases are traced. A trace is held by its
+# queued job for the whole batch, so tracing every file of a large batch costs
+# more memory than the jobs themselves.
+sample_rate = 0.01
+# Durations kept per phase to estimate the percentiles.
+RESERVOIR_SIZE = 10000
+TOP_N = 20
+
+_local = threading.local()
+
+def init(trace_sample_rate=None):
+  global sample_rate
+  if trace_sample_rate not in (None, ""):
+    sample_rate = min(1.0, max(0.0, float(trace_sample_rate)))
+
+
+class Trace(object):
+  """
+  The time per phase spent on one file.
+  """
+  __slots__ = ("name", "phases")
+
+  def __init__(self, name=None):
+    self.name = name
+    self.phases = {}
+
+  def add(self, phase, seconds):
+    self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+  def merge(self, other, share=1.0):
+    """
+    Adds the phases of other, multiplied by share, to this trace.
+    """
+    for phase, seconds in other.phases.items():
+      self.add(phase, seconds * share)
+
+  def total(self):
+    return sum(self.phases.values())
+
+
+def begin(name=None, sampled=None):
+  """
+  Begins a trace in the current thread. Unless sampled is given, the trace is
+  kept with the probability sample_rate.
+  Returns: The Trace, or None if it is not sampled.
+  """
+  if sampled is None:
+    sampled = sample_rate >= 1.0 or random.random() < sample_rate
+  _local.trace = Trace(name) if sampled else None
+  return _local.trace
+
+def end():
+  """
+  Ends the trace of the current thread.
+  Returns: The Trace, or None if there is none.
+  """
+  trace = getattr(_local, "trace", None)
+  _local.trace = None
+  return trace
+
+def current():
+  return getattr(_local, "trace", None)
+
+def record(phase, seconds, histogram=None):
+  """
+  Adds seconds spent in phase to the current trace, and to histogram, which
+  is the phase metric by default.
+  """
+  if histogram is None:
+    metrics.phase_seconds.observe(seconds, phase=phase)
+  else:
+    histogram.observe(seconds)
+  trace = getattr(_local, "trace", None)
+  if trace is not None:
+    trace.add(phase, seconds)
+
+
+class span(object):
+  """
+  A context manager that records the duration of its block as phase.
+  """
+  def __init__(self, phase, histogram=None):
+    self.phase = phase
+    self.histogram = histogram
+
+  def __enter__(self):
+    self.start = time()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    record(self.phase, time() - self.start, self.histogram)
+    return False
+
+
+def acquire(lock, phase="lock_wait"):
+  """
+  Acquires lock, recording the wait as phase.
+  """
+  start = time()
+  lock.acquire()
+  record(phase, time() - start)
+
+
+class TraceReport(object):
+  """
+  Aggregates the traces of the files of a batch. The percentiles are
+  estimated from a uniform sample of at most RESERVOIR_SIZE durations per
+  phase, so the memory used does not grow with the batch. The slowest files
+  are ranked among all the files added, traced or not.
+  """
+  def __init__(self, batch_id=None, reservoir_size=RESERVOIR_SIZE,
+               top_n=TOP_N):
+    self.batch_id = batch_id
+    self.reservoir_size = reservoir_size
+    self.top_n = top_n
+    self.lock = threading.Lock()
+    self.files = 0
+    self.traced_files = 0
+    # phase: [count, sum, max, reservoir]
+    self.phases = {}
+    # A min-heap of (total, name, phases) of the slowest files, phases None
+    # for the files not traced.
+    self.slowest = []
+    self.random = random.Random()
+
+  def add(self, trace, name=None, seconds=None):
+    """
+    Adds a file that took seconds, by default the total of its trace, and its
+    trace if it is sampled.
+    """
+    if seconds is None:
+      if trace is None:
+        return
+      seconds = trace.total()
+    if trace is not None and name is None:
+      name = trace.name
+    self.lock.acquire()
+    try:
+      self.files += 1
+      item = (seconds, name,
+              dict(trace.phases) if trace is not None else None)
+      if len(self.slowest) < self.top_n:
+        heapq.heappush(self.slowest, item)
+      elif item[0] > self.slowest[0][0]:
+        heapq.heapreplace(self.slowest, item)
+      if trace is None:
+        return
+      self.traced_files += 1
+      for phase, duration in trace.phases.items():
+        entry = self.phases.get(phase)
+        if entry is None:
+          entry = self.phases[phase] = [0, 0.0, 0.0, []]
+        entry[0] += 1
+        entry[1] += duration
+        entry[2] = max(entry[2], duration)
+        reservoir = entry[3]
+        if len(reservoir) < self.reservoir_size:
+          reservoir.append(duration)
+        else:
+          index = self.random.randint(0, entry[0] - 1)
+          if index < self.reservoir_size:
+            reservoir[index] = duration
+    finally:
+      self.lock.release()
+
+  def report(self, top_n=None):
+    """
+    Returns: A dict with the batch_id, the numbers of files and of traced
+      files, the count, mean, p50, p90, p99 and max seconds per phase, and
+      the slowest files with their phases if they are traced.
+    """
+    self.lock.acquire()
+    try:
+      phases = {}
+      for phase, (count, total, maximum, reservoir) in self.phases.items():
+        durations = sorted(reservoir)
+        phases[phase] = dict(
+            count=count, mean=total / count, max=maximum,
+            p50=_percentile(durations, 50), p90=_percentile(durations, 90),
+            p99=_percentile(durations, 99))
+      slowest = sorted(self.slowest, reverse=True)[:top_n or self.top_n]
+      return dict(
+          batch_id=self.batch_id, files=self.files,
+          traced_files=self.traced_files,
+          sample_rate=sample_rate, phases=phases,
+          slowest=[dict(file=name, total=total, phases=file_phases)
+                   for total, name, file_phases in slowest])
+    finally:
+      self.lock.release()
+
+
+def _percentile(sorted_values, percent):
+  """
+  Returns: The nearest-rank percentile of the sorted values.
+  """
+  if not sorted_values:
+    return None
+  rank = int(math.ceil(percent / 100.0 * len(sorted_values))) - 1
+  return sorted_values[min(max(rank, 0), len(sorted_values) - 1)]
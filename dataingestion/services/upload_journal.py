@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distributed according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+"""
+This module keeps an append-only journal of the uploads confirmed by the
+server, one JSON object per line, written before the result is committed to
+the database. If the process dies in between, setup replays the journal into
+the database at the next start, so that a resumed batch does not upload
+those files again.
+
+Each line is flushed to the operating system when it is written, which
+survives the process being killed. It is synced to the disk at most every
+sync_seconds, or sync_seconds after it is written if no other line follows,
+which bounds what a system crash can lose.
+"""
+import os, json, threading, logging
+from datetime import datetime
+from time import time
+from dataingestion.services import model
+
+logger = logging.getLogger('iDigBioSvc.upload_journal')
+
+# 0 syncs every line.
+sync_seconds = 1.0
+
+_lock = threading.Lock()
+_file = None
+_last_sync = 0
+# Whether lines are written since the last sync, and the timer to sync them.
+_unsynced = False
+_timer = None
+
+def init(sync=None):
+  global sync_seconds
+  if sync not in (None, ""):
+    sync_seconds = max(0.0, float(sync))
+
+def setup(path):
+  """
+  Replays the journal at path into the database, which is set up, and opens
+  it empty for the uploads to come.
+  Returns: The count of the uploads replayed.
+  """
+  global _file, _last_sync
+  close()
+  count = 0
+  if os.path.exists(path):
+    count = replay(path)
+  _lock.acquire()
+  try:
+    _file = open(path, "wb")
+    _sync()
+    _last_sync = time()
+  finally:
+    _lock.release()
+  return count
+
+def read(path):
+  """
+  Returns: The entries of the journal at path. A last line cut short by a
+    crash is ignored.
+  """
+  entries = []
+  with open(path, "rb") as f:
+    for line in f:
+      try:
+        entries.append(json.loads(line))
+      except ValueError:
+        logger.warning("Ignored an incomplete journal line: {0!r}"
+                       .format(line))
+  return entries
+
+def replay(path):
+  """
+  Records the uploads of the journal at path in the database, and commits.
+  Returns: The count of the uploads replayed.
+  """
+  entries = read(path)
+  for entry in entries:
+    model.set_upload_result(entry["record_id"], entry["batch_id"],
+                            entry["content"], entry["file_url"])
+  if entries:
+    model.commit()
+    logger.info("Replayed {0} uploads from the journal {1}."
+                .format(len(entries), path))
+  return len(entries)
+
+def record(record_id, batch_id, file_url, file_md5, content):
+  """
+  Appends the upload of the image record with record_id to the journal.
+  Does nothing if the journal is not set up.
+  """
+  global _last_sync, _unsynced, _timer
+  line = json.dumps({
+      "record_id": record_id, "batch_id": batch_id, "file_url": file_url,
+      "file_md5": file_md5, "content": content,
+      "time": str(datetime.utcnow())}, sort_keys=True) + "\n"
+  _lock.acquire()
+  try:
+    if _file is None:
+      return
+    _file.write(line)
+    _file.flush()
+    now = time()
+    if now - _last_sync >= sync_seconds:
+      _sync()
+      _last_sync = now
+    else:
+      _unsynced = True
+      if _timer is None:
+        _timer = threading.Timer(sync_seconds - (now - _last_sync),
+                                 _timed_sync)
+        _timer.daemon = True
+        _timer.start()
+  finally:
+    _lock.release()
+
+def reset():
+  """
+  Empties the journal, once all the uploads it records are committed to the
+  database.
+  """
+  _lock.acquire()
+  try:
+    if _file is None:
+      return
+    _file.seek(0)
+    _file.truncate()
+    _sync()
+  finally:
+    _lock.release()
+
+def _sync():
+  global _unsynced
+  _file.flush()
+  os.fsync(_file.fileno())
+  _unsynced = False
+
+def _timed_sync():
+  """
+  Syncs the lines written since the last sync, if no record did.
+  """
+  global _last_sync, _timer
+  _lock.acquire()
+  try:
+    _timer = None
+    if _file is not None and _unsynced:
+      _sync()
+      _last_sync = time()
+  finally:
+    _lock.release()
+
+def close():
+  global _file, _timer
+  _lock.acquire()
+  try:
+    if _timer is not None:
+      _timer.cancel()
+      _timer = None
+    if _file is not None:
+      _sync()
+      _file.close()
+    _file = None
+  finally:
+    _lock.release()
@@ -1,5 +1,6 @@
-import os
+import os, tempfile, threading
 import ConfigParser
+from time import time
 
 #Fields in the configuration file.
 CONFIG_SECTION = 'iDigBio'
@@ -50,10 +51,38 @@ def get_user_config(name):
   global config
   return getattr(config, name)
 
+def get_user_config_bool(name, default=False):
+  """
+  Returns: The value for the name as a bool ("true", "yes", "on" or "1"),
+    or default if the name does not exist.
+  """
+  try:
+    value = get_user_config(name)
+  except AttributeError:
+    return default
+  return value.strip().lower() in ("true", "yes", "on", "1")
+
+def get_user_config_int(name, default=None):
+  """
+  Returns: The value for the name as an int, or default if the name does not
+    exist or is not an int.
+  """
+  try:
+    return int(get_user_config(name))
+  except (AttributeError, ValueError):
+    return default
+
 def set_user_config(name, value):
   global config
   setattr(config, name, value)
 
+def set_user_configs(values):
+  """
+  Sets all the name: value pairs of values, with one write of the file.
+  """
+  global config
+  config.update(values)
+
 def rm_user_config():
   global config
   if os.path.exists(config.config_file):
@@ -63,40 +92,106 @@ def rm_user_config():
 class UserConfig(object):
   """
   The class with the user config values.
+
+  The values are cached: the file is read again only if its modification
+  time, inode or size changed, which is checked at most every CHECK_INTERVAL
+  seconds. The file is replaced atomically on writes.
   """
+  CHECK_INTERVAL = 1.0
+  # Attributes of the object rather than config values.
+  _ATTRIBUTES = ("config", "config_file", "lock", "_stat_key", "_checked_at")
+
   def __init__(self, config_file):
     self.config = ConfigParser.ConfigParser()
     self.config.add_section(CONFIG_SECTION)
     self.config_file = config_file
+    self.lock = threading.RLock()
+    self._stat_key = None
+    self._checked_at = None
 
-  def reload(self):
-    if os.path.exists(self.config_file):
-      self.config.read(self.config_file)
+  def _file_key(self):
+    try:
+      st = os.stat(self.config_file)
+    except OSError:
+      return None
+    return (st.st_mtime, st.st_ino, st.st_size)
 
-    if not self.config.has_section(CONFIG_SECTION):
-      self.config.add_section(CONFIG_SECTION)
+  def reload(self):
+    """
+    Reads the file again if it changed since it was last read or written.
+    """
+    with self.lock:
+      self._checked_at = time()
+      key = self._file_key()
+      if key == self._stat_key:
+        return
+      config = ConfigParser.ConfigParser()
+      if key is not None:
+        config.read(self.config_file)
+      if not config.has_section(CONFIG_SECTION):
+        config.add_section(CONFIG_SECTION)
+      self.config = config
+      self._stat_key = key
+
+  def _refresh(self):
+    if (self._checked_at is None or
+        time() - self._checked_at >= self.CHECK_INTERVAL):
+      self.reload()
 
   def __getattr__(self, name):
-    self.reload()
-    try:
-      return self.config.get(CONFIG_SECTION, name)
-    except:
-      raise AttributeError
+    if name in UserConfig._ATTRIBUTES:
+      raise AttributeError(name)
+    with self.lock:
+      self._refresh()
+      try:
+        return self.config.get(CONFIG_SECTION, name)
+      except ConfigParser.Error:
+        raise AttributeError(name)
 
   def __setattr__(self, name, value):
-    if name == 'config' or name == 'config_file':
+    if name in UserConfig._ATTRIBUTES:
       self.__dict__[name] = value
       return
-
-    self.config.set(CONFIG_SECTION, name, value)
-    with open(self.config_file, 'wb') as f:
-      self.config.write(f)
+    self.update({name: value})
+
+  def update(self, values):
+    """
+    Sets the name: value pairs of values and writes the file once.
+    """
+    with self.lock:
+      self._refresh()
+      for name, value in values.items():
+        self.config.set(CONFIG_SECTION, name, value)
+      self._write()
+
+  def _write(self):
+    """
+    Writes the config to a temporary file then renames it over the file, so
+    that a reader never sees a partial file.
+    """
+    directory = os.path.dirname(os.path.abspath(self.config_file))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".user.conf.")
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        self.config.write(f)
+        f.flush()
+        os.fsync(f.fileno())
+      if os.name == 'nt' and os.path.exists(self.config_file):
+        # Windows does not rename over an existing file.
+        os.remove(self.config_file)
+      os.rename(temp_path, self.config_file)
+    except:
+      if os.path.exists(temp_path):
+        os.remove(temp_path)
+      raise
+    self._stat_key = self._file_key()
+    self._checked_at = time()
 
   # Check if the authentication check is disabled.
   def check_disabled(self):
-    self.reload()
-
-    if self.config.has_option(CONFIG_SECTION, DISABLE_CHECK):
-      return self.config.get(CONFIG_SECTION, DISABLE_CHECK)
-    else:
-      return False
+    with self.lock:
+      self._refresh()
+      if self.config.has_option(CONFIG_SECTION, DISABLE_CHECK):
+        return self.config.get(CONFIG_SECTION, DISABLE_CHECK)
+      else:
+        return False
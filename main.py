@@ -11,16 +11,17 @@ import logging.handlers
 from datetime import datetime
 import argparse
 import shutil
+import json
+import threading
 current_dir = os.path.abspath(os.getcwd())
 site.addsitedir(join(current_dir, "lib"))
 import appdirs
-import cherrypy
 import ConfigParser
-from cherrypy import engine
-from dataingestion.ui.ingestui import DataIngestionUI
-from dataingestion.services.service_rest import DataIngestionService
+# CherryPy and the web UI are imported by main only: the upload command does
+# not need them.
 import dataingestion.services.model
-from dataingestion.services import user_config
+import dataingestion.services.ingestion_manager
+from dataingestion.services import user_config, constants
 
 APP_NAME = 'iDigBio Data Ingestion Tool'
 APP_AUTHOR = 'iDigBio'
@@ -29,20 +30,27 @@ quiet_mode = False
 
 USER_CONFIG_FILENAME = 'user.conf'
 
+# Exit statuses of the upload command.
+EXIT_OK = 0
+EXIT_FAILURES = 1 # Some files or the CSV file failed to upload.
+# 2 is the status of bad arguments, from argparse.
+EXIT_INPUT_ERROR = 3 # The CSV file cannot be read or is malformed.
+EXIT_SERVER_ERROR = 4 # Authentication failed or the server is unavailable.
+
 logger = logging.getLogger("iDigBioSvc.main")
 
 def main(argv):
-  # Process configuration files and configure modules.
-  idigbio_conf_path = join(current_dir, 'etc', 'idigbio.conf')
-  config = ConfigParser.ConfigParser()
-  config.read(idigbio_conf_path)
-  api_endpoint = config.get('iDigBio', 'idigbio.api_endpoint')
-  worker_thread_count = config.get('iDigBio', 'idigbio.worker_thread_count')
+  if len(argv) > 1 and argv[1] == 'upload':
+    sys.exit(upload_main(argv[2:]))
+
+  import cherrypy
+  from cherrypy import engine
+  from dataingestion.ui.ingestui import DataIngestionUI
+  from dataingestion.services.service_rest import DataIngestionService
+
+  config = _init_services()
   disable_startup_service_check = config.get(
     'iDigBio', 'devmode_disable_startup_service_check')
-  
-  dataingestion.services.api_client.init(api_endpoint)
-  dataingestion.services.ingestion_manager.init(worker_thread_count)
   cherrypy.config.update(join(current_dir, 'etc', 'http.conf'))
   
   engine_conf_path = join(current_dir, 'etc', 'engine.conf')
@@ -53,10 +61,16 @@ def main(argv):
             config=engine_conf_path)
   
   # Process command-line arguments:
-  parser = argparse.ArgumentParser()
+  parser = argparse.ArgumentParser(
+      epilog="Run \"main.py upload --help\" for the upload command without "
+      "the web UI.")
   parser.add_argument("--newdb", action="store_true", help='create a new db file')
   parser.add_argument("-d", "--debug", action="store_true")
   parser.add_argument("-q", "--quiet", action="store_true")
+  parser.add_argument("--profile", nargs="?", const="", metavar="DIR",
+                      help="profile the threads of each upload task and write "
+                      "the profiles to DIR, by default the profiles folder "
+                      "next to the log file")
   args = parser.parse_args()
 
   if args.debug:
@@ -75,12 +89,92 @@ def main(argv):
   else:
     quiet_mode = False
 
-  # Configure the logging mechanisms
+  log_folder = _setup_logging(log_level)
+
+  if args.profile is not None:
+    profile_dir = args.profile or join(log_folder, "profiles")
+    dataingestion.services.profiling.init(profile_dir)
+    print "Profiles folder:", profile_dir
+    
+  data_folder, db_file, user_config_path = _setup_data(args.newdb)
+  user_config.set_user_config(
+      'devmode_disable_startup_service_check', disable_startup_service_check)
+  
+  # Set up/start server.
+  if hasattr(engine, "signal_handler"):
+    engine.signal_handler.subscribe()
+  if hasattr(engine, "console_control_handler"):
+    engine.console_control_handler.subscribe()
+  cherrypy.log("Starting...", "main")
+
+  atexit.register(
+    _logout_user_if_configured, user_config_path, data_folder, db_file)
+
+  engine.start()
+  if not debug_mode and not quiet_mode:
+    # In a proper run, the text written here will be the only text output
+    # the end-user sees: Keep it short and simple.
+    print("Starting the iDigBio Data Ingestion Tool...")
+    try:
+      import webbrowser
+      webbrowser.open(
+          "http://127.0.0.1:{0}".format(cherrypy.config['server.socket_port']))
+      logger.info("Webbrowser is opened.")
+    except ImportError:
+      # Gracefully fall back
+      print("Open http://127.0.0.1:{0} in your webbrowser.".format(
+          cherrypy.config['server.socket_port']))
+    print("Close this window or hit ctrl+c to stop the local iDigBio Data "
+          "Ingestion Tool.")
+  engine.block()
+
+def _init_services():
+  """
+  Configures the service modules with idigbio.conf.
+  Returns: The ConfigParser of idigbio.conf.
+  """
+  idigbio_conf_path = join(current_dir, 'etc', 'idigbio.conf')
+  config = ConfigParser.ConfigParser()
+  config.read(idigbio_conf_path)
+  api_endpoint = config.get('iDigBio', 'idigbio.api_endpoint')
+  worker_thread_count = config.get('iDigBio', 'idigbio.worker_thread_count')
+
+  dataingestion.services.api_client.init(
+      api_endpoint,
+      _get_option(config, 'idigbio.chunked_upload_threshold_mb'),
+      _get_option(config, 'idigbio.chunk_size_mb'),
+      _get_option(config, 'idigbio.chunk_parallelism'),
+      _get_option(config, 'idigbio.csv_gzip'),
+      _get_option(config, 'idigbio.breaker_failures'),
+      _get_option(config, 'idigbio.breaker_reset_seconds'),
+      _get_option(config, 'idigbio.server_outage_seconds'),
+      _get_option(config, 'idigbio.timeout_min_seconds'),
+      _get_option(config, 'idigbio.timeout_max_seconds'),
+      _get_option(config, 'idigbio.read_ahead_blocks'))
+  dataingestion.services.ingestion_manager.init(
+      worker_thread_count, _get_option(config, 'idigbio.md5_precheck_chunk'),
+      _get_option(config, 'idigbio.batch_max_files'),
+      _get_option(config, 'idigbio.batch_max_mb'),
+      _get_option(config, 'idigbio.upload_engine'),
+      _get_option(config, 'idigbio.async_concurrency'))
+  dataingestion.services.tracing.init(
+      _get_option(config, 'idigbio.trace_sample_rate'))
+  dataingestion.services.query_stats.init(
+      _get_option(config, 'idigbio.slow_query_ms'))
+  dataingestion.services.upload_journal.init(
+      _get_option(config, 'idigbio.journal_sync_seconds'))
+  return config
+
+def _setup_logging(log_level, stream=None):
+  """
+  Logs to the console, at log_level, and to the log file.
+  Returns: The log folder.
+  """
   # Default log level to DEBUG and filter the logs for console output.
   logging.getLogger().setLevel(logging.DEBUG)
   logging.getLogger("cherrypy").setLevel(logging.INFO) # cherrypy must be forced
   svc_log = logging.getLogger('iDigBioSvc')
-  handler = logging.StreamHandler()
+  handler = logging.StreamHandler(stream)
   handler.setFormatter(
       logging.Formatter(
           '%(asctime)s %(thread)d %(name)s %(levelname)s - %(message)s'))
@@ -99,69 +193,207 @@ def main(argv):
   handler.setLevel(logging.DEBUG)
   handler.doRollover()
   svc_log.addHandler(handler)
-    
-  # Set up the DB.
+  return log_folder
+
+def _setup_data(newdb=False):
+  """
+  Sets up the DB and the user config in the data folder.
+  Returns: (data folder, DB file, user config file).
+  """
   data_folder = appdirs.user_data_dir(APP_NAME, APP_AUTHOR)
   if not exists(data_folder):
     os.makedirs(data_folder)
   db_file = join(data_folder, "idigbio.ingest.db")
-  if args.newdb:
+  if newdb:
     _move_db(data_folder, db_file)
     logger.info("Creating a new DB file.")
 
   logger.info("Use DB file: {0}".format(db_file))
   dataingestion.services.model.setup(db_file)
+  dataingestion.services.upload_journal.setup(db_file + ".journal")
   
   # Set up the user config.
   user_config_path = join(data_folder, USER_CONFIG_FILENAME)
   user_config.setup(user_config_path)
-  user_config.set_user_config(
-      'devmode_disable_startup_service_check', disable_startup_service_check)
-  
-  # Set up/start server.
-  if hasattr(engine, "signal_handler"):
-    engine.signal_handler.subscribe()
-  if hasattr(engine, "console_control_handler"):
-    engine.console_control_handler.subscribe()
-  cherrypy.log("Starting...", "main")
+  return data_folder, db_file, user_config_path
 
-  atexit.register(
-    _logout_user_if_configured, user_config_path, data_folder, db_file)
+def upload_main(argv):
+  """
+  The upload command: uploads the media of a CSV file without the web UI,
+  printing the progress to stdout as one JSON object per line.
+  Returns: The exit status.
+  """
+  parser = argparse.ArgumentParser(
+      prog="main.py upload",
+      description="Uploads the media of a CSV file without the web UI. The "
+      "progress is printed as JSON lines. Exit status: 0 if all the files "
+      "are uploaded, 1 if some failed, 2 on bad arguments, 3 on a bad CSV "
+      "file, 4 if the login or the server failed.")
+  parser.add_argument("--csv", help="the CSV file of the media to upload")
+  parser.add_argument("--license", choices=sorted(constants.IMAGE_LICENSES),
+                      help="the license of the media, required with --csv")
+  parser.add_argument("--resume", action="store_true",
+                      help="resume the last batch if it is unfinished and of "
+                      "the same CSV file. Files already uploaded are skipped "
+                      "in any case.")
+  parser.add_argument("--accountuuid", help="the account to upload with, "
+                      "saved like a login. Default: the last login.")
+  parser.add_argument("--apikey")
+  parser.add_argument("--interval", type=float, default=1.0,
+                      help="seconds between the progress lines")
+  parser.add_argument("-d", "--debug", action="store_true",
+                      help="log debug messages to stderr")
+  args = parser.parse_args(argv)
+  if not args.csv and not args.resume:
+    parser.error("--csv or --resume is required.")
+  if args.csv and not args.license:
+    parser.error("--license is required with --csv.")
+  if bool(args.accountuuid) != bool(args.apikey):
+    parser.error("--accountuuid and --apikey go together.")
 
-  engine.start()
-  if not debug_mode and not quiet_mode:
-    # In a proper run, the text written here will be the only text output
-    # the end-user sees: Keep it short and simple.
-    print("Starting the iDigBio Data Ingestion Tool...")
+  # stdout is for the progress only: the modules print to stderr instead.
+  out = sys.stdout
+  sys.stdout = sys.stderr
+  def emit(event, **fields):
+    fields["event"] = event
+    out.write(json.dumps(fields, sort_keys=True) + "\n")
+    out.flush()
+
+  _init_services()
+  _setup_logging(logging.DEBUG if args.debug else logging.WARNING,
+                 sys.stderr)
+  _setup_data()
+
+  values = _upload_values(args)
+  if values is False:
+    emit("result", status="nothing_to_resume")
+    return EXIT_OK
+  if values and not os.path.isfile(values[user_config.CSV_PATH]):
+    emit("error", message="CSV file {0} does not exist.".format(args.csv))
+    return EXIT_INPUT_ERROR
+
+  api_client = dataingestion.services.api_client
+  try:
+    if args.accountuuid:
+      user_config.set_user_configs(
+          {'accountuuid': args.accountuuid, 'apikey': args.apikey})
+    logged_in = api_client.authenticate(
+        user_config.get_user_config('accountuuid'),
+        user_config.get_user_config('apikey'))
+  except AttributeError:
+    emit("error", message="No login: give --accountuuid and --apikey.")
+    return EXIT_SERVER_ERROR
+  except api_client.ClientException as ex:
+    emit("error", message="Login failed: {0}".format(ex))
+    return EXIT_SERVER_ERROR
+  if not logged_in:
+    emit("error", message="The account UUID and API key are incorrect.")
+    return EXIT_SERVER_ERROR
+
+  return _run_upload(values, args.interval, emit)
+
+def _upload_values(args):
+  """
+  Returns: The values of upload_task for args: None to resume the last
+    batch, or False if there is nothing to resume.
+  """
+  last_batch = dataingestion.services.model.load_last_batch()
+  if (args.resume and last_batch is not None and
+      last_batch.finish_time is None and
+      (not args.csv or os.path.realpath(args.csv) ==
+       os.path.realpath(last_batch.CSVfilePath))):
+    return None
+  if not args.csv:
+    return False
+  return {user_config.CSV_PATH: os.path.abspath(args.csv),
+          user_config.RIGHTS_LICENSE: args.license}
+
+def _run_upload(values, interval, emit):
+  """
+  Runs the upload task, emitting its progress every interval seconds.
+  Returns: The exit status.
+  """
+  manager = dataingestion.services.ingestion_manager
+  errors = []
+  def run():
     try:
-      import webbrowser
-      webbrowser.open(
-          "http://127.0.0.1:{0}".format(cherrypy.config['server.socket_port']))
-      logger.info("Webbrowser is opened.")
-    except ImportError:
-      # Gracefully fall back
-      print("Open http://127.0.0.1:{0} in your webbrowser.".format(
-          cherrypy.config['server.socket_port']))
-    print("Close this window or hit ctrl+c to stop the local iDigBio Data "
-          "Ingestion Tool.")
-  engine.block()
+      manager.upload_task(values)
+    except Exception as ex:
+      logger.exception("The upload task failed.")
+      errors.append(ex)
+
+  thread = threading.Thread(target=run, name="upload")
+  thread.start()
+  try:
+    while thread.isAlive():
+      thread.join(interval)
+      if manager.ongoing_upload_task is not None:
+        emit("progress", **_progress_fields(manager))
+  except KeyboardInterrupt:
+    for each in threading.enumerate():
+      each.abort = True
+    emit("error", message="Interrupted.")
+    return EXIT_FAILURES
+
+  if manager.ongoing_upload_task is None:
+    emit("error", message=str(errors[0]) if errors else "No upload task.")
+    return EXIT_FAILURES
+  fields = _progress_fields(manager)
+  batch = manager.ongoing_upload_task.batch
+  fields["batch_id"] = batch.id if batch else None
+  if errors:
+    fields["message"] = str(errors[0])
+  if fields["input_csv_error"]:
+    status = EXIT_INPUT_ERROR
+  elif (fields["fatal_server_error"] or
+        isinstance(errors[0] if errors else None,
+                   (dataingestion.services.api_client.ClientException,
+                    dataingestion.services.api_client.ServerException))):
+    status = EXIT_SERVER_ERROR
+  elif errors or fields["fails"] or not fields["csv_uploaded"]:
+    status = EXIT_FAILURES
+  else:
+    status = EXIT_OK
+  fields["exit_status"] = status
+  emit("result", **fields)
+  return status
+
+def _progress_fields(manager):
+  (fatal_server_error, input_csv_error, total, skips, successes, fails,
+   csv_uploaded, finished) = manager.get_progress()
+  bytes_done, bytes_total, rate, eta = manager.get_byte_progress()
+  return dict(
+      total=total, skips=skips, successes=successes, fails=fails,
+      csv_uploaded=csv_uploaded, finished=finished,
+      fatal_server_error=fatal_server_error, input_csv_error=input_csv_error,
+      bytes_done=bytes_done, bytes_total=bytes_total, bytes_per_second=rate,
+      eta_seconds=eta)
+
+def _get_option(config, name, default=None):
+  """Returns an optional option of the iDigBio section in idigbio.conf."""
+  if config.has_option('iDigBio', name):
+    return config.get('iDigBio', name)
+  return default
 
 def _move_db(data_folder, db_file):
   if exists(db_file):
     dataingestion.services.model.close()  
+    dataingestion.services.upload_journal.close()
+    # The commits still in the write-ahead log would be lost otherwise.
+    dataingestion.services.model.checkpoint(db_file)
     move_to = join(
         data_folder, "idigbio.ingest." + datetime.now().strftime(
             "%Y-%b-%d_%H-%M-%S") + ".db")
     shutil.move(db_file, move_to)
-    cherrypy.log.error("Moved the old DB to {0}".format(move_to), "main")
+    # The uploads not yet replayed belong to the old DB, as does the log if
+    # the checkpoint left it.
+    for suffix in (".journal", "-wal", "-shm"):
+      if exists(db_file + suffix):
+        shutil.move(db_file + suffix, move_to + suffix)
+    logger.warning("Moved the old DB to {0}".format(move_to))
 
 def _logout_user_if_configured(user_config_path, data_folder, db_file):
-  try:
-    logout = dataingestion.services.user_config.get_user_config(
-        'logoutafterexit')
-  except AttributeError:
-    logout = 'false'
-  if logout == 'true':
+  if user_config.get_user_config_bool('logoutafterexit'):
     _move_db(data_folder, db_file)
     os.remove(user_config_path)
 
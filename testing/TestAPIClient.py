@@ -7,7 +7,8 @@
 
 # This preprocess is to set up the paths to make sure the current module
 # referencing in the files to be tested.
-import sys, os, unittest, tempfile, datetime, urllib2, subprocess
+import sys, os, unittest, tempfile, datetime, urllib2, subprocess, json
+import gzip, hashlib
 from threading import Thread
 rootdir = os.path.dirname(os.getcwd())
 sys.path.append(rootdir)
@@ -140,9 +141,65 @@ class TestAPIClient(unittest.TestCase):
     api_client._post_csv(name)
     print "Post csv test done."
 
+    with open(name, "rb") as f:
+      content = f.read()
+    gz_name = name + ".gz"
+    gz = gzip.open(gz_name, "wb")
+    gz.write(content)
+    gz.close()
+    result = json.loads(api_client._post_csv(gz_name, "gzip"))
+    self.assertEqual(result["file_md5"], hashlib.md5(content).hexdigest())
+    os.remove(gz_name)
+    print "Post gzip csv test done."
+
+  def _testPostImageChunked(self):
+    '''Test Connection.post_image_chunked.'''
+    api_client.chunk_size = 16 * 1024 # image1.jpg is sent in 9 parts.
+    conn = api_client.Connection()
+    result = json.loads(conn.post_image_chunked(self._filepath1, "ABC5"))
+    self.assertEqual(result["file_md5"], api_client._file_md5(self._filepath1))
+    print "Post image chunked test1 done."
+
+    # Resume: parts already received by the server are not sent again.
+    session = api_client._open_upload_session(
+        self._filepath2, "ABC6", api_client._file_md5(self._filepath2),
+        api_client.chunk_size)
+    api_client._post_part(str(session["session_id"]), self._filepath2, 0,
+                          api_client.chunk_size)
+    session = api_client._open_upload_session(
+        self._filepath2, "ABC6", api_client._file_md5(self._filepath2),
+        api_client.chunk_size)
+    self.assertEqual(session["parts"].keys(), ["0"])
+    result = json.loads(conn.post_image_chunked(self._filepath2, "ABC6"))
+    self.assertEqual(result["file_md5"], api_client._file_md5(self._filepath2))
+    print "Post image chunked test2 done."
+
+  def _testCheckExisting(self):
+    '''Test _check_existing.'''
+    md5_1 = api_client._file_md5(self._filepath1)
+    api_client._post_image(self._filepath1, "ABC7")
+    existing = api_client._check_existing([md5_1, "0" * 32])
+    self.assertEqual(existing.keys(), [md5_1])
+    self.assertEqual(existing[md5_1]["file_md5"], md5_1)
+    print "Check existing test done."
+
+  def _testPostImagesBatch(self):
+    '''Test _post_images_batch.'''
+    results = api_client._post_images_batch(
+        [(self._filepath1, "ABC8"), (self._filepath2, "ABC9")])
+    self.assertEqual(len(results), 2)
+    self.assertEqual(json.loads(results[0])["file_md5"],
+                     api_client._file_md5(self._filepath1))
+    self.assertEqual(json.loads(results[1])["file_md5"],
+                     api_client._file_md5(self._filepath2))
+    print "Post images batch test done."
+
   def runTest(self):
     self._testAuthenticate()
     self._testPostImage()
+    self._testPostImageChunked()
+    self._testCheckExisting()
+    self._testPostImagesBatch()
     self._testPostCsv()
 
 if __name__ == '__main__':
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distribted according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+# This preprocess is to set up the paths to make sure the current module
+# referencing in the files to be tested.
+import sys, os, unittest, socket, threading
+from time import time
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+rootdir = os.path.dirname(os.getcwd())
+sys.path.append(rootdir)
+sys.path.append(os.path.join(rootdir, 'lib'))
+
+from dataingestion.services import async_upload
+from dataingestion.services.api_client import ClientException, RequestTimeout
+
+
+class _Handler(BaseHTTPRequestHandler):
+  """Answers the body it received, or the status in the path."""
+  def do_POST(self):
+    body = self.rfile.read(int(self.headers["Content-Length"]))
+    status = int(self.path.strip("/") or 200)
+    self.send_response(status)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+class _Server(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+
+class TestAsyncUpload(unittest.TestCase):
+  def setUp(self):
+    self.server = _Server(("127.0.0.1", 0), _Handler)
+    self.url = "http://127.0.0.1:%d/" % self.server.server_address[1]
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.start()
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    self.thread.join()
+
+  def _run(self, loop, requests, seconds=10):
+    results = {}
+    def _done(request, result):
+      results[request] = result
+    for request in requests:
+      request.on_done = _done
+      loop.start(request)
+    deadline = time() + seconds
+    while len(loop) and time() < deadline:
+      loop.poll(0.05)
+    return [results.get(request) for request in requests]
+
+  def _request(self, body, path="", timeout=None):
+    return async_upload.AsyncRequest(
+        self.url + path, {"Content-Length": str(len(body))}, [body],
+        timeout or RequestTimeout(3, 3, 3), None)
+
+  def _testRequests(self, use_select):
+    loop = async_upload.EventLoop()
+    if use_select:
+      loop.poller.poll = None
+    bodies = ["x" * size for size in (0, 10, 100000, 1000000)]
+    results = self._run(loop, [self._request(body) for body in bodies]
+                              + [self._request("a", "503")])
+    self.assertEqual(results[:-1], bodies)
+    self.assertTrue(isinstance(results[-1], ClientException))
+    self.assertEqual(results[-1].http_status, 503)
+
+  def _testErrors(self):
+    closed = socket.socket()
+    closed.bind(("127.0.0.1", 0))
+    port = closed.getsockname()[1]
+    closed.close()
+    silent = socket.socket()
+    silent.bind(("127.0.0.1", 0))
+    silent.listen(1)
+    try:
+      refused = async_upload.AsyncRequest(
+          "http://127.0.0.1:%d/" % port, {}, [""], RequestTimeout(3, 3, 3),
+          None)
+      no_response = async_upload.AsyncRequest(
+          "http://127.0.0.1:%d/" % silent.getsockname()[1], {}, [""],
+          RequestTimeout(3, 0.3, 3), None)
+      results = self._run(async_upload.EventLoop(), [refused, no_response])
+    finally:
+      silent.close()
+    for result in results:
+      self.assertTrue(isinstance(result, ClientException))
+      self.assertEqual(result.http_status, None)
+    self.assertTrue("timed out (response)" in results[1].reason)
+
+  def _testBodyError(self):
+    def _body():
+      yield "a"
+      raise IOError("Read failed.")
+    request = self._request("ab")
+    request.body = _body()
+    result, = self._run(async_upload.EventLoop(), [request])
+    self.assertTrue(isinstance(result, ClientException))
+    self.assertTrue("Read failed." in result.reason)
+
+  def _testClose(self):
+    silent = socket.socket()
+    silent.bind(("127.0.0.1", 0))
+    silent.listen(1)
+    results = []
+    try:
+      loop = async_upload.EventLoop()
+      loop.start(async_upload.AsyncRequest(
+          "http://127.0.0.1:%d/" % silent.getsockname()[1], {}, [""],
+          RequestTimeout(3, 3, 3), lambda request, result:
+              results.append(result)))
+      loop.poll(0.1)
+      loop.close()
+    finally:
+      silent.close()
+    self.assertEqual(len(loop), 0)
+    self.assertEqual(len(results), 1)
+    self.assertTrue(isinstance(results[0], ClientException))
+
+  def _testParse(self):
+    self.assertEqual(async_upload._parse_response(
+        "HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+        "3\r\nabc\r\n2;x=y\r\nde\r\n0\r\n\r\n"), (
+        200, {"transfer-encoding": "chunked"}, "abcde"))
+    self.assertFalse(async_upload._response_complete(
+        ["HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\nab"]))
+    self.assertTrue(async_upload._response_complete(
+        ["HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\nab", "cd"]))
+
+  def runTest(self):
+    self._testRequests(False)
+    self._testRequests(True)
+    self._testErrors()
+    self._testBodyError()
+    self._testClose()
+    self._testParse()
+
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distribted according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+# This preprocess is to set up the paths to make sure the current module
+# referencing in the files to be tested.
+import sys, os, unittest, tempfile
+rootdir = os.path.dirname(os.getcwd())
+sys.path.append(rootdir)
+sys.path.append(os.path.join(rootdir, 'lib'))
+
+from dataingestion.services import ingestion_manager, model
+from dataingestion.services.ingestion_manager import InputCSVException
+
+
+class TestCSVInput(unittest.TestCase):
+  def _testRowMapper(self):
+    mapper = model.RowMapper(["dwc:note", "idigbio:MediaGUID",
+                              "idigbio:OriginalFileName",
+                              "idigbio:SpecimenRecordUUID", "dwc:other"])
+    self.assertEqual(mapper.map(["n", "guid", "/a.jpg", "1 2", "o"]),
+                     ("/a.jpg", "guid", "12",
+                      {"dwc:note": "n", "dwc:other": "o"}))
+    # The identifying columns are optional.
+    self.assertEqual(model.RowMapper(["dwc:note"]).map(["n"]),
+                     ("", "", "", {"dwc:note": "n"}))
+
+  def _validate(self, content):
+    fd, path = tempfile.mkstemp(suffix=".csv")
+    try:
+      os.write(fd, content)
+      os.close(fd)
+      ingestion_manager._validate_csv(path)
+    finally:
+      os.remove(path)
+
+  def _testValidate(self):
+    self._validate('"idigbio:OriginalFileName","dwc:note"\n'
+                   '"/a.jpg","a, b"\n"/b.jpg",""\n')
+    self._validate('')
+    try:
+      self._validate('"idigbio:OriginalFileName","dwc:note"\n'
+                     '"/a.jpg"\n"/b.jpg","x"\n"/c.jpg","a ""b"""\n'
+                     '"/d.jpg","x","y"\n')
+      self.fail("InputCSVException not raised.")
+    except InputCSVException as ex:
+      # All the malformed rows are reported.
+      self.assertTrue(str(ex).startswith("Input CSV File weird. 3 rows"))
+      self.assertEqual(ex.reason.splitlines(), [
+          "Line 2: 1 columns instead of 2.",
+          "Line 4: a field contains a double quotation mark (\").",
+          "Line 5: 3 columns instead of 2."])
+
+  def runTest(self):
+    self._testRowMapper()
+    self._testValidate()
+
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distribted according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+# This preprocess is to set up the paths to make sure the current module
+# referencing in the files to be tested.
+import sys, os, unittest, tempfile, shutil, json, hashlib, gzip, csv
+from StringIO import StringIO
+rootdir = os.path.dirname(os.getcwd())
+sys.path.append(rootdir)
+sys.path.append(os.path.join(rootdir, 'lib'))
+
+from dataingestion.services import model, ingestion_manager, api_client
+
+
+class _Connection(object):
+  """
+  Answers the MD5 of the CSV file it receives, decoded if decode_gzip is True.
+  Otherwise a gzip file is stored as it is.
+  """
+  attempts = 1
+
+  def __init__(self, decode_gzip=False):
+    self.decode_gzip = decode_gzip
+    self.encodings = []
+
+  def post_csv_stream(self, stream, filename, content_encoding=None):
+    stream.seek(0)
+    body = stream.read()
+    self.encodings.append(content_encoding)
+    result = {}
+    if content_encoding == "gzip" and self.decode_gzip:
+      body = gzip.GzipFile(fileobj=StringIO(body)).read()
+      result["content_encoding"] = "gzip"
+    result["file_md5"] = hashlib.md5(body).hexdigest()
+    return json.dumps(result)
+
+
+class TestCSVUpload(unittest.TestCase):
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    model.setup(os.path.join(self._dir, "idigbio.ingest_test.db"))
+    csv_path = os.path.join(self._dir, "batch.csv")
+    with open(csv_path, "wb") as f:
+      f.write("idigbio:OriginalFileName\n")
+    self._batch = model.add_batch(csv_path, "account", "CC0", "url", "logo")
+    model.commit()
+    self._csv_gzip = api_client.csv_gzip
+    api_client.csv_gzip = False
+    ingestion_manager.ongoing_upload_task = ingestion_manager.BatchUploadTask()
+    self._spool_max_size = ingestion_manager.CSV_SPOOL_MAX_SIZE
+
+  def tearDown(self):
+    ingestion_manager.CSV_SPOOL_MAX_SIZE = self._spool_max_size
+    api_client.csv_gzip = self._csv_gzip
+    model.close()
+    shutil.rmtree(self._dir)
+
+  def _csvUploaded(self):
+    reader = model.read_session()
+    try:
+      return reader.query(model.UploadBatch.CSVUploaded).filter_by(
+          id=self._batch.id).scalar()
+    finally:
+      reader.close()
+
+  def _addImages(self, count):
+    for index in xrange(count):
+      path = os.path.join(self._dir, "image%d.jpg" % index)
+      with open(path, "wb") as f:
+        f.write("jpeg %d" % index)
+      model.add_image(self._batch, [path], ["idigbio:OriginalFileName"])
+    model.commit()
+
+  def _expectedCSV(self):
+    """The CSV file made from all the rows at once."""
+    buf = StringIO()
+    writer = csv.writer(buf, delimiter=',', quotechar='"',
+                        quoting=csv.QUOTE_MINIMAL)
+    writer.writerow(model.get_batch_details_fieldnames())
+    for row in model.get_unuploaded_information():
+      writer.writerow(row)
+    return buf.getvalue()
+
+  def _checkCSVTempFile(self, rolled):
+    expected = self._expectedCSV()
+    f, csv_md5, gzip_md5 = ingestion_manager._make_csvtempfile()
+    try:
+      self.assertEqual(f._rolled, rolled)
+      f.seek(0)
+      self.assertEqual(f.read(), expected)
+      self.assertEqual(csv_md5, hashlib.md5(expected).hexdigest())
+      self.assertEqual(gzip_md5, None)
+    finally:
+      f.close()
+    f, csv_md5, gzip_md5 = ingestion_manager._make_csvtempfile(compress=True)
+    try:
+      f.seek(0)
+      body = f.read()
+      self.assertEqual(gzip.GzipFile(fileobj=StringIO(body)).read(), expected)
+      self.assertEqual(csv_md5, hashlib.md5(expected).hexdigest())
+      self.assertEqual(gzip_md5, hashlib.md5(body).hexdigest())
+    finally:
+      f.close()
+
+  def _testCSVTempFile(self):
+    self._addImages(50)
+    self._checkCSVTempFile(rolled=False)
+    # Written to the disk past CSV_SPOOL_MAX_SIZE.
+    ingestion_manager.CSV_SPOOL_MAX_SIZE = 1024
+    self._checkCSVTempFile(rolled=True)
+
+  def _testCSVUploadedCommitted(self):
+    ingestion_manager._upload_csv(_Connection())
+    # As the upload task does when a file failed: the batch is not finished.
+    model.remove_session()
+    self.assertTrue(self._csvUploaded())
+
+  def _testGzip(self):
+    api_client.csv_gzip = True
+    conn = _Connection(decode_gzip=True)
+    ingestion_manager._upload_csv(conn)
+    self.assertEqual(conn.encodings, ["gzip"])
+    # A server that ignores the encoding stores the gzip file: the CSV file is
+    # sent again uncompressed, as are the next ones.
+    conn = _Connection()
+    ingestion_manager._upload_csv(conn)
+    self.assertEqual(conn.encodings, ["gzip", None])
+    self.assertFalse(api_client.csv_gzip)
+
+  def runTest(self):
+    self._testCSVTempFile()
+    self._testCSVUploadedCommitted()
+    self._testGzip()
+
+
+if __name__ == '__main__':
+   unittest.main()
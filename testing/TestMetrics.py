@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distribted according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+# This preprocess is to set up the paths to make sure the current module
+# referencing in the files to be tested.
+import sys, os, unittest
+rootdir = os.path.dirname(os.getcwd())
+sys.path.append(rootdir)
+sys.path.append(os.path.join(rootdir, 'lib'))
+
+from dataingestion.services import metrics
+
+
+class TestMetrics(unittest.TestCase):
+  def _testCounter(self):
+    counter = metrics.Counter("test_requests_total", "Test requests.")
+    counter.inc(cause="http_503")
+    counter.inc(2, cause="http_503")
+    counter.inc(cause='a "quoted"\nvalue')
+    self.assertEqual(counter.get(cause="http_503"), 3)
+    text = counter.render()
+    self.assertTrue("# TYPE test_requests_total counter" in text)
+    self.assertTrue('test_requests_total{cause="http_503"} 3.0' in text)
+    self.assertTrue(
+        'test_requests_total{cause="a \\"quoted\\"\\nvalue"} 1.0' in text)
+
+  def _testGauge(self):
+    gauge = metrics.Gauge("test_depth", "Test depth.")
+    gauge.inc()
+    gauge.dec()
+    gauge.set_function(lambda: 5, queue="object")
+    text = gauge.render()
+    self.assertTrue("test_depth 0.0" in text)
+    self.assertTrue('test_depth{queue="object"} 5.0' in text)
+
+  def _testHistogram(self):
+    histogram = metrics.Histogram("test_seconds", "Test latency.",
+                                  buckets=(0.1, 1))
+    histogram.observe(0.05, phase="send")
+    histogram.observe(0.5, phase="send")
+    histogram.observe(2, phase="send")
+    with histogram.time(phase="hash"):
+      pass
+    text = histogram.render()
+    self.assertTrue('test_seconds_bucket{phase="send",le="0.1"} 1' in text)
+    self.assertTrue('test_seconds_bucket{phase="send",le="1.0"} 2' in text)
+    self.assertTrue('test_seconds_bucket{phase="send",le="+Inf"} 3' in text)
+    self.assertTrue('test_seconds_sum{phase="send"} 2.55' in text)
+    self.assertTrue('test_seconds_count{phase="send"} 3' in text)
+    self.assertEqual(histogram.get_count(phase="hash"), 1)
+    self.assertTrue(metrics.render().endswith("\n"))
+
+  def runTest(self):
+    self._testCounter()
+    self._testGauge()
+    self._testHistogram()
+
+
+if __name__ == '__main__':
+   unittest.main()
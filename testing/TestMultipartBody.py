@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distribted according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+# This preprocess is to set up the paths to make sure the current module
+# referencing in the files to be tested.
+import sys, os, unittest, socket, tempfile, threading
+from StringIO import StringIO
+rootdir = os.path.dirname(os.getcwd())
+sys.path.append(rootdir)
+sys.path.append(os.path.join(rootdir, 'lib'))
+
+from poster.encode import multipart_encode, MultipartParam
+from dataingestion.services.api_client import MultipartBody
+
+
+class TestMultipartBody(unittest.TestCase):
+  def setUp(self):
+    self.file = tempfile.TemporaryFile()
+    self.content = os.urandom(3 * MultipartBody.BLOCK_SIZE + 123)
+    self.file.write(self.content)
+    self.file.flush()
+
+  def tearDown(self):
+    self.file.close()
+
+  def _params(self):
+    return [("file", self.file), ("filereference", "ref"),
+            MultipartParam("csv", filename="a.csv", filetype="text/csv",
+                           fileobj=StringIO("a,b\r\n"), filesize=5)]
+
+  def _expected(self):
+    datagen, headers = multipart_encode(self._params(), boundary="b0undary")
+    datagen.reset()
+    return "".join(datagen), headers
+
+  def _testIterate(self, read_ahead):
+    expected, headers = self._expected()
+    calls = []
+    body = MultipartBody(self._params(), boundary="b0undary",
+                         cb=lambda param, current, total: calls.append(
+                             (current, total)), read_ahead=read_ahead)
+    self.assertEqual(body.headers, headers)
+    self.assertEqual(body.total, len(expected))
+    self.assertEqual("".join(body), expected)
+    self.assertEqual(calls[-1], (len(expected), len(expected)))
+    # Sent again after a reset.
+    body.reset()
+    self.assertEqual("".join(body), expected)
+    body.close()
+
+  def _testSendTo(self, read_ahead):
+    expected, _junk = self._expected()
+    body = MultipartBody(self._params(), boundary="b0undary",
+                         read_ahead=read_ahead)
+    sender, receiver = socket.socketpair()
+    received = []
+    def _receive():
+      while True:
+        data = receiver.recv(65536)
+        if not data:
+          break
+        received.append(data)
+    thread = threading.Thread(target=_receive)
+    thread.start()
+    sent = []
+    try:
+      # Part of the body is first sent before a retry.
+      body.next()
+      body.reset()
+      body.send_to(sender, sent.append)
+    finally:
+      body.close()
+      sender.close()
+      thread.join()
+      receiver.close()
+    self.assertEqual("".join(received), expected)
+    self.assertEqual(sum(sent), len(expected))
+    self.assertEqual(body.current, len(expected))
+
+  def _testFileChanged(self, read_ahead):
+    body = MultipartBody([("file", self.file)], read_ahead=read_ahead)
+    self.file.truncate(10)
+    self.assertRaises(socket.error, list, body)
+    body.close()
+    self.file.seek(0)
+    self.file.write(self.content)
+    self.file.flush()
+
+  def _testAbandoned(self):
+    body = MultipartBody([("file", self.file)], read_ahead=1)
+    body.next()
+    body.next()
+    reader = body.reader.thread
+    self.assertTrue(reader.is_alive())
+    body.close()
+    self.assertFalse(reader.is_alive())
+
+  def runTest(self):
+    for read_ahead in (0, 2):
+      self._testIterate(read_ahead)
+      self._testSendTo(read_ahead)
+      self._testFileChanged(read_ahead)
+    self._testAbandoned()
+
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distribted according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+# This preprocess is to set up the paths to make sure the current module
+# referencing in the files to be tested.
+import sys, os, unittest, tempfile, shutil, threading, time
+rootdir = os.path.dirname(os.getcwd())
+sys.path.append(rootdir)
+sys.path.append(os.path.join(rootdir, 'lib'))
+
+from dataingestion.services import profiling
+
+
+def _busy_wait(event):
+  while not event.is_set():
+    time.sleep(0.001)
+
+
+class TestProfiling(unittest.TestCase):
+  def _testThreadStacks(self):
+    text = profiling.format_thread_stacks()
+    self.assertTrue("Thread MainThread" in text)
+    self.assertTrue("_testThreadStacks" in text)
+
+  def _testSampler(self):
+    event = threading.Event()
+    thread = threading.Thread(target=_busy_wait, args=(event,),
+                              name="busy-worker")
+    thread.start()
+    try:
+      sampler = profiling.start_sampling(0.2, 0.005)
+      self.assertIsNone(profiling.start_sampling(1))
+      sampler.join()
+    finally:
+      event.set()
+      thread.join()
+    self.assertFalse(sampler.running())
+    self.assertTrue(sampler.samples > 1)
+    lines = sampler.collapsed().splitlines()
+    busy = [line for line in lines if line.startswith("busy-worker;")]
+    self.assertTrue(busy)
+    stack, count = busy[0].rsplit(" ", 1)
+    self.assertTrue("TestProfiling.py:_busy_wait" in stack)
+    self.assertTrue(int(count) > 0)
+
+  def _testDump(self):
+    directory = tempfile.mkdtemp()
+    try:
+      profiling.init(directory)
+      profile = profiling.new_profile()
+      profiling.call(profile, sum, range(10))
+      written = profiling.dump("batch-1", [("worker", profile),
+                                           ("idle", None)])
+      self.assertEqual(sorted(os.listdir(written)),
+                       ["all.prof", "worker.prof"])
+    finally:
+      profiling.init(None)
+      shutil.rmtree(directory)
+    self.assertIsNone(profiling.new_profile())
+
+  def runTest(self):
+    self._testThreadStacks()
+    self._testSampler()
+    self._testDump()
+
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distribted according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+# This preprocess is to set up the paths to make sure the current module
+# referencing in the files to be tested.
+import sys, os, unittest
+rootdir = os.path.dirname(os.getcwd())
+sys.path.append(rootdir)
+sys.path.append(os.path.join(rootdir, 'lib'))
+
+from sqlalchemy import create_engine
+from dataingestion.services import query_stats, metrics
+
+
+class TestQueryStats(unittest.TestCase):
+  def _testStatementKind(self):
+    self.assertEqual(query_stats.statement_kind(
+        'SELECT count(*) FROM (SELECT a FROM "images" WHERE b = ?)'),
+        "SELECT images")
+    self.assertEqual(query_stats.statement_kind(
+        "insert into batches (a) values (?)"), "INSERT batches")
+    self.assertEqual(query_stats.statement_kind("COMMIT"), "COMMIT")
+
+  def _testInstrument(self):
+    engine = create_engine("sqlite://")
+    query_stats.instrument(engine)
+    query_stats.reset()
+    query_stats.init(0)
+    try:
+      engine.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT)")
+      engine.execute("INSERT INTO items (name) VALUES (?)", "a")
+      engine.execute("SELECT * FROM items WHERE name = ?", "a").fetchall()
+    finally:
+      query_stats.init(500)
+    stats = query_stats.get_stats()
+    self.assertEqual(len(stats), 3)
+    insert = [entry for entry in stats
+              if entry["statement"].startswith("INSERT")][0]
+    self.assertEqual((insert["count"], insert["rows"]), (1, 1))
+    self.assertEqual(metrics.db_query_seconds.get_count(
+        statement="SELECT items"), 1)
+    self.assertEqual(metrics.db_slow_queries.get(statement="SELECT items"), 1)
+
+  def runTest(self):
+    self._testStatementKind()
+    self._testInstrument()
+
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distribted according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+# This preprocess is to set up the paths to make sure the current module
+# referencing in the files to be tested.
+import sys, os, unittest
+from Queue import Empty
+from time import sleep
+rootdir = os.path.dirname(os.getcwd())
+sys.path.append(rootdir)
+sys.path.append(os.path.join(rootdir, 'lib'))
+
+from dataingestion.services import api_client, ingestion_manager
+from dataingestion.services.api_client import (CircuitBreaker, ClientException,
+                                               Connection, RetryLater)
+
+
+class TestRetry(unittest.TestCase):
+  def setUp(self):
+    api_client.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+
+  def _testBackoffDelay(self):
+    for attempts in xrange(1, 12):
+      delay = api_client.backoff_delay(attempts, 1)
+      self.assertTrue(0 <= delay <= min(api_client.MAX_BACKOFF,
+                                        2 ** (attempts - 1)))
+
+  def _testCircuitBreaker(self):
+    breaker = api_client.breaker
+    self.assertTrue(breaker.allow(now=0))
+    breaker.record_failure(now=0)
+    self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+    breaker.record_failure(now=1)
+    self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+    self.assertFalse(breaker.allow(now=5))
+    self.assertEqual(breaker.retry_after(now=5), 6)
+    self.assertEqual(breaker.outage_seconds(now=5), 5)
+    # One probe when half-open.
+    self.assertTrue(breaker.allow(now=11))
+    self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+    self.assertFalse(breaker.allow(now=12))
+    breaker.record_failure(now=12)
+    self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+    self.assertTrue(breaker.allow(now=22))
+    breaker.record_success()
+    self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+    self.assertEqual(breaker.outage_seconds(), 0)
+    self.assertTrue(breaker.allow(now=23))
+
+  def _testDeferredRetries(self):
+    conn = Connection(retries=2, defer_retries=True)
+    failures = []
+    def _fail(status):
+      failures.append(status)
+      raise ClientException("Failed", http_status=status)
+
+    # Not retried.
+    try:
+      conn._retry_from(0, None, _fail, 400)
+      self.fail("ClientException not raised.")
+    except ClientException as ex:
+      self.assertNotIsInstance(ex, RetryLater)
+    try:
+      conn._retry_from(0, None, _fail, 503)
+      self.fail("RetryLater not raised.")
+    except RetryLater as ex:
+      self.assertEqual((ex.attempts, ex.http_status), (1, 503))
+    self.assertEqual(failures, [400, 503])
+    self.assertEqual(api_client.breaker.state, CircuitBreaker.CLOSED)
+
+    # Exhausted.
+    try:
+      conn._retry_from(2, None, _fail, 500)
+      self.fail("ClientException not raised.")
+    except RetryLater:
+      self.fail("The retries are exhausted.")
+    except ClientException as ex:
+      self.assertEqual(ex.http_status, 500)
+    # The two 5xx in a row opened the circuit: no request is sent.
+    try:
+      conn._retry_from(1, None, _fail, 503)
+      self.fail("RetryLater not raised.")
+    except RetryLater as ex:
+      self.assertEqual((ex.attempts, ex.err), (1, None))
+    self.assertEqual(len(failures), 3)
+
+  def _testDeferredQueue(self):
+    queue = ingestion_manager.DeferredQueue()
+    queue.put_later("later", 0.2)
+    queue.put("now")
+    self.assertEqual(queue.get_nowait(), "now")
+    self.assertRaises(Empty, queue.get_nowait)
+    self.assertEqual(queue.deferred_count(), 1)
+    sleep(0.25)
+    self.assertEqual(queue.get_nowait(), "later")
+    queue.task_done()
+    queue.task_done()
+    self.assertEqual(queue.unfinished_tasks, 0)
+
+  def runTest(self):
+    self._testBackoffDelay()
+    self._testCircuitBreaker()
+    self.setUp()
+    self._testDeferredRetries()
+    self._testDeferredQueue()
+
+
+if __name__ == '__main__':
+   unittest.main()
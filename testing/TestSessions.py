@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distribted according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+# This preprocess is to set up the paths to make sure the current module
+# referencing in the files to be tested.
+import sys, os, unittest, tempfile, shutil, threading, json, time
+rootdir = os.path.dirname(os.getcwd())
+sys.path.append(rootdir)
+sys.path.append(os.path.join(rootdir, 'lib'))
+
+from sqlalchemy.exc import OperationalError
+from dataingestion.services import model, ingestion_manager
+from dataingestion.services.api_client import ClientException
+
+
+class TestSessions(unittest.TestCase):
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    model.setup(os.path.join(self._dir, "idigbio.ingest_test.db"))
+    csv_path = os.path.join(self._dir, "batch.csv")
+    with open(csv_path, "wb") as f:
+      f.write("idigbio:OriginalFileName\n")
+    self._batch = model.add_batch(csv_path, "account", "CC0", "url", "logo")
+    self._jobs = []
+    for name in ("a.jpg", "b.jpg"):
+      path = os.path.join(self._dir, name)
+      with open(path, "wb") as f:
+        f.write(name)
+      self._jobs.append(ingestion_manager.ImageJob(model.add_image(
+          self._batch, [path], ["idigbio:OriginalFileName"])))
+    model.commit()
+
+  def tearDown(self):
+    model.close()
+    shutil.rmtree(self._dir)
+
+  def _inThread(self, func):
+    results = []
+    thread = threading.Thread(target=lambda: results.append(func()))
+    thread.start()
+    thread.join()
+    return results[0]
+
+  def _testThreadSessions(self):
+    def _session():
+      try:
+        return model.session()
+      finally:
+        model.remove_session()
+    self.assertFalse(self._inThread(_session) is model.session())
+
+  def _testReadersDoNotWait(self):
+    self.assertEqual(
+        model.session.execute("PRAGMA journal_mode").scalar(), "wal")
+    # The writer holds a write transaction open.
+    self._batch.ErrorCode = "pending"
+    model.session.flush()
+    info = self._inThread(model.get_last_batch_info)
+    self.assertEqual(info["path"], self._batch.CSVfilePath)
+    self.assertEqual(info["ErrorCode"], None)
+    model.commit()
+
+  def _testReadOnly(self):
+    reader = model.read_session()
+    try:
+      self.assertRaises(OperationalError, reader.execute,
+                        "DELETE FROM %s" % model.__batches_tablename__)
+    finally:
+      reader.close()
+    self.assertEqual(len(model.get_all_batches()), 1)
+
+  def _testDetachedBatch(self):
+    model.remove_session()
+    # Still readable by the other threads once its session is closed.
+    self.assertEqual(self._inThread(lambda: self._batch.ErrorCode), "pending")
+
+  def _testFailedWriteUnlocks(self):
+    self.assertRaises(
+        ClientException, ingestion_manager._save_upload_result, self._jobs[0],
+        json.dumps({"file_url": "http://a", "file_md5": "other"}),
+        self._batch.id)
+    # The failed write does not keep the database locked for the session of
+    # another thread.
+    job = self._jobs[1]
+    def _save():
+      try:
+        ingestion_manager._save_upload_result(job, json.dumps(
+            {"file_url": "http://b", "file_md5": job.md5}), self._batch.id)
+      finally:
+        model.remove_session()
+    start = time.time()
+    self._inThread(_save)
+    self.assertTrue(time.time() - start < 1)
+    self.assertEqual([row[2] for row in
+                      model.get_batch_details_brief(self._batch.id)],
+                     [None, "http://b"])
+
+  def _openFiles(self):
+    fds = "/proc/self/fd"
+    paths = []
+    for fd in os.listdir(fds):
+      try:
+        paths.append(os.readlink(os.path.join(fds, fd)))
+      except OSError:
+        # The fd of listdir, closed.
+        pass
+    return paths
+
+  def _testCloseReleasesFile(self):
+    if not os.path.isdir("/proc/self/fd"):
+      return
+    self.assertEqual(len(model.get_all_batches()), 1)
+    model.close()
+    db_file = os.path.join(self._dir, "idigbio.ingest_test.db")
+    # Nor the writer nor the readers keep the file open, so that it can be
+    # moved.
+    self.assertEqual([path for path in self._openFiles()
+                      if path.startswith(db_file)], [])
+    model.setup(db_file)
+
+  def runTest(self):
+    self._testThreadSessions()
+    self._testFailedWriteUnlocks()
+    self._testReadersDoNotWait()
+    self._testReadOnly()
+    self._testDetachedBatch()
+    self._testCloseReleasesFile()
+
+
+if __name__ == '__main__':
+   unittest.main()
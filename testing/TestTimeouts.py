@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distribted according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+# This preprocess is to set up the paths to make sure the current module
+# referencing in the files to be tested.
+import sys, os, unittest, socket, urllib2, threading, time
+rootdir = os.path.dirname(os.getcwd())
+sys.path.append(rootdir)
+sys.path.append(os.path.join(rootdir, 'lib'))
+
+from dataingestion.services import api_client, metrics
+from dataingestion.services.api_client import TimeoutPolicy
+
+
+class TestTimeouts(unittest.TestCase):
+  def _testPolicy(self):
+    policy = TimeoutPolicy(min_seconds=10, max_seconds=100)
+    small = policy.for_size(0)
+    self.assertEqual((small.connect, small.read, small.deadline),
+                     (TimeoutPolicy.MIN_CONNECT, 10, 10))
+    # 1 MB/s measured: 40 MB are expected to take 40 seconds.
+    policy.throughput = 2 ** 20
+    large = policy.for_size(40 * 2 ** 20)
+    self.assertEqual((large.read, large.deadline), (50, 100))
+    # Too small to be measured.
+    policy.record_transfer(1024, 10)
+    self.assertEqual(policy.throughput, 2 ** 20)
+    policy.record_transfer(4 * 2 ** 20, 1)
+    self.assertTrue(2 ** 20 < policy.throughput < 4 * 2 ** 20)
+
+    policy.throughput = 2 ** 20
+    policy.record_timeout("response")
+    self.assertEqual(policy.throughput, 2 ** 19)
+    policy.record_connect(2)
+    self.assertEqual(policy.for_size(0).connect, 8)
+    policy.record_timeout("connect")
+    self.assertEqual(policy.for_size(0).connect, 16)
+
+  def _testResponseTimeout(self):
+    # A server that accepts the request and never responds.
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    accepted = []
+    thread = threading.Thread(target=lambda: accepted.append(server.accept()))
+    thread.start()
+    timeout = api_client.RequestTimeout(1, 0.5, 1)
+    start = time.time()
+    before = metrics.timeouts.get(phase="response")
+    try:
+      urllib2.urlopen("http://127.0.0.1:%d/" % server.getsockname()[1],
+                      timeout=timeout)
+      self.fail("No timeout.")
+    except socket.timeout as e:
+      self.assertEqual(api_client._timeout_phase(e), "response")
+      api_client._record_timeout(e)
+    finally:
+      thread.join()
+      for conn, _junk in accepted:
+        conn.close()
+      server.close()
+    self.assertTrue(time.time() - start < 1)
+    self.assertEqual(metrics.timeouts.get(phase="response"), before + 1)
+
+  def _testPhases(self):
+    self.assertEqual(api_client._timeout_phase(
+        urllib2.URLError(api_client._ConnectTimeout())), "connect")
+    self.assertEqual(api_client._timeout_phase(
+        urllib2.URLError(api_client._DeadlineExceeded())), "deadline")
+    self.assertEqual(api_client._timeout_phase(
+        urllib2.URLError(socket.timeout())), "send")
+    self.assertEqual(api_client._timeout_phase(
+        urllib2.URLError(socket.error(111, "Connection refused"))), None)
+
+  def runTest(self):
+    self._testPolicy()
+    self._testResponseTimeout()
+    self._testPhases()
+
+
+if __name__ == '__main__':
+   unittest.main()
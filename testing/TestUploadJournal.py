@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distribted according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+# This preprocess is to set up the paths to make sure the current module
+# referencing in the files to be tested.
+import sys, os, unittest, tempfile, shutil, time
+rootdir = os.path.dirname(os.getcwd())
+sys.path.append(rootdir)
+sys.path.append(os.path.join(rootdir, 'lib'))
+
+from dataingestion.services import model, upload_journal
+
+
+class TestUploadJournal(unittest.TestCase):
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    self._db = os.path.join(self._dir, "idigbio.ingest_test.db")
+    self._journal = self._db + ".journal"
+    model.setup(self._db)
+    upload_journal.setup(self._journal)
+    csv_path = os.path.join(self._dir, "batch.csv")
+    with open(csv_path, "wb") as f:
+      f.write("idigbio:OriginalFileName\n")
+    self._media = os.path.join(self._dir, "a.jpg")
+    with open(self._media, "wb") as f:
+      f.write("jpeg")
+    self._batch = model.add_batch(csv_path, "account", "CC0", "url", "logo")
+    self._record = model.add_image(self._batch, [self._media],
+                                   ["idigbio:OriginalFileName"])
+    model.commit()
+    self._sync_seconds = upload_journal.sync_seconds
+
+  def tearDown(self):
+    upload_journal.sync_seconds = self._sync_seconds
+    upload_journal.close()
+    model.close()
+    shutil.rmtree(self._dir)
+
+  def _restart(self):
+    """The process dies before the commit, and starts again."""
+    upload_journal.close()
+    model.close()
+    model.setup(self._db)
+    return upload_journal.setup(self._journal)
+
+  def _testReplay(self):
+    upload_journal.record(self._record.id, self._batch.id, "http://a",
+                          self._record.MediaMD5, '{"file_url": "http://a"}')
+    # A line cut short by the crash.
+    with open(self._journal, "ab") as f:
+      f.write('{"record_id": ')
+    self.assertEqual(self._restart(), 1)
+    self.assertEqual(upload_journal.read(self._journal), [])
+    # Not uploaded again.
+    self.assertEqual(model.add_image(self._batch, [self._media],
+                                     ["idigbio:OriginalFileName"]), None)
+    self.assertEqual(self._restart(), 0)
+
+  def _testReset(self):
+    upload_journal.record(1, 1, "http://b", "md5", "{}")
+    entries = upload_journal.read(self._journal)
+    self.assertEqual([(e["record_id"], e["file_url"], e["file_md5"])
+                      for e in entries], [(1, "http://b", "md5")])
+    upload_journal.reset()
+    self.assertEqual(upload_journal.read(self._journal), [])
+
+  def _testTimedSync(self):
+    """The last line of a batch is synced without a record to follow."""
+    upload_journal.sync_seconds = 0.2
+    self._restart()
+    upload_journal.record(1, 1, "http://c", "md5", "{}")
+    upload_journal.record(2, 1, "http://d", "md5", "{}")
+    self.assertTrue(upload_journal._unsynced)
+    time.sleep(0.5)
+    self.assertFalse(upload_journal._unsynced)
+    self.assertEqual(upload_journal._timer, None)
+
+  def runTest(self):
+    self._testReplay()
+    self._testReset()
+    self._testTimedSync()
+
+
+if __name__ == '__main__':
+   unittest.main()
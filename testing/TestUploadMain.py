@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distribted according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+# This preprocess is to set up the paths to make sure the current module
+# referencing in the files to be tested.
+import sys, os, unittest, tempfile, shutil, threading, json, hashlib, cgi
+import base64, subprocess
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+rootdir = os.path.dirname(os.getcwd())
+sys.path.append(rootdir)
+sys.path.append(os.path.join(rootdir, 'lib'))
+
+import main
+
+AUTHORIZATION = "Basic " + base64.b64encode("account:key")
+
+
+class _Handler(BaseHTTPRequestHandler):
+  """
+  Logs in the account with the API key "key", and stores the media and the
+  CSV files as the server does: answers their MD5.
+  """
+  def do_POST(self):
+    if self.headers.get("Authorization") != AUTHORIZATION:
+      self.send_error(401)
+      return
+    if self.path == "/check":
+      self._reply({})
+    elif self.path.endswith("/sessions"):
+      # No chunked uploads.
+      self.send_error(404)
+    else:
+      form = cgi.FieldStorage(fp=self.rfile, headers=self.headers, environ={
+          "REQUEST_METHOD": "POST",
+          "CONTENT_TYPE": self.headers["Content-Type"]})
+      md5 = hashlib.md5(form["file"].value).hexdigest()
+      self._reply({"file_md5": md5, "file_url": "http://media/" + md5})
+
+  def _reply(self, result):
+    body = json.dumps(result)
+    self.send_response(200)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+class _Server(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+
+class TestUploadMain(unittest.TestCase):
+  """Runs the upload command of main.py against a local server."""
+  def setUp(self):
+    self.server = _Server(("127.0.0.1", 0), _Handler)
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.start()
+    self._dir = tempfile.mkdtemp()
+    # main.py reads etc/idigbio.conf and lib in its working directory.
+    os.mkdir(os.path.join(self._dir, "etc"))
+    with open(os.path.join(rootdir, "etc", "idigbio.conf"), "rb") as f:
+      conf = f.read()
+    with open(os.path.join(self._dir, "etc", "idigbio.conf"), "wb") as f:
+      f.write(conf.replace(
+          "idigbio.api_endpoint: http://media.idigbio.org",
+          "idigbio.api_endpoint: http://127.0.0.1:%d"
+          % self.server.server_address[1]))
+    os.symlink(os.path.join(rootdir, "lib"), os.path.join(self._dir, "lib"))
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    self.thread.join()
+    shutil.rmtree(self._dir)
+
+  def _csv(self, name, count, missing=()):
+    """
+    Writes a CSV file of count new media, the indexes in missing deleted.
+    Returns: The path of the CSV file.
+    """
+    csv_path = os.path.join(self._dir, name + ".csv")
+    with open(csv_path, "wb") as f:
+      f.write('"idigbio:OriginalFileName","idigbio:MediaGUID"\n')
+      for index in xrange(count):
+        path = os.path.join(self._dir, "%s%d.jpg" % (name, index))
+        if index not in missing:
+          with open(path, "wb") as media:
+            media.write("%s %d" % (name, index))
+        f.write('"%s","%s-%d"\n' % (path, name, index))
+    return csv_path
+
+  def _upload(self, csv_path, apikey="key"):
+    """
+    Runs the upload command with a new data folder.
+    Returns: (exit status, the last JSON line printed).
+    """
+    env = dict((name, value) for name, value in os.environ.items()
+               if not name.startswith("XDG_"))
+    env["HOME"] = tempfile.mkdtemp(dir=self._dir)
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(rootdir, "main.py"), "upload",
+         "--csv", csv_path, "--license", "CC0", "--accountuuid", "account",
+         "--apikey", apikey, "--interval", "0.1"],
+        cwd=self._dir, env=env, stdout=subprocess.PIPE,
+        stderr=open(os.devnull, "wb"))
+    out = process.communicate()[0]
+    # Every line printed is a JSON object.
+    lines = [json.loads(line) for line in out.splitlines()]
+    return process.returncode, lines[-1]
+
+  def _testUploaded(self):
+    status, result = self._upload(self._csv("uploaded", 3))
+    self.assertEqual(status, main.EXIT_OK)
+    self.assertEqual((result["event"], result["successes"], result["fails"],
+                      result["csv_uploaded"]), ("result", 3, 0, True))
+
+  def _testFileFailed(self):
+    status, result = self._upload(self._csv("failed", 3, missing=[1]))
+    self.assertEqual(status, main.EXIT_FAILURES)
+    self.assertEqual((result["successes"], result["fails"]), (2, 1))
+
+  def _testNoCSVFile(self):
+    status, result = self._upload(os.path.join(self._dir, "none.csv"))
+    self.assertEqual(status, main.EXIT_INPUT_ERROR)
+    self.assertEqual(result["event"], "error")
+
+  def _testLoginFailed(self):
+    status, result = self._upload(self._csv("login", 1), apikey="wrong")
+    self.assertEqual(status, main.EXIT_SERVER_ERROR)
+    self.assertEqual(result["event"], "error")
+
+  def runTest(self):
+    self._testUploaded()
+    self._testFileFailed()
+    self._testNoCSVFile()
+    self._testLoginFailed()
+
+
+if __name__ == '__main__':
+   unittest.main()
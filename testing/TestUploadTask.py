@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distribted according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+# This preprocess is to set up the paths to make sure the current module
+# referencing in the files to be tested.
+import sys, os, unittest, tempfile, shutil, threading, json, hashlib, cgi
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+rootdir = os.path.dirname(os.getcwd())
+sys.path.append(rootdir)
+sys.path.append(os.path.join(rootdir, 'lib'))
+
+from dataingestion.services import (model, ingestion_manager, api_client,
+                                    user_config, tracing)
+from dataingestion.services.ingestion_manager import BatchUploadTask, ImageJob
+
+
+class _Handler(BaseHTTPRequestHandler):
+  """Stores the media as the file service does: answers their MD5."""
+  def do_POST(self):
+    if self.path.endswith("/sessions"):
+      # No chunked uploads.
+      self.send_error(404)
+      return
+    form = cgi.FieldStorage(fp=self.rfile, headers=self.headers, environ={
+        "REQUEST_METHOD": "POST",
+        "CONTENT_TYPE": self.headers["Content-Type"]})
+    def _result(name):
+      md5 = hashlib.md5(form[name].value).hexdigest()
+      return {"file_md5": md5, "file_url": "http://media/" + md5}
+    if self.path.endswith("/batch"):
+      results = []
+      index = 0
+      while "file%d" % index in form:
+        result = _result("file%d" % index)
+        result["index"] = index
+        results.append(result)
+        index += 1
+      body = json.dumps({"results": results})
+    else:
+      body = json.dumps(_result("file"))
+    self.send_response(200)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+class _Server(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+
+class TestUploadTask(unittest.TestCase):
+  # Settings of the modules changed by the tests.
+  SAVED = [(api_client, "api_endpoint"), (api_client, "auth_string"),
+           (api_client, "csv_gzip"), (api_client, "chunked_threshold"),
+           (ingestion_manager, "upload_engine"),
+           (ingestion_manager, "worker_thread_count"),
+           (ingestion_manager, "ongoing_upload_task"),
+           (tracing, "sample_rate")]
+
+  def setUp(self):
+    self._saved = [getattr(module, name) for module, name in self.SAVED]
+    self.server = _Server(("127.0.0.1", 0), _Handler)
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.start()
+    self._dir = tempfile.mkdtemp()
+    model.setup(os.path.join(self._dir, "idigbio.ingest_test.db"))
+    user_config.setup(os.path.join(self._dir, "user.conf"))
+    user_config.set_user_config("accountuuid", "account")
+    api_client.init("http://127.0.0.1:%d" % self.server.server_address[1])
+    api_client.auth_string = "YWNjb3VudDprZXk="
+    api_client.csv_gzip = False
+    ingestion_manager.worker_thread_count = 2
+
+  def tearDown(self):
+    for (module, name), value in zip(self.SAVED, self._saved):
+      setattr(module, name, value)
+    model.close()
+    self.server.shutdown()
+    self.server.server_close()
+    self.thread.join()
+    shutil.rmtree(self._dir)
+
+  def _media(self, count, name):
+    """Files new to the database, which skips those already uploaded."""
+    paths = []
+    for index in xrange(count):
+      path = os.path.join(self._dir, "%s%d.jpg" % (name, index))
+      with open(path, "wb") as f:
+        f.write("%s %d" % (name, index))
+      paths.append(path)
+    return paths
+
+  def _upload(self, paths, seconds=30):
+    """
+    Runs the upload task of a CSV file of paths.
+    Returns: (successes, fails, finished).
+    """
+    csv_path = os.path.join(self._dir, "batch.csv")
+    with open(csv_path, "wb") as f:
+      f.write('"idigbio:OriginalFileName","idigbio:MediaGUID"\n')
+      for index, path in enumerate(paths):
+        f.write('"%s","guid-%d"\n' % (path, index))
+    task = threading.Thread(target=ingestion_manager.upload_task, args=(
+        {user_config.CSV_PATH: csv_path, user_config.RIGHTS_LICENSE: "CC0"},))
+    task.start()
+    task.join(seconds)
+    # A job that is not counted keeps the task waiting.
+    self.assertFalse(task.isAlive(), "The upload task does not finish.")
+    progress = ingestion_manager.get_progress()
+    return progress[4], progress[5], progress[7]
+
+  def _testMissingFile(self, engine):
+    ingestion_manager.upload_engine = engine
+    paths = self._media(3, engine)
+    os.remove(paths[1])
+    self.assertEqual(self._upload(paths), (2, 1, True))
+
+  def _testGroupMemberDeleted(self):
+    """A member of an image group is deleted after it is hashed."""
+    paths = self._media(3, "group")
+    csv_path = os.path.join(self._dir, "group.csv")
+    with open(csv_path, "wb") as f:
+      f.write("idigbio:OriginalFileName\n")
+    batch = model.add_batch(csv_path, "account", "CC0", "url", "logo")
+    jobs = [ImageJob(model.add_image(batch, [path],
+                                     ["idigbio:OriginalFileName"]))
+            for path in paths]
+    model.commit()
+    os.remove(paths[0])
+    task = ingestion_manager.ongoing_upload_task = BatchUploadTask(batch)
+    self.assertEqual(ingestion_manager._upload_image_group(
+        jobs, str(batch.id), ingestion_manager._get_conn()), [])
+    while not task.postprocess_queue.empty():
+      task.postprocess_queue.get()()
+    self.assertEqual((task.get_successes(), task.get_fails()), (2, 1))
+    # Not run by upload_task, which does not start while it is unfinished.
+    ingestion_manager.ongoing_upload_task = None
+
+  def _testNoUploadSessions(self):
+    api_client.chunked_threshold = 1
+    path, = self._media(1, "chunked")
+    result = json.loads(ingestion_manager._get_conn().post_image_chunked(
+        path, "guid"))
+    with open(path, "rb") as f:
+      self.assertEqual(result["file_md5"], hashlib.md5(f.read()).hexdigest())
+    # The next files are sent whole.
+    self.assertFalse(api_client.use_chunked_upload(100))
+
+  def _testSlowestNotTraced(self):
+    """The slowest files are ranked among the files whose phases are not
+    traced."""
+    tracing.sample_rate = 0.0
+    paths = self._media(3, "untraced")
+    self.assertEqual(self._upload(paths), (3, 0, True))
+    report = ingestion_manager.get_trace_report()
+    self.assertEqual((report["files"], report["traced_files"]), (3, 0))
+    self.assertEqual(sorted(entry["file"] for entry in report["slowest"]),
+                     paths)
+    for entry in report["slowest"]:
+      self.assertTrue(entry["total"] > 0)
+      self.assertEqual(entry["phases"], None)
+
+  def runTest(self):
+    self._testMissingFile("threads")
+    self._testMissingFile("async")
+    self._testGroupMemberDeleted()
+    self._testNoUploadSessions()
+    self._testSlowestNotTraced()
+
+
+if __name__ == '__main__':
+   unittest.main()
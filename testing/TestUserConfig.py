@@ -37,5 +37,37 @@ class TestUserConfig(unittest.TestCase):
                       'account_uuid')
 
 
+class TestUserConfigCache(unittest.TestCase):
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    self._filePath = os.path.join(self._dir, 'user.conf')
+    user_config.setup(self._filePath)
+
+  def tearDown(self):
+    for name in os.listdir(self._dir):
+      os.remove(os.path.join(self._dir, name))
+    os.rmdir(self._dir)
+
+  def runTest(self):
+    # One write for several values, and no temporary file left.
+    user_config.set_user_configs({'accountuuid': 'id1', 'retries': '3',
+                                  'logoutafterexit': 'True'})
+    self.assertEqual(os.listdir(self._dir), ['user.conf'])
+    self.assertEqual(user_config.get_user_config_int('retries'), 3)
+    self.assertEqual(user_config.get_user_config_int('accountuuid', 5), 5)
+    self.assertTrue(user_config.get_user_config_bool('logoutafterexit'))
+    self.assertFalse(user_config.get_user_config_bool('missing'))
+
+    # Another process replaces the file: the change is seen after the check
+    # interval.
+    with open(self._filePath + '.new', 'wb') as f:
+      f.write('[iDigBio]\naccountuuid = id2\n')
+    os.rename(self._filePath + '.new', self._filePath)
+    self.assertEqual(user_config.get_user_config('accountuuid'), 'id1')
+    user_config.config._checked_at = 0
+    self.assertEqual(user_config.get_user_config('accountuuid'), 'id2')
+    self.assertRaises(AttributeError, user_config.get_user_config, 'retries')
+
+
 if __name__ == '__main__':
    unittest.main()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distributed according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+"""
+End-to-end upload benchmark: generates a synthetic corpus and its CSV file,
+starts the stub server, runs ingestion_manager.upload_task against it and
+reports files/sec, MB/sec, CPU time and peak RSS as JSON.
+
+Each run is one process, as the upload modules keep their state in globals.
+Compare the saved results with compare.py.
+
+Example:
+  python bench.py --corpus jpg:500:lognormal:300KB:0.8 \\
+      --corpus tif:20:uniform:10MB:40MB --threads 10 --out run1.json
+"""
+import sys, os, json, time, argparse, tempfile, shutil, subprocess, socket
+import resource, platform, urllib2, logging
+benchdir = os.path.dirname(os.path.abspath(__file__))
+rootdir = os.path.dirname(os.path.dirname(benchdir))
+sys.path.append(rootdir)
+sys.path.append(os.path.join(rootdir, 'lib'))
+
+import corpus
+from dataingestion.services import (api_client, ingestion_manager, model,
+                                    user_config, metrics)
+
+STUB_PATH = os.path.join(rootdir, "testing", "stub_server", "file-service.py")
+STUB_START_TIMEOUT = 20
+
+def _free_port():
+  sock = socket.socket()
+  sock.bind(("127.0.0.1", 0))
+  port = sock.getsockname()[1]
+  sock.close()
+  return port
+
+def start_stub(port, stub_args=()):
+  """
+  Starts the stub server in a subprocess and waits until it accepts
+  connections.
+  """
+  env = dict(os.environ, PYTHONPATH=os.path.join(rootdir, "lib"))
+  log = open(os.path.join(tempfile.gettempdir(), "bench-stub.log"), "wb")
+  process = subprocess.Popen(
+      [sys.executable, STUB_PATH, "--port", str(port)] + list(stub_args),
+      cwd=os.path.dirname(STUB_PATH), env=env, stdout=log,
+      stderr=subprocess.STDOUT)
+  deadline = time.time() + STUB_START_TIMEOUT
+  while time.time() < deadline:
+    if process.poll() is not None:
+      raise RuntimeError("The stub server exited, see %s." % log.name)
+    try:
+      socket.create_connection(("127.0.0.1", port), 1).close()
+      return process
+    except socket.error:
+      time.sleep(0.2)
+  process.kill()
+  raise RuntimeError("The stub server did not start.")
+
+def stop_stub(process, port):
+  try:
+    urllib2.urlopen("http://127.0.0.1:%d/upload/shutdown" % port,
+                    timeout=5).read()
+  except Exception:
+    pass
+  deadline = time.time() + 10
+  while process.poll() is None and time.time() < deadline:
+    time.sleep(0.1)
+  if process.poll() is None:
+    process.kill()
+    process.wait()
+
+def _git_commit():
+  try:
+    return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                   cwd=rootdir).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def _phase_totals():
+  """
+  Returns: The total seconds and count per upload phase from the metrics.
+  """
+  totals = {}
+  for suffix, labels, value in metrics.phase_seconds.samples():
+    if suffix in ("_sum", "_count"):
+      phase = dict(labels)["phase"]
+      totals.setdefault(phase, {})[suffix[1:]] = value
+  return totals
+
+def run(args):
+  workdir = args.workdir or tempfile.mkdtemp(prefix="idigbio-bench-")
+  if not os.path.exists(workdir):
+    os.makedirs(workdir)
+  try:
+    started = time.time()
+    files = corpus.generate(workdir, args.corpus, args.seed)
+    csv_path = os.path.join(workdir, "bench.csv")
+    corpus.write_csv(csv_path, files, args.seed)
+    total_bytes = sum(size for _junk, size in files)
+    generate_seconds = time.time() - started
+
+    port = args.port or _free_port()
+    stub = start_stub(port, args.stub_arg)
+    try:
+      api_client.init("http://127.0.0.1:%d" % port, args.chunk_threshold_mb,
+                      args.chunk_size_mb, args.chunk_parallelism,
+                      args.csv_gzip)
+      # The stub server does not authenticate.
+      api_client.auth_string = "YmVuY2g6YmVuY2g="
+      db_path = args.db or os.path.join(workdir, "bench.sqlite")
+      model.setup(db_path)
+      user_config.setup(os.path.join(workdir, "user.conf"))
+      user_config.set_user_config(user_config.IDIGBIOPROVIDEDBYGUID, "bench")
+      ingestion_manager.init(args.threads, args.precheck, args.batch_files,
+                             args.batch_mb, args.engine, args.concurrency)
+
+      usage_before = resource.getrusage(resource.RUSAGE_SELF)
+      wall_start = time.time()
+      ingestion_manager.upload_task({
+          user_config.CSV_PATH: csv_path,
+          user_config.RIGHTS_LICENSE: args.license})
+      wall = time.time() - wall_start
+      usage_after = resource.getrusage(resource.RUSAGE_SELF)
+      (fatal_server_error, input_csv_error, total, skips, successes, fails,
+       csv_uploaded, _junk) = ingestion_manager.get_progress()
+    finally:
+      stop_stub(stub, port)
+    stub_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+  finally:
+    if not args.workdir and not args.keep:
+      shutil.rmtree(workdir, ignore_errors=True)
+
+  cpu_user = usage_after.ru_utime - usage_before.ru_utime
+  cpu_system = usage_after.ru_stime - usage_before.ru_stime
+  # ru_maxrss is in KB on Linux and in bytes on Mac OS X.
+  rss_scale = 1 if sys.platform == "darwin" else 1024
+  return {
+      "label": args.label,
+      "commit": _git_commit(),
+      "python": platform.python_version(),
+      "platform": platform.platform(),
+      "config": {
+          "corpus": args.corpus, "seed": args.seed, "threads": args.threads,
+          "engine": args.engine, "concurrency": args.concurrency,
+          "precheck": args.precheck, "batch_files": args.batch_files,
+          "batch_mb": args.batch_mb,
+          "chunk_threshold_mb": args.chunk_threshold_mb,
+          "chunk_size_mb": args.chunk_size_mb,
+          "chunk_parallelism": args.chunk_parallelism,
+          "csv_gzip": args.csv_gzip, "db": args.db,
+          "stub_args": args.stub_arg},
+      "files": len(files),
+      "bytes": total_bytes,
+      "generate_seconds": generate_seconds,
+      "wall_seconds": wall,
+      "files_per_second": len(files) / wall if wall else None,
+      "mb_per_second": total_bytes / 2.0 ** 20 / wall if wall else None,
+      "cpu_user_seconds": cpu_user,
+      "cpu_system_seconds": cpu_system,
+      "cpu_utilization": (cpu_user + cpu_system) / wall if wall else None,
+      "peak_rss_bytes": usage_after.ru_maxrss * rss_scale,
+      "stub_cpu_seconds": stub_usage.ru_utime + stub_usage.ru_stime,
+      "result": {
+          "successes": successes, "fails": fails, "skips": skips,
+          "total": total, "csv_uploaded": csv_uploaded,
+          "fatal_server_error": fatal_server_error,
+          "input_csv_error": input_csv_error},
+      "phases": _phase_totals(),
+      "retries": metrics.retries.get(),
+  }
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+  parser.add_argument("--corpus", action="append",
+                      help="A corpus spec type:count:distribution, see "
+                      "corpus.py. Repeat for mixed corpora. Default: "
+                      "jpg:200:lognormal:300KB:0.8")
+  parser.add_argument("--seed", type=int, default=1)
+  parser.add_argument("--threads", type=int, default=10)
+  parser.add_argument("--engine", choices=("threads", "async"),
+                      default="threads", help="The upload engine.")
+  parser.add_argument("--concurrency", type=int, default=None,
+                      help="The uploads in flight of the async engine.")
+  parser.add_argument("--precheck", type=int, default=0)
+  parser.add_argument("--batch-files", type=int, default=1)
+  parser.add_argument("--batch-mb", type=float, default=8)
+  parser.add_argument("--chunk-threshold-mb", type=float, default=None)
+  parser.add_argument("--chunk-size-mb", type=float, default=None)
+  parser.add_argument("--chunk-parallelism", type=int, default=None)
+  parser.add_argument("--csv-gzip", default="false")
+  parser.add_argument("--license", default="CC0")
+  parser.add_argument("--db", help="The SQLite file to use, e.g. on another "
+                      "disk. Default: a new file in the work directory.")
+  parser.add_argument("--port", type=int, help="Default: a free port.")
+  parser.add_argument("--stub-arg", action="append", default=[],
+                      help="An argument for the stub server, given as "
+                      "--stub-arg=--option=value. Repeatable.")
+  parser.add_argument("--workdir", help="Where the corpus is generated. It "
+                      "is kept. Default: a temporary directory.")
+  parser.add_argument("--keep", action="store_true",
+                      help="Keep the temporary work directory.")
+  parser.add_argument("--label", default="")
+  parser.add_argument("--out", help="The JSON result file. Default: stdout.")
+  args = parser.parse_args(argv)
+  args.corpus = args.corpus or ["jpg:200:lognormal:300KB:0.8"]
+
+  logging.basicConfig(level=logging.CRITICAL)
+  result = run(args)
+  text = json.dumps(result, indent=2, sort_keys=True)
+  if args.out:
+    with open(args.out, "w") as f:
+      f.write(text + "\n")
+  else:
+    print text
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distributed according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+"""
+Prints the results of benchmark runs, saved by bench.py --out, side by side.
+The relative change is shown against the first run.
+
+Usage: python compare.py base.json run1.json [run2.json ...]
+"""
+import sys, json, os
+
+COLUMNS = ["files/s", "MB/s", "wall s", "cpu s", "rss MB", "fails"]
+
+def _values(result):
+  return {
+      "files/s": result["files_per_second"],
+      "MB/s": result["mb_per_second"],
+      "wall s": result["wall_seconds"],
+      "cpu s": result["cpu_user_seconds"] + result["cpu_system_seconds"],
+      "rss MB": result["peak_rss_bytes"] / 2.0 ** 20,
+      "fails": result["result"]["fails"],
+  }
+
+def main(paths):
+  if not paths:
+    print __doc__
+    return 2
+  results = []
+  for path in paths:
+    with open(path) as f:
+      results.append((path, json.load(f)))
+  base = _values(results[0][1])
+  names = COLUMNS
+  print "%-30s" % "run" + "".join("%18s" % name for name in names)
+  for path, result in results:
+    values = _values(result)
+    cells = []
+    for name in names:
+      cell = "%.2f" % values[name]
+      if path != results[0][0] and base[name]:
+        cell += " (%+.0f%%)" % ((values[name] / base[name] - 1) * 100)
+      cells.append("%18s" % cell)
+    label = result.get("label") or os.path.basename(path)
+    print "%-30s" % label[:30] + "".join(cells)
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
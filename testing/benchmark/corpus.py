@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distributed according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+"""
+Generates synthetic JPEG and TIFF media files of given size distributions,
+and the CSV file to upload them.
+
+A corpus is described by specs "type:count:distribution", for example:
+  jpg:900:lognormal:300KB:0.8  900 JPEGs, median 300 KB, log-sigma 0.8
+  tif:100:uniform:10MB:40MB    100 TIFFs between 10 and 40 MB
+  jpg:50:fixed:2MB             50 JPEGs of 2 MB
+"""
+import os, csv, struct, random, math, uuid
+
+UNITS = {"B": 1, "KB": 2 ** 10, "MB": 2 ** 20, "GB": 2 ** 30}
+MIN_SIZE = 256
+WRITE_BLOCK = 2 ** 20
+
+def parse_size(text):
+  """
+  Returns: The number of bytes of text such as "300KB" or "2.5MB".
+  """
+  text = text.strip().upper()
+  for unit in ("GB", "MB", "KB", "B"):
+    if text.endswith(unit):
+      return int(float(text[:-len(unit)]) * UNITS[unit])
+  return int(text)
+
+def parse_spec(spec):
+  """
+  Returns: (file type, count, size sampler) of a corpus spec. The sampler
+    takes a random.Random and returns a size in bytes.
+  """
+  fields = spec.split(":")
+  if len(fields) < 4 or fields[0] not in ("jpg", "tif"):
+    raise ValueError("Bad corpus spec: %s" % spec)
+  file_type, count, dist, args = (fields[0], int(fields[1]), fields[2],
+                                  fields[3:])
+  if dist == "fixed":
+    size = parse_size(args[0])
+    sampler = lambda rand: size
+  elif dist == "uniform":
+    low, high = parse_size(args[0]), parse_size(args[1])
+    sampler = lambda rand: rand.randint(low, high)
+  elif dist == "lognormal":
+    median, sigma = parse_size(args[0]), float(args[1])
+    sampler = lambda rand: int(rand.lognormvariate(math.log(median), sigma))
+  else:
+    raise ValueError("Unknown size distribution: %s" % dist)
+  return file_type, count, lambda rand: max(MIN_SIZE, sampler(rand))
+
+def _write_random(f, count):
+  while count > 0:
+    data = os.urandom(min(count, WRITE_BLOCK))
+    f.write(data)
+    count -= len(data)
+
+def write_jpeg(path, size):
+  """
+  Writes a JPEG of exactly size bytes: a JFIF header, comment segments of
+  random bytes and the end-of-image marker.
+  """
+  header = ("\xff\xd8\xff\xe0" + struct.pack(">H", 16) +
+            "JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00")
+  remaining = size - len(header) - 2
+  with open(path, "wb") as f:
+    f.write(header)
+    while remaining > 0:
+      length = min(65533, remaining - 4)
+      if 0 < remaining - 4 - length < 4:
+        length -= 4
+      f.write("\xff\xfe" + struct.pack(">H", length + 2))
+      _write_random(f, length)
+      remaining -= length + 4
+    f.write("\xff\xd9")
+
+def write_tiff(path, size):
+  """
+  Writes a TIFF of exactly size bytes: one 8-bit grayscale strip of random
+  bytes, one row high.
+  """
+  entries = [(256, 4, None), (257, 3, 1), (258, 3, 8), (259, 3, 1),
+             (262, 3, 1), (273, 4, None), (278, 3, 1), (279, 4, None)]
+  data_offset = 8 + 2 + 12 * len(entries) + 4
+  data_size = size - data_offset
+  values = {256: data_size, 273: data_offset, 279: data_size}
+  with open(path, "wb") as f:
+    f.write("II*\x00" + struct.pack("<I", 8))
+    f.write(struct.pack("<H", len(entries)))
+    for tag, field_type, value in entries:
+      if value is None:
+        value = values[tag]
+      if field_type == 3:
+        f.write(struct.pack("<HHIHH", tag, field_type, 1, value, 0))
+      else:
+        f.write(struct.pack("<HHII", tag, field_type, 1, value))
+    f.write(struct.pack("<I", 0))
+    _write_random(f, data_size)
+
+def generate(directory, specs, seed=None):
+  """
+  Generates the files of the corpus specs in directory. The sizes and names
+  depend only on seed; the contents are random.
+  Returns: A list of (path, size).
+  """
+  rand = random.Random(seed)
+  files = []
+  for spec in specs:
+    file_type, count, sampler = parse_spec(spec)
+    for _junk in xrange(count):
+      size = sampler(rand)
+      path = os.path.join(directory, "%06d.%s" % (len(files), file_type))
+      if file_type == "jpg":
+        write_jpeg(path, size)
+      else:
+        write_tiff(path, size)
+      files.append((path, size))
+  return files
+
+def write_csv(csv_path, files, seed=None):
+  """
+  Writes the upload CSV file of files, with a few annotation columns.
+  """
+  rand = random.Random(seed)
+  with open(csv_path, "wb") as f:
+    writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+    writer.writerow(["idigbio:OriginalFileName", "idigbio:MediaGUID",
+                     "dwc:catalogNumber", "dwc:scientificName"])
+    for index, (path, _junk) in enumerate(files):
+      writer.writerow([path, str(uuid.UUID(int=rand.getrandbits(128))),
+                       "BENCH-%06d" % index, "Synthetica benchmarkii"])
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distributed according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+"""
+Builds an ingestion database with many synthetic batches and image records,
+like the database of an installation that has uploaded for years, for the
+model microbenchmarks in modelbench.py.
+
+The schema is created by model.setup; the rows are inserted with plain
+sqlite3 executemany calls, as the ORM would take hours for millions of rows.
+All the batches but the last one have their CSV uploaded. About 2% of the
+records have an error and 5% are not uploaded.
+
+Example:
+  python dbfixture.py --preset 1m --out /data/fixture-1m.sqlite
+"""
+import sys, os, json, random, hashlib, sqlite3, argparse, time
+from datetime import datetime, timedelta
+benchdir = os.path.dirname(os.path.abspath(__file__))
+rootdir = os.path.dirname(os.path.dirname(benchdir))
+sys.path.append(rootdir)
+sys.path.append(os.path.join(rootdir, 'lib'))
+
+from dataingestion.services import constants, model
+
+# name: (image rows, batches)
+PRESETS = {"10k": (10000, 20), "1m": (1000000, 500), "5m": (5000000, 2000)}
+INSERT_CHUNK = 10000
+ERROR_RATE = 0.02
+NOT_UPLOADED_RATE = 0.05
+FIRST_BATCH_TIME = datetime(2012, 1, 2, 9, 30, 0, 123456)
+
+IMAGE_COLUMNS = [
+    "OriginalFileName", "MediaGUID", "SpecimenRecordUUID", "Error", "Warnings",
+    "MediaAPContent", "UploadTime", "MediaURL", "MimeType", "MediaSizeInBytes",
+    "ProviderCreatedTimeStamp", "ProviderCreatedByGUID", "MediaEXIF",
+    "Annotations", "etag", "MediaMD5", "AllMD5", "BatchID"]
+BATCH_COLUMNS = [
+    "id", "CSVfilePath", "iDigbioProvidedByGUID", "RightsLicense",
+    "RightsLicenseStatementUrl", "RightsLicenseLogoUrl", "start_time",
+    "finish_time", "RecordCount", "SkipCount", "FailCount", "ErrorCode",
+    "CSVUploaded", "AllMD5"]
+
+def _md5(text):
+  return hashlib.md5(text).hexdigest()
+
+def _batch_sizes(rows, batches, rand):
+  """
+  Returns: batches sizes summing to rows, varying around the mean.
+  """
+  weights = [rand.lognormvariate(0, 0.7) for _junk in xrange(batches)]
+  scale = rows / sum(weights)
+  sizes = [int(weight * scale) for weight in weights]
+  sizes[-1] += rows - sum(sizes)
+  return sizes
+
+def _image_rows(batch_id, first_index, count, batch_time, rand):
+  for index in xrange(first_index, first_index + count):
+    guid = "urn:uuid:%s" % _md5("guid%d" % index)
+    media_md5 = _md5("media%d" % index)
+    path = "/data/specimens/batch%05d/IMG_%07d.JPG" % (batch_id, index)
+    size = str(int(rand.lognormvariate(12.6, 0.8)))
+    error = warnings = ""
+    upload_time = media_url = content = None
+    draw = rand.random()
+    if draw < ERROR_RATE:
+      error = "File not found."
+    elif draw >= ERROR_RATE + NOT_UPLOADED_RATE:
+      upload_time = str(batch_time + timedelta(seconds=index - first_index))
+      media_url = "http://media.idigbio.org/lookup/images/%s" % media_md5
+      content = json.dumps({
+          "file_name": os.path.basename(path), "file_url": media_url,
+          "file_reference": guid, "file_md5": media_md5,
+          "content_type": "image/jpeg", "file_size": int(size)})
+    annotations = json.dumps({
+        "dwc:catalogNumber": "UF-%07d" % index,
+        "dwc:scientificName": "Synthetica fixturae",
+        "dwc:recordedBy": "Collector %d" % (index % 97)})
+    yield (path, guid, "", error, warnings, content, upload_time, media_url,
+           "image/jpeg", size, batch_time.ctime(), "collector", "{}",
+           annotations, None, media_md5, _md5("all%d" % index), batch_id)
+
+def build(db_path, rows, batches, seed=None):
+  """
+  Creates the database db_path with rows image records in batches batches.
+  Returns: The number of image records per batch.
+  """
+  if os.path.exists(db_path):
+    os.remove(db_path)
+  model.setup(db_path)
+  model.close()
+
+  rand = random.Random(seed)
+  sizes = _batch_sizes(rows, batches, rand)
+  images_sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+      constants.IMAGES_TABLENAME, ", ".join(IMAGE_COLUMNS),
+      ", ".join("?" * len(IMAGE_COLUMNS)))
+  batches_sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+      constants.BATCHES_TABLENAME, ", ".join(BATCH_COLUMNS),
+      ", ".join("?" * len(BATCH_COLUMNS)))
+
+  conn = sqlite3.connect(db_path)
+  try:
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA journal_mode = OFF")
+    index = 0
+    for batch_id, size in enumerate(sizes, 1):
+      batch_time = FIRST_BATCH_TIME + timedelta(days=batch_id)
+      uploaded = batch_id < len(sizes)
+      conn.execute(batches_sql, (
+          batch_id, "/data/specimens/batch%05d.csv" % batch_id, "collector",
+          "CC0", "http://creativecommons.org/publicdomain/zero/1.0/",
+          "http://i.creativecommons.org/p/zero/1.0/88x31.png",
+          str(batch_time), str(batch_time + timedelta(hours=5)) if uploaded
+          else None, size, 0, 0, None, uploaded, _md5("batch%d" % batch_id)))
+      rows_iter = _image_rows(batch_id, index, size, batch_time, rand)
+      while True:
+        chunk = [row for _junk, row in zip(xrange(INSERT_CHUNK), rows_iter)]
+        if not chunk:
+          break
+        conn.executemany(images_sql, chunk)
+      index += size
+    conn.commit()
+  finally:
+    conn.close()
+  return sizes
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+  parser.add_argument("--preset", choices=sorted(PRESETS),
+                      help="Rows and batches: 10k (20 batches), 1m (500) or "
+                      "5m (2000).")
+  parser.add_argument("--rows", type=int)
+  parser.add_argument("--batches", type=int)
+  parser.add_argument("--seed", type=int, default=1)
+  parser.add_argument("--out", required=True, help="The SQLite file. It is "
+                      "replaced if it exists.")
+  args = parser.parse_args(argv)
+  rows, batches = PRESETS[args.preset or "10k"]
+  rows = args.rows or rows
+  batches = min(args.batches or batches, rows)
+
+  started = time.time()
+  build(args.out, rows, batches, args.seed)
+  print "%d image records in %d batches written to %s in %.1f s." % (
+      rows, batches, args.out, time.time() - started)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distributed according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+"""
+Times the model and result generation functions that dominate the database
+time (add_image, get_batch_details, get_unuploaded_information,
+get_all_batches and generateZip) against a database built by dbfixture.py,
+and reports the regressions against a previous run.
+
+The database is not modified: the images added are rolled back.
+
+Example:
+  python modelbench.py --db fixture-1m.sqlite --out new.json \\
+      --baseline old.json
+"""
+import sys, os, json, time, argparse, tempfile, shutil, subprocess, logging
+import uuid
+benchdir = os.path.dirname(os.path.abspath(__file__))
+rootdir = os.path.dirname(os.path.dirname(benchdir))
+sys.path.append(rootdir)
+sys.path.append(os.path.join(rootdir, 'lib'))
+
+import corpus, dbfixture
+from dataingestion.services import constants, model, result_generator
+
+ADD_IMAGE_CALLS = 100
+# A case is a regression if its median time grows by more than this.
+DEFAULT_THRESHOLD = 0.2
+
+def _git_commit():
+  try:
+    return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                   cwd=rootdir).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def _median(values):
+  values = sorted(values)
+  middle = len(values) // 2
+  if len(values) % 2:
+    return values[middle]
+  return (values[middle - 1] + values[middle]) / 2.0
+
+def _time(func, repeat):
+  """
+  Returns: The seconds of each of the repeat calls of func, and the number
+    of rows returned by the last call.
+  """
+  runs = []
+  result = None
+  for _junk in xrange(repeat):
+    start = time.time()
+    result = func()
+    runs.append(time.time() - start)
+  rows = len(result) if isinstance(result, list) else None
+  return runs, rows
+
+def _fixture_info():
+  batches = model.get_all_batches()
+  sizes = [(int(batch[8]), int(batch[0])) for batch in batches]
+  return {"rows": sum(size for size, _junk in sizes),
+          "batches": len(sizes),
+          # The worst case of the batch detail pages.
+          "largest_batch": max(sizes)[1] if sizes else None}
+
+def _add_images(workdir):
+  """
+  Returns: A function adding ADD_IMAGE_CALLS new images to the last batch.
+  """
+  media_path = os.path.join(workdir, "media.jpg")
+  corpus.write_jpeg(media_path, 300 * 1024)
+  row_mapper = model.RowMapper(["idigbio:OriginalFileName",
+                                 "idigbio:MediaGUID", "dwc:catalogNumber"])
+  batch = model.load_last_batch()
+
+  def add():
+    for index in xrange(ADD_IMAGE_CALLS):
+      model.add_image(batch, [media_path, str(uuid.uuid4()), str(index)],
+                      row_mapper)
+    model.session.flush()
+  return add
+
+def run(args):
+  workdir = tempfile.mkdtemp(prefix="idigbio-modelbench-")
+  try:
+    model.setup(args.db)
+    info = _fixture_info()
+    last_batch = model.load_last_batch().id
+    cases = [
+        ("get_all_batches", model.get_all_batches),
+        ("get_batch_details_largest",
+         lambda: model.get_batch_details(info["largest_batch"])),
+        ("get_batch_details_last", lambda: model.get_batch_details(0)),
+        ("get_unuploaded_information", model.get_unuploaded_information),
+        ("generateZip_last", lambda: result_generator.generateZip(
+            last_batch, os.path.join(workdir, constants.ZIP_NAME))),
+    ]
+    results = {}
+    for name, func in cases:
+      if args.case and name not in args.case:
+        continue
+      runs, rows = _time(func, args.repeat)
+      results[name] = {"median": _median(runs), "min": min(runs),
+                       "runs": runs, "rows": rows}
+    if not args.case or "add_image" in args.case:
+      try:
+        runs, _junk = _time(_add_images(workdir), args.repeat)
+      finally:
+        model.session.rollback()
+      # Per call, to compare with the other cases.
+      runs = [seconds / ADD_IMAGE_CALLS for seconds in runs]
+      results["add_image"] = {"median": _median(runs), "min": min(runs),
+                              "runs": runs, "rows": None}
+    model.close()
+  finally:
+    shutil.rmtree(workdir, ignore_errors=True)
+  return {
+      "label": args.label,
+      "commit": _git_commit(),
+      "db": os.path.abspath(args.db),
+      "db_bytes": os.path.getsize(args.db),
+      "fixture": info,
+      "repeat": args.repeat,
+      "cases": results}
+
+def compare(base, result, threshold=DEFAULT_THRESHOLD):
+  """
+  Prints the median times of result against base.
+  Returns: The names of the cases slower than base by more than threshold.
+  """
+  regressions = []
+  print "%-30s%14s%14s%10s" % ("case", "base s", "new s", "change")
+  for name in sorted(result["cases"]):
+    new = result["cases"][name]["median"]
+    if name not in base["cases"]:
+      print "%-30s%14s%14.4f" % (name, "-", new)
+      continue
+    old = base["cases"][name]["median"]
+    change = new / old - 1 if old else 0.0
+    flag = ""
+    if change > threshold:
+      regressions.append(name)
+      flag = "  REGRESSION"
+    print "%-30s%14.4f%14.4f%+9.0f%%%s" % (name, old, new, change * 100, flag)
+  if base.get("fixture") != result.get("fixture"):
+    print "Warning: the runs used different fixtures."
+  return regressions
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+  parser.add_argument("--db", help="A database built by dbfixture.py.")
+  parser.add_argument("--preset", choices=sorted(dbfixture.PRESETS),
+                      help="Without --db, builds a temporary fixture.")
+  parser.add_argument("--repeat", type=int, default=5)
+  parser.add_argument("--case", action="append",
+                      help="Run only this case. Repeatable.")
+  parser.add_argument("--label", default="")
+  parser.add_argument("--out", help="The JSON result file. Default: stdout.")
+  parser.add_argument("--baseline", help="A previous result file to compare "
+                      "with. The exit status is 1 if there are regressions.")
+  parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+  args = parser.parse_args(argv)
+
+  logging.basicConfig(level=logging.CRITICAL)
+  tempdir = None
+  if not args.db:
+    tempdir = tempfile.mkdtemp(prefix="idigbio-fixture-")
+    args.db = os.path.join(tempdir, "fixture.sqlite")
+    rows, batches = dbfixture.PRESETS[args.preset or "10k"]
+    dbfixture.build(args.db, rows, batches)
+  try:
+    result = run(args)
+  finally:
+    if tempdir:
+      shutil.rmtree(tempdir, ignore_errors=True)
+
+  text = json.dumps(result, indent=2, sort_keys=True)
+  if args.out:
+    with open(args.out, "w") as f:
+      f.write(text + "\n")
+  elif not args.baseline:
+    print text
+  if args.baseline:
+    with open(args.baseline) as f:
+      if compare(json.load(f), result, args.threshold):
+        return 1
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
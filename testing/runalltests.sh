@@ -3,3 +3,16 @@
 ./TestModel.py
 ./TestAPIClient.py
 ./TestIngestionManager.py
+./TestMetrics.py
+./TestProfiling.py
+./TestQueryStats.py
+./TestRetry.py
+./TestTimeouts.py
+./TestAsyncUpload.py
+./TestMultipartBody.py
+./TestCSVInput.py
+./TestSessions.py
+./TestUploadJournal.py
+./TestCSVUpload.py
+./TestUploadTask.py
+./TestUploadMain.py
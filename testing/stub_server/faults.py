@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+"""
+Latency shaping and fault injection for the stub storage server, to
+reproduce production pathologies (retry storms, stragglers, corrupted
+uploads) locally. All the faults are off by default.
+
+  --latency DIST            Server processing time of each request. DIST is
+                            fixed:S, uniform:A:B, exponential:MEAN or
+                            lognormal:MEDIAN:SIGMA, in seconds.
+  --bandwidth-kbps N        Caps the request bodies read by the server, over
+                            all connections, at N KB/s.
+  --error-rate STATUS:P     Answers a request with the HTTP STATUS with
+                            probability P. Repeatable, e.g. 503:0.05.
+  --reset-rate P            Resets the connection in the middle of reading
+                            the request body.
+  --slow-rate P             Delays the response by --slow-seconds.
+  --wrong-md5-rate P        Returns a wrong file_md5 (or part_md5).
+  --seed N                  Seed of the random decisions.
+"""
+import random, time, threading, socket, struct, json, math
+import cherrypy
+
+def parse_distribution(text):
+  """
+  Returns: A function of a random.Random returning samples of the
+    distribution text, see --latency.
+  """
+  fields = text.split(":")
+  args = [float(x) for x in fields[1:]]
+  if fields[0] == "fixed":
+    return lambda rand: args[0]
+  if fields[0] == "uniform":
+    return lambda rand: rand.uniform(args[0], args[1])
+  if fields[0] == "exponential":
+    return lambda rand: rand.expovariate(1.0 / args[0])
+  if fields[0] == "lognormal":
+    return lambda rand: rand.lognormvariate(math.log(args[0]), args[1])
+  raise ValueError("Unknown distribution: %s" % text)
+
+
+class TokenBucket(object):
+  """
+  Limits the bytes per second consumed by all the threads together.
+  """
+  def __init__(self, rate):
+    self.rate = float(rate)
+    self.lock = threading.Lock()
+    self.next_time = time.time()
+
+  def consume(self, count):
+    with self.lock:
+      now = time.time()
+      start = max(now, self.next_time)
+      self.next_time = start + count / self.rate
+      delay = self.next_time - now
+    if delay > 0:
+      time.sleep(delay)
+
+
+class ShapedFile(object):
+  """
+  Wraps the request body file: reads are throttled by a TokenBucket and
+  the connection is reset after reset_after bytes, if given.
+  """
+  BLOCK = 16 * 1024
+
+  def __init__(self, fp, bucket=None, reset_after=None):
+    self.fp = fp
+    self.bucket = bucket
+    self.reset_after = reset_after
+    self.count = 0
+
+  def _account(self, data):
+    self.count += len(data)
+    if self.bucket and data:
+      self.bucket.consume(len(data))
+    if self.reset_after is not None and self.count >= self.reset_after:
+      reset_connection()
+    return data
+
+  def read(self, size=None):
+    # Small reads keep the throttling smooth and the reset point accurate.
+    if size is None or size < 0 or size > self.BLOCK:
+      size = self.BLOCK
+    return self._account(self.fp.read(size))
+
+  def readline(self, size=None):
+    return self._account(self.fp.readline(size))
+
+  def readlines(self, sizehint=0):
+    return [self._account(line) for line in self.fp.readlines(sizehint)]
+
+  def __getattr__(self, name):
+    return getattr(self.fp, name)
+
+
+def _find_socket(fileobj):
+  """
+  Returns: The socket under the request's file object, unwrapping the
+    CherryPy and wsgiserver file wrappers.
+  """
+  seen = 0
+  while fileobj is not None and seen < 10:
+    if isinstance(fileobj, socket.socket) or hasattr(fileobj, "setsockopt"):
+      return fileobj
+    fileobj = (getattr(fileobj, "_sock", None) or
+               getattr(fileobj, "rfile", None) or getattr(fileobj, "fp", None))
+    seen += 1
+  return None
+
+def reset_connection():
+  """
+  Resets the connection of the current request: the client sees a
+  "connection reset by peer" while it sends the body.
+  """
+  sock = _find_socket(cherrypy.serving.request.rfile)
+  if sock is not None:
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                    struct.pack("ii", 1, 0))
+    try:
+      sock.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+      pass
+  raise socket.error("Connection reset by fault injection.")
+
+
+class Faults(object):
+  def __init__(self, latency=None, bandwidth_kbps=None, error_rates=(),
+               reset_rate=0, slow_rate=0, slow_seconds=30, wrong_md5_rate=0,
+               seed=None):
+    self.latency = latency and parse_distribution(latency)
+    self.bucket = bandwidth_kbps and TokenBucket(bandwidth_kbps * 1024)
+    self.error_rates = []
+    for spec in error_rates:
+      status, rate = spec.split(":")
+      self.error_rates.append((int(status), float(rate)))
+    self.reset_rate = reset_rate
+    self.slow_rate = slow_rate
+    self.slow_seconds = slow_seconds
+    self.wrong_md5_rate = wrong_md5_rate
+    self.random = random.Random(seed)
+    self.random_lock = threading.Lock()
+
+  def _random(self):
+    with self.random_lock:
+      return self.random.random()
+
+  def install(self):
+    """
+    Applies the faults to all the requests of the server, but shutdown.
+    """
+    cherrypy.tools.faults = cherrypy.Tool("on_start_resource",
+                                          self._on_start_resource)
+    cherrypy.config.update({"tools.faults.on": True})
+
+  def _on_start_resource(self):
+    request = cherrypy.serving.request
+    if request.path_info.endswith("/shutdown"):
+      return
+    reset_after = None
+    if self.reset_rate and self._random() < self.reset_rate:
+      length = int(request.headers.get("Content-Length") or 0)
+      reset_after = int(length * self._random())
+    if self.bucket or reset_after is not None:
+      request.body.fp = ShapedFile(request.body.fp, self.bucket, reset_after)
+    request.hooks.attach("before_handler", self._before_handler)
+    if self.wrong_md5_rate:
+      request.hooks.attach("before_finalize", self._corrupt_md5)
+
+  def _before_handler(self):
+    # The body is read; the delay stands for the server processing time.
+    delay = 0
+    if self.latency:
+      with self.random_lock:
+        delay = max(0, self.latency(self.random))
+    if self.slow_rate and self._random() < self.slow_rate:
+      delay += self.slow_seconds
+    if delay:
+      time.sleep(delay)
+    for status, rate in self.error_rates:
+      if self._random() < rate:
+        raise cherrypy.HTTPError(status, "Injected fault.")
+
+  def _corrupt_md5(self):
+    response = cherrypy.serving.response
+    # The status is set by now only if the request failed.
+    if response.status and not str(response.status).startswith("200"):
+      return
+    # The body may be an iterator: it is put back whatever happens.
+    text = "".join(response.body)
+    response.body = text
+    try:
+      body = json.loads(text)
+    except (ValueError, TypeError):
+      return
+    changed = False
+    for obj in [body] + list(body.get("results", [])):
+      for key in ("file_md5", "part_md5"):
+        if key in obj and self._random() < self.wrong_md5_rate:
+          obj[key] = "0" * 32
+          changed = True
+    if changed:
+      response.body = json.dumps(body)
+      response.headers.pop("Content-Length", None)
+
+
+def add_arguments(parser):
+  parser.add_argument("--latency")
+  parser.add_argument("--bandwidth-kbps", type=float)
+  parser.add_argument("--error-rate", action="append", default=[])
+  parser.add_argument("--reset-rate", type=float, default=0)
+  parser.add_argument("--slow-rate", type=float, default=0)
+  parser.add_argument("--slow-seconds", type=float, default=30)
+  parser.add_argument("--wrong-md5-rate", type=float, default=0)
+  parser.add_argument("--seed", type=int)
+
+def from_args(args):
+  return Faults(args.latency, args.bandwidth_kbps, args.error_rate,
+                args.reset_rate, args.slow_rate, args.slow_seconds,
+                args.wrong_md5_rate, args.seed)
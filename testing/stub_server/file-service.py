@@ -7,9 +7,19 @@ absDir = os.path.join(os.getcwd(), localDir)
 
 import cherrypy
 import json
+import tempfile
+import threading
+import base64
+import uuid
+import gzip
 
 import hashlib
 
+import faults
+
+# Bytes read from an uploaded file at a time.
+READ_BLOCK = 2 ** 20
+
 class FileDemo(object):
 
     def index(self):
@@ -46,25 +56,60 @@ class FileDemo(object):
         m = hashlib.md5()
         size = 0
         while True:
-            data = file.file.read(8192)
+            data = file.file.read(READ_BLOCK)
             if not data:
                 break
             size += len(data)
             m.update(data)
         file.file.seek(0)
         h = m.hexdigest()
-        return { 
+        return self._store({ 
             "file_size": size,
             "file_name": unicode(file.filename),            
             "file_md5": h,
             "file_reference": filereference,
             "content_type": unicode(file.content_type),
             "file_url": "127.0.0.1:8080/"+h
-        }
+        })
     images.exposed = True
 
     @cherrypy.tools.json_out()
-    def datasets(self, file):
+    def batch(self, **kwargs):
+        """
+        Stores the files file0..fileN with references filereference0..N and
+        returns a result for each of them.
+        """
+        results = []
+        index = 0
+        while "file%d" % index in kwargs:
+            result = self.images(kwargs["file%d" % index],
+                                 kwargs.get("filereference%d" % index))
+            result["index"] = index
+            results.append(result)
+            index += 1
+        return {"results": results}
+    batch.exposed = True
+
+    # The records of the stored media, keyed by MD5.
+    stored_media = {}
+
+    def _store(self, result):
+        self.stored_media[result["file_md5"]] = result
+        return result
+
+    @cherrypy.tools.json_out()
+    def exists(self):
+        """
+        Returns the records of the media with the given MD5s that are already
+        stored.
+        """
+        file_md5s = json.loads(cherrypy.request.body.read())["file_md5s"]
+        return {"existing": dict((h, self.stored_media[h]) for h in file_md5s
+                                 if h in self.stored_media)}
+    exists.exposed = True
+
+    @cherrypy.tools.json_out()
+    def datasets(self, file, content_encoding=None):
         out = """<html>
         <body>
             myFile length: %s<br />
@@ -78,39 +123,156 @@ class FileDemo(object):
         # how to read large files in chunks instead of all at once.
         # CherryPy reads the uploaded file into a temporary file;
         # myFile.file.read reads from that.
+        # A gzip-encoded upload is decoded, so the size and MD5 are of the
+        # CSV file itself.
+        if content_encoding == "gzip":
+            stream = gzip.GzipFile(fileobj=file.file, mode="rb")
+        elif content_encoding:
+            raise cherrypy.HTTPError(415, "Unsupported content encoding.")
+        else:
+            stream = file.file
         size = 0
         m = hashlib.md5()
         size = 0
         while True:
-            data = file.file.read(8192)
-            print data
+            data = stream.read(READ_BLOCK)
             if not data:
                 break
             size += len(data)
             m.update(data)
         file.file.seek(0)
         h = m.hexdigest()
-        return { 
+        result = { 
             "file_size": size,
             "file_name": unicode(file.filename),            
             "file_md5": h,
             "content_type": unicode(file.content_type),
             "file_url": "127.0.0.1:8080/"+h
         }
+        if content_encoding:
+            result["content_encoding"] = content_encoding
+        return result
     datasets.exposed = True
 
+    # Chunked upload sessions, keyed by session id. Sessions are also found by
+    # (file_reference, file_md5) so that a client can resume an upload.
+    upload_sessions = {}
+    upload_sessions_lock = threading.Lock()
+
+    @cherrypy.tools.json_out()
+    def sessions(self, *args, **kwargs):
+        """
+        POST /upload/sessions                       open or resume a session.
+        POST /upload/sessions/<id>/parts/<index>    upload one part.
+        POST /upload/sessions/<id>/commit           assemble the parts.
+        """
+        if not args:
+            return self._open_session(json.loads(cherrypy.request.body.read()))
+        with self.upload_sessions_lock:
+            session = self.upload_sessions.get(args[0])
+        if session is None:
+            raise cherrypy.HTTPError(404, "No such upload session.")
+        if len(args) == 3 and args[1] == "parts":
+            return self._receive_part(session, int(args[2]))
+        if len(args) == 2 and args[1] == "commit":
+            return self._commit_session(session)
+        raise cherrypy.HTTPError(404)
+    sessions.exposed = True
+
+    def _open_session(self, meta):
+        key = (meta["filereference"], meta["file_md5"])
+        with self.upload_sessions_lock:
+            for session in self.upload_sessions.values():
+                if session["key"] == key:
+                    break
+            else:
+                session = {
+                    "key": key,
+                    "session_id": uuid.uuid4().hex,
+                    "meta": meta,
+                    "part_size": int(meta["part_size"]),
+                    "dir": tempfile.mkdtemp(),
+                    "parts": {}
+                }
+                self.upload_sessions[session["session_id"]] = session
+            return {
+                "session_id": session["session_id"],
+                "part_size": session["part_size"],
+                "parts": dict(session["parts"])
+            }
+
+    def _receive_part(self, session, index):
+        data = cherrypy.request.body.read()
+        h = hashlib.md5(data)
+        expected = cherrypy.request.headers.get("Content-MD5")
+        if expected and base64.b64decode(expected) != h.digest():
+            raise cherrypy.HTTPError(400, "Content-MD5 mismatch.")
+        with open(os.path.join(session["dir"], str(index)), "wb") as f:
+            f.write(data)
+        with self.upload_sessions_lock:
+            session["parts"][str(index)] = h.hexdigest()
+        return {"part": index, "part_md5": h.hexdigest()}
+
+    def _commit_session(self, session):
+        meta = session["meta"]
+        size = int(meta["file_size"])
+        part_count = max(1, -(-size // session["part_size"]))
+        m = hashlib.md5()
+        for index in range(part_count):
+            path = os.path.join(session["dir"], str(index))
+            if not os.path.exists(path):
+                raise cherrypy.HTTPError(409, "Part %d is missing." % index)
+            with open(path, "rb") as f:
+                m.update(f.read())
+        h = m.hexdigest()
+        with self.upload_sessions_lock:
+            self.upload_sessions.pop(session["session_id"], None)
+        return self._store({
+            "file_size": size,
+            "file_name": unicode(meta["file_name"]),
+            "file_md5": h,
+            "file_reference": meta["filereference"],
+            "content_type": u"application/octet-stream",
+            "file_url": "127.0.0.1:8080/"+h
+        })
+
     @cherrypy.tools.json_out()
     def shutdown(self):
       sys.exit()
     shutdown.exposed = True
 
 
+class Root(object):
+
+    @cherrypy.tools.json_out()
+    def check(self, *args, **kwargs):
+        # Any account is accepted.
+        return {}
+    check.exposed = True
+
+
 tutconf = os.path.join(os.path.dirname(__file__), 'tutorial.conf')
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--threads", type=int, default=10,
+                        help="Requests handled concurrently.")
+    faults.add_arguments(parser)
+    args = parser.parse_args()
+    # HTTP/1.1 keeps the connections alive between requests.
+    cherrypy.config.update({
+        "server.socket_port": args.port,
+        "server.thread_pool": args.threads,
+        "server.socket_queue_size": max(5, args.threads),
+        "server.protocol_version": "HTTP/1.1",
+        "log.screen": False})
+    faults.from_args(args).install()
     # CherryPy always starts with app.root when trying to map request URIs
     # to objects, so we need to mount a request handler root. A request
     # to '/' will be mapped to HelloWorld().index().
+    cherrypy.tree.mount(Root(), "", config=tutconf)
     cherrypy.quickstart(FileDemo(), script_name="/upload", config=tutconf)
 else:
     # This branch is for the test suite; you can ignore it.
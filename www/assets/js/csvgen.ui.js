@@ -110,15 +110,19 @@ postCsvGeneration = function(values) {
         $(".progress-primary").addClass('active');
         $("#progressbar-container-csvgen").addClass('in');
 
-        setTimeout("updateCSVGenProgress()", 100);
+        updateCSVGenProgress(-1);
     };
     
     // now send the form and wait to hear back
     $.post("/services/generatecsv", { values: values }, callback, 'json');
 }
 
-updateCSVGenProgress = function() {
-    var url = '/services/csvgenprogress';
+/**
+ * Long-polls the CSV generation progress: the server answers when the
+ * progress differs from the given version.
+ */
+updateCSVGenProgress = function(version) {
+    var url = '/services/csvgenprogress?version=' + version + '&now=' + $.now();
     
     $.getJSON(url, function(progressObj) {
         
@@ -154,8 +158,7 @@ updateCSVGenProgress = function() {
                 showAlert2("Error: " + progressObj.error, "", "alert-error");
             }
         } else { // Not finished.
-            // Calls itself again after 100ms.
-            setTimeout("updateCSVGenProgress()", 100);
+            updateCSVGenProgress(progressObj.version);
         }
     });
 }
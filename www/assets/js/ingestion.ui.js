@@ -309,7 +309,7 @@ postCsvUpload = function(action, values) {
     $(".progress-primary").addClass('active');
     $("#progressbar-container").addClass('in');
 
-    setTimeout("updateProgress()", 1000);
+    updateProgress(-1);
   };
 
   // now send the form and wait to hear back
@@ -382,16 +382,66 @@ showAlert = function(message, additionalElement, alertType) {
   $("#alert-extra").html(additionalElement);
 }
 
-updateProgress = function() {
+formatBytes = function(bytes) {
+  var units = ["B", "KB", "MB", "GB", "TB"];
+  var i = 0;
+  while (bytes >= 1024 && i < units.length - 1) {
+    bytes /= 1024;
+    i++;
+  }
+  return (i == 0 ? bytes : bytes.toFixed(1)) + " " + units[i];
+}
+
+formatDuration = function(seconds) {
+  seconds = Math.round(seconds);
+  var h = Math.floor(seconds / 3600);
+  var m = Math.floor(seconds % 3600 / 60);
+  var s = seconds % 60;
+  return (h > 0 ? h + "h " : "") + (h > 0 || m > 0 ? m + "m " : "") + s + "s";
+}
+
+/**
+ * Returns the sent bytes, rate and remaining time of the progress as text.
+ */
+formatByteProgress = function(progressObj) {
+  if (!progressObj.bytes_total || progressObj.finished) {
+    return "";
+  }
+  var text = "Sent " + formatBytes(progressObj.bytes_done) + " of " +
+    formatBytes(progressObj.bytes_total);
+  if (progressObj.bytes_per_second != null) {
+    text += " at " + formatBytes(progressObj.bytes_per_second) + "/s";
+  }
+  if (progressObj.eta_seconds != null) {
+    text += ", about " + formatDuration(progressObj.eta_seconds) + " left";
+  }
+  return text + ". ";
+}
+
+/**
+ * Long-polls the upload progress: the server answers when the progress
+ * differs from the given version.
+ */
+updateProgress = function(version) {
   // dummy query string is added not to allow IE retrieve results
   // from its browser cache.
   // added by Kyuho in July 23rd 2013
-  var url = '/services/ingestionprogress?&now=' + $.now();
+  var url = '/services/ingestionprogress?version=' + version + '&now=' + $.now();
 
   $.getJSON(url, function(progressObj) {
-    var progress = progressObj.total == 0 ? 100 :
+    if (!progressObj.started) {
+      // The upload task is not created yet.
+      updateProgress(progressObj.version);
+      return;
+    }
+    var progress = progressObj.total == 0 ? (progressObj.finished ? 100 : 0) :
       Math.floor((progressObj.successes + progressObj.fails +
         progressObj.skips) / progressObj.total * 100);
+    if (progressObj.bytes_total > 0 && !progressObj.finished) {
+      // Bytes tell the remaining time better than files of mixed sizes.
+      progress = Math.min(progress, Math.floor(
+        progressObj.bytes_done / progressObj.bytes_total * 100));
+    }
 
     var csvfileuploaded = "";
     if (progress == 100) {
@@ -409,7 +459,8 @@ updateProgress = function() {
        ", Skipped: " + progressObj.skips,
        ", Failed: " + progressObj.fails,
        ", Total to upload: " + progressObj.total,
-       ". " + csvfileuploaded,
+       ". " + formatByteProgress(progressObj),
+       csvfileuploaded,
        ")"].join(""));
 
     $("#upload-progressbar").width(progress + '%');
@@ -484,9 +535,12 @@ updateProgress = function() {
         $.getJSON('/services/ingestionresult', renderResult);
       }
     } else {
-      // Calls itself again after 1000ms.
-      setTimeout("updateProgress ()", 1000);
+      updateProgress(progressObj.version);
     }
+  })
+  .error(function() {
+    // Try again after a while, e.g. if the task is not queued yet.
+    setTimeout(function() { updateProgress(version); }, 1000);
   });
 }
 